@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 from flask_cors import CORS
 import requests
 import os
@@ -6,19 +6,54 @@ from dotenv import load_dotenv
 import re
 import ast
 import json
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Iterable, Optional
 import tempfile
 import base64
+import sys
+import time
+import uuid
+import queue
+import random
+import atexit
+import logging
+import logging.handlers
+import threading
+import bisect
+import collections
+import multiprocessing
+import hashlib
+import contextvars
+import functools
+import math
+import hmac
+import socket
+import tracemalloc
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 import tiktoken  # For accurate token counting
 
 # Load environment variables
 load_dotenv()
 
+_encodings: Dict[str, Any] = {}
+_encoding_retry_at: Dict[str, float] = {}
+
+def get_encoding(model: str = "cl100k_base"):
+    """The tiktoken encoding, loaded once. A failed load (its BPE file is
+    downloaded on first use) is retried at most once a minute instead of
+    on every count."""
+    encoding = _encodings.get(model)
+    if encoding is not None or time.monotonic() < _encoding_retry_at.get(model, 0.0):
+        return encoding
+    try:
+        encoding = _encodings[model] = tiktoken.get_encoding(model)
+    except Exception:
+        _encoding_retry_at[model] = time.monotonic() + 60.0
+    return encoding
+
 def count_tokens(text: str, model: str = "cl100k_base") -> int:
     """Count tokens accurately using tiktoken"""
     try:
-        encoding = tiktoken.get_encoding(model)
-        return len(encoding.encode(text))
+        return len(get_encoding(model).encode(text))
     except:
         # Fallback: rough estimation (4 chars = 1 token)
         return len(text) // 4
@@ -39,9 +74,324 @@ DEFAULT_CONFIG = {
     'model': 'llama3-8b-8192',
     'maxContextLength': 6000,  # Increased for better analysis
     'maxTokens': 4096,  # Response token limit
-    'maxInputTokens': 6000  # Input token limit (leaving room for response)
+    'maxInputTokens': 6000,  # Input token limit (leaving room for response)
+    'outputPercentile': 95,  # max_tokens is this percentile of a template's observed completion sizes...
+    'outputHeadroom': 0.25,  # ...plus this fraction, between outputMinTokens and maxTokens
+    'outputMinTokens': 256,
+    'outputMinSamples': 20,  # Completions observed before a template/prompt shape gets its own limit
+    'outputSampleWindow': 200,  # Recent completion sizes kept per template and prompt shape
+    'outputRetryGrowth': 2.0,  # A response cut off at max_tokens is retried with the limit grown by this factor
+    'maxBatchSize': 50,  # Max prompts per /api/analyze-and-execute/batch request
+    'batchParallelism': 4,  # Default concurrent upstream calls per batch
+    'maxBatchParallelism': 16,  # Upper bound for a client-requested parallelism
+    'promptTemplateDir': os.environ.get('PROMPT_TEMPLATE_DIR', ''),  # Optional directory of <name>.txt template overrides
+    'modelEndpoints': [],  # Optional [{url, apiKey, model, weight}]; defaults to modelApiUrl alone
+    'hedgeEnabled': True,  # Send a duplicate to the next endpoint when the primary is slow
+    'hedgePercentile': 95,  # Hedge after the primary's own p95 latency
+    'hedgeDefaultDelay': 2.0,  # Hedge delay in seconds until an endpoint has latency history
+    'hedgeMinDelay': 0.05,
+    'hedgeWorkers': 32,
+    'latencyWindow': 100,  # Recent successful latencies kept per endpoint
+    'circuitWindow': 20,  # Recent outcomes used for the circuit breaker error rate
+    'circuitMinCalls': 5,
+    'circuitErrorRate': 0.5,  # Open the circuit at this error rate
+    'circuitOpenSeconds': 30,  # Time before an open circuit allows a trial request
+    'rateLimitRequestsPerMinute': 30,  # Upstream request budget, corrected from x-ratelimit-* headers
+    'rateLimitTokensPerMinute': 30000,  # Upstream input+output token budget
+    'rateLimitMaxWait': 60,  # Seconds a call may queue for rate-limit capacity before failing
+    'classifierContextChars': 20000,  # Context sample size scanned when picking a system prompt
+    'analysisFileBudget': 5.0,  # Seconds one file may spend in its analyzer before falling back to an outline
+    'analysisRequestBudget': 15.0,  # Seconds all file analysis of one request may take
+    'analysisWorkers': 2,  # Analyzer processes; a worker that overruns its budget is killed and replaced
+    'analysisWorkerStartTimeout': 60,  # Seconds a new analyzer process may take to import
+    'analysisRespawnBackoff': 1.0,  # First retry delay after a replacement worker fails to start; doubles each time
+    'analysisRespawnMaxBackoff': 60.0,  # Ceiling for that delay; retries go on until a worker starts
+    'degradedOutlineLines': 40,  # Leading lines kept in the outline of an over-budget file
+    'defaultRequestTimeout': 0,  # Seconds; deadline for clients that send none (0 = no deadline)
+    'deadlineAnalysisShare': 0.4,  # Fraction of the remaining request budget file analysis may use
+    'deadlineTightSeconds': 5.0,  # Below this budget, folder walks and main-program extraction are skipped
+    'deadlineMinModelSeconds': 1.0,  # Return a partial result instead of calling the model with less time than this
+    'deadlineReserveSeconds': 0.25,  # Kept back from the upstream call to build and send the response
+    'maxSessions': 100,  # Conversation sessions kept; the least recently used is evicted beyond this
+    'sessionIdleSeconds': 1800,  # Sessions unused for this long are evicted
+    'sessionMaxBytes': 8 * 1024 * 1024,  # Memory cap per session (analysis summaries and turns)
+    'sessionHistoryTokens': 1500,  # Prior turns sent with each session turn
+    'chunkMaxTokens': 400,  # Larger functions/classes are split into members or line windows
+    'chunkMinRelevance': 0.5,  # Chunks scoring below this fraction of the best chunk stay out of the context
+    'nearDuplicateThreshold': 0.8,  # Files whose MinHash similarity to an earlier input reaches this are listed, not analyzed (0 = off)
+    'compiledDuplicateThreshold': 0.6,  # Same, for compiled output next to its source with the same name (x.ts / x.js)
+    'minhashBins': 128,  # MinHash signature length
+    'minhashBands': 32,  # LSH bands; files sharing any band are compared
+    'nearDuplicateMinBytes': 256,  # Smaller files are always analyzed
+    'nearDuplicateMaxBytes': 1048576,  # Larger files are never read whole just to compare them
+    'dedupMinLines': 4,  # Repeated runs of at least this many code lines are emitted once per context (0 = off)
+    'dependencyMaxDepth': 2,  # Hops of calls/imports followed from the relevant chunks (0 = off)
+    'dependencyGraphFiles': 20000,  # Per-file dependency nodes cached across requests
+    'summaryCacheEntries': 10000,  # Rendered file/folder summaries (with token counts) kept across requests
+    'tokenEstimateMargin': 0.1,  # Estimates within this fraction of a budget limit are replaced by exact counts
+    'tokenCalibrationMinChars': 20000,  # Exact-counted chars per language before its learned ratio replaces the seed
+    'maxConcurrentRequests': 16,  # Model-bound requests (analyze, batch, session turns) handled at once
+    'admissionQueueSize': 32,  # Requests that may wait for a slot; beyond this they get 429 at once
+    'admissionMaxWait': 10,  # Seconds a queued request may wait for a slot before it gets 429
+    'admissionRateWindow': 60,  # Seconds of completions used to estimate the queue drain rate for Retry-After
+    'priorityWeights': {'interactive': 8, 'normal': 4, 'bulk': 1},  # Weighted-fair shares of queued work per priority
+    'bulkMaxShare': 0.75,  # Fraction of request slots and analysis workers bulk work may hold at once
+    'adminToken': os.environ.get('ADMIN_TOKEN', ''),  # Required in X-Admin-Token for /api/debug/*; unset disables them
+    'memorySnapshotsKept': 8,  # Named tracemalloc snapshots kept for diffing
+    'memoryRequestHistory': 200,  # Recent per-request peak memory records kept while tracing
+    'memoryTopSites': 25,  # Allocation sites reported by default
+    'workspacePollSeconds': 2.0,  # Rescan interval when watchdog is not installed
+    'workspaceIndexDutyCycle': 0.5,  # Fraction of one core the background indexer may use
+    'workspaceMaxFiles': 5000,  # Files indexed per workspace
+    'workspaceMaxFileBytes': 1024 * 1024,  # Larger files are listed but not analyzed
+    'workspaceIgnoreDirs': ['node_modules', '__pycache__', 'venv', 'dist', 'build', 'out', 'target'],
+    'logLevel': 'INFO',
+    'logPayloadChars': 200,  # Prompt/context/output fields are truncated to this size in logs
+    'logQueueSize': 10000,  # Records beyond this are dropped instead of blocking requests
+    'logSampleRates': {  # Fraction of INFO events kept, per event name (default 1.0)
+        'model_request': 1.0,
+        'model_response': 1.0,
+        'request_complete': 1.0
+    }
 }
 
+# --- TOKEN ACCOUNTING ---
+# Most token counts are only displayed or are far from any limit, so they are
+# estimated from per-language chars-per-token ratios. Exact tokenization runs
+# only for decisions within `tokenEstimateMargin` of a budget, and every exact
+# count recalibrates the ratio for its language.
+
+class TokenEstimator:
+    """Calibrated per-language token estimates, with counters for the estimator's error"""
+
+    # Starting chars-per-token ratios for cl100k_base, replaced as exact counts come in
+    SEED_RATIOS = {
+        'python': 3.6, 'javascript': 3.4, 'typescript': 3.4, 'java': 3.8, 'c': 3.3, 'cpp': 3.3,
+        'html': 3.1, 'css': 3.2, 'json': 3.0, 'yaml': 3.4, 'xml': 3.0, 'text': 4.0
+    }
+
+    def __init__(self, margin: float, min_calibration_chars: int):
+        self.margin = margin
+        self.min_calibration_chars = min_calibration_chars
+        self._lock = threading.Lock()
+        self._chars = collections.Counter()  # Exact-counted chars and tokens per language
+        self._tokens = collections.Counter()
+        self._ratios = dict(self.SEED_RATIOS)
+        self.estimated = 0
+        self.estimated_chars = 0
+        self.exact = 0
+        self.exact_chars = 0
+        self.fallback = 0  # count() calls made while tiktoken could not be loaded
+        self._errors: Dict[str, List[float]] = {}  # language -> [samples, sum of |relative error|, max]
+
+    def ratio(self, language: str) -> float:
+        return self._ratios.get(language) or self._ratios['text']
+
+    def estimate(self, text: str, language: str = 'text') -> int:
+        return self.estimate_chars(len(text), language)
+
+    def estimate_chars(self, chars: int, language: str = 'text') -> int:
+        with self._lock:
+            self.estimated += 1
+            self.estimated_chars += chars
+        return int(chars / self.ratio(language) + 0.5)
+
+    def estimate_many(self, texts: List[str], language: str = 'text') -> List[int]:
+        """Estimates for a batch of texts with one ratio lookup and one counter update"""
+        ratio = self.ratio(language)
+        lengths = [len(text) for text in texts]
+        with self._lock:
+            self.estimated += len(lengths)
+            self.estimated_chars += sum(lengths)
+        return [int(length / ratio + 0.5) for length in lengths]
+
+    def count(self, text: str, language: str = 'text') -> int:
+        """Exact count; also records how far off the estimate was and recalibrates the language's ratio.
+
+        Without tiktoken the count is count_tokens' chars/4 fallback, which
+        says nothing about the language, so nothing is learned from it.
+        """
+        predicted = len(text) / self.ratio(language)
+        tokens = count_tokens(text)
+        if get_encoding() is None:
+            with self._lock:
+                self.fallback += 1
+            return tokens
+        with self._lock:
+            self.exact += 1
+            self.exact_chars += len(text)
+            if tokens:
+                error = abs(predicted - tokens) / tokens
+                stats = self._errors.setdefault(language, [0, 0.0, 0.0])
+                stats[0] += 1
+                stats[1] += error
+                stats[2] = max(stats[2], error)
+                self._chars[language] += len(text)
+                self._tokens[language] += tokens
+                if self._chars[language] >= self.min_calibration_chars:
+                    self._ratios[language] = self._chars[language] / self._tokens[language]
+        return tokens
+
+    def needs_calibration(self, language: str) -> bool:
+        with self._lock:
+            return self._chars[language] < self.min_calibration_chars
+
+    def calibrate(self, samples: List[tuple]):
+        """Learn ratios up front from (text, language) samples"""
+        for text, language in samples:
+            self.count(text, language)
+
+    def fits(self, tokens: int, limit: int) -> Optional[bool]:
+        """Whether an estimated `tokens` fits in `limit`, or None when it is too close to call without an exact count"""
+        if tokens * (1 + self.margin) <= limit:
+            return True
+        if tokens * (1 - self.margin) > limit:
+            return False
+        return None
+
+    def ratios(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._ratios)
+
+    def load_ratios(self, ratios: Dict[str, float]):
+        """Adopt ratios calibrated elsewhere (analysis workers get the request process's)"""
+        with self._lock:
+            self._ratios.update(ratios)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'estimated': self.estimated,
+                'estimated_chars': self.estimated_chars,
+                'exact': self.exact,
+                'exact_chars': self.exact_chars,
+                'fallback': self.fallback,
+                'ratios': {language: round(ratio, 3) for language, ratio in self._ratios.items()},
+                'error': {
+                    language: {'samples': int(stats[0]), 'mean_pct': round(stats[1] / stats[0] * 100, 2),
+                               'max_pct': round(stats[2] * 100, 2)}
+                    for language, stats in self._errors.items()
+                }
+            }
+
+token_estimator = TokenEstimator(DEFAULT_CONFIG['tokenEstimateMargin'], DEFAULT_CONFIG['tokenCalibrationMinChars'])
+
+# --- STRUCTURED LOGGING ---
+# Log records are formatted as JSON lines and written by a background listener
+# thread, so the request path only pays for truncation and a queue put.
+request_id_var: contextvars.ContextVar = contextvars.ContextVar('request_id', default=None)
+
+class LogStats:
+    """Counters describing log volume and the time spent logging on the request path"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.emitted = 0
+        self.sampled_out = 0
+        self.dropped = 0
+        self.bytes_written = 0
+        self.call_seconds = 0.0
+        self.max_call_seconds = 0.0
+
+    def record_call(self, seconds: float):
+        with self._lock:
+            self.emitted += 1
+            self.call_seconds += seconds
+            self.max_call_seconds = max(self.max_call_seconds, seconds)
+
+    def record_sampled_out(self):
+        with self._lock:
+            self.sampled_out += 1
+
+    def record_dropped(self):
+        with self._lock:
+            self.dropped += 1
+
+    def record_bytes(self, count: int):
+        with self._lock:
+            self.bytes_written += count
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'emitted': self.emitted,
+                'sampled_out': self.sampled_out,
+                'dropped': self.dropped,
+                'bytes_written': self.bytes_written,
+                'avg_call_ms': (self.call_seconds / self.emitted * 1000) if self.emitted else 0.0,
+                'max_call_ms': self.max_call_seconds * 1000,
+                'queue_depth': log_queue.qsize()
+            }
+
+class StructuredFormatter(logging.Formatter):
+    """Render a log record as a single JSON line"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'event': getattr(record, 'event', record.getMessage()),
+            'request_id': getattr(record, 'request_id', None)
+        }
+        entry.update(getattr(record, 'fields', {}))
+        line = json.dumps(entry, default=str, ensure_ascii=False)
+        log_stats.record_bytes(len(line) + 1)
+        return line
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that drops (and counts) records instead of blocking when the queue is full"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Formatting happens on the listener thread, not here
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_stats.record_dropped()
+
+def truncate_field(value: Any, limit: int) -> Any:
+    """Truncate a log payload field to at most `limit` characters"""
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if not isinstance(value, str):
+        value = json.dumps(value, default=str, ensure_ascii=False)
+    if len(value) > limit:
+        return f"{value[:limit]}... (+{len(value) - limit} chars)"
+    return value
+
+def log_event(event: str, level: int = logging.INFO, **fields):
+    """Log a structured event, applying per-event sampling and payload truncation"""
+    if not logger.isEnabledFor(level):
+        return
+    start = time.perf_counter()
+    rate = DEFAULT_CONFIG['logSampleRates'].get(event, 1.0)
+    # Warnings and errors are never sampled away
+    if level < logging.WARNING and rate < 1.0 and random.random() >= rate:
+        log_stats.record_sampled_out()
+        return
+    limit = DEFAULT_CONFIG['logPayloadChars']
+    logger.log(level, event, extra={
+        'event': event,
+        'request_id': request_id_var.get(),
+        'fields': {key: truncate_field(value, limit) for key, value in fields.items()}
+    })
+    log_stats.record_call(time.perf_counter() - start)
+
+log_stats = LogStats()
+log_queue: queue.Queue = queue.Queue(maxsize=DEFAULT_CONFIG['logQueueSize'])
+_log_output = logging.StreamHandler(sys.stdout)
+_log_output.setFormatter(StructuredFormatter())
+log_listener = logging.handlers.QueueListener(log_queue, _log_output)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+logger = logging.getLogger('nlp_agent')
+logger.setLevel(DEFAULT_CONFIG['logLevel'])
+logger.propagate = False
+logger.addHandler(BoundedQueueHandler(log_queue))
+
 # --- SYSTEM PROMPT TEMPLATES ---
 SYSTEM_PROMPTS = {
     "python_script": (
@@ -200,47 +550,780 @@ SYSTEM_PROMPTS = {
     )
 }
 
+# Text wrapped around the context in the user message; its token cost is fixed
+CONTEXT_MESSAGE_TEMPLATE = "Context:\n{context}\n\nUser Request: {prompt}"
+
+def encode_tokens(text: str, model: str = "cl100k_base") -> Optional[List[int]]:
+    """Encode text with tiktoken, or return None when tiktoken is unavailable"""
+    try:
+        return get_encoding(model).encode(text)
+    except Exception:
+        return None
+
+class PromptRegistry:
+    """Precomputed system prompt templates with their token counts and content hashes.
+
+    Built-in templates come from SYSTEM_PROMPTS. If a template directory is
+    configured, each `<name>.txt` file in it adds or overrides a template and
+    the directory is re-scanned (at most every `reload_interval` seconds) so
+    edits are picked up without a restart. Only changed templates are
+    re-tokenized.
+    """
+
+    def __init__(self, templates: Dict[str, str], template_dir: str = '', reload_interval: float = 2.0):
+        self.builtin_templates = dict(templates)
+        self.template_dir = template_dir
+        self.reload_interval = reload_interval
+        self.reloads = 0
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._dir_signature = None
+        self._last_check = 0.0
+        self.context_framing_tokens = count_tokens(CONTEXT_MESSAGE_TEMPLATE.format(context='', prompt=''))
+        self._load()
+
+    def _build_entry(self, name: str, text: str, source: str) -> Dict[str, Any]:
+        content_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+        previous = self._entries.get(name)
+        if previous and previous['hash'] == content_hash:
+            return dict(previous, source=source)
+        tokens = encode_tokens(text)
+        return {
+            'name': name,
+            'text': text,
+            'tokens': tokens,
+            'token_count': len(tokens) if tokens is not None else estimate_tokens(text),
+            'hash': content_hash,
+            'source': source,
+            'system_message': {'role': 'system', 'content': text}
+        }
+
+    def _scan_template_dir(self) -> Dict[str, str]:
+        """Map template name to file path for every template file in the directory"""
+        if not self.template_dir or not os.path.isdir(self.template_dir):
+            return {}
+        return {
+            os.path.splitext(file_name)[0]: os.path.join(self.template_dir, file_name)
+            for file_name in sorted(os.listdir(self.template_dir))
+            if file_name.endswith('.txt')
+        }
+
+    def _signature(self, paths: Dict[str, str]):
+        signature = []
+        for name, path in paths.items():
+            try:
+                stat = os.stat(path)
+                signature.append((name, stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                pass
+        return tuple(signature)
+
+    def _load(self):
+        paths = self._scan_template_dir()
+        entries = {}
+        for name, text in self.builtin_templates.items():
+            entries[name] = self._build_entry(name, text, 'builtin')
+        for name, path in paths.items():
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    entries[name] = self._build_entry(name, f.read(), path)
+            except OSError as e:
+                log_event('prompt_template_error', logging.WARNING, template=name, error=str(e))
+        with self._lock:
+            self._entries = entries
+            self._dir_signature = self._signature(paths)
+            self._last_check = time.monotonic()
+
+    def reload_if_changed(self):
+        """Reload templates if the template directory changed since the last scan"""
+        if not self.template_dir or time.monotonic() - self._last_check < self.reload_interval:
+            return
+        paths = self._scan_template_dir()
+        if self._signature(paths) == self._dir_signature:
+            self._last_check = time.monotonic()
+            return
+        self._load()
+        self.reloads += 1
+        log_event('prompt_templates_reloaded', templates=len(self._entries), template_dir=self.template_dir)
+
+    def get(self, name: str) -> Dict[str, Any]:
+        """Get a template entry, falling back to the default template"""
+        self.reload_if_changed()
+        entries = self._entries
+        return entries.get(name) or entries['default']
+
+    def token_count(self, name: str) -> int:
+        return self.get(name)['token_count']
+
+    @property
+    def max_token_count(self) -> int:
+        """Token cost of the largest template, for budgeting before a template is chosen"""
+        self.reload_if_changed()
+        return max(entry['token_count'] for entry in self._entries.values())
+
+    def describe(self) -> Dict[str, Any]:
+        self.reload_if_changed()
+        return {
+            'template_dir': self.template_dir,
+            'reloads': self.reloads,
+            'context_framing_tokens': self.context_framing_tokens,
+            'templates': [
+                {
+                    'name': entry['name'],
+                    'token_count': entry['token_count'],
+                    'hash': entry['hash'],
+                    'source': entry['source']
+                }
+                for entry in self._entries.values()
+            ]
+        }
+
+prompt_registry = PromptRegistry(SYSTEM_PROMPTS, DEFAULT_CONFIG['promptTemplateDir'])
+
+# --- SYSTEM PROMPT CLASSIFIER ---
+# Each rule scores one template. Keyword weights are applied per match in the
+# user prompt (scaled by prompt_weight) and in a bounded sample of the context
+# (capped per template), so prompt intent outweighs whatever the files contain.
+# Negative weights suppress a template. Ties go to the earlier rule.
+PROMPT_CLASSIFIER_RULES = [
+    {
+        'template': 'nlp_app',
+        'prompt': {'nlp': 1.0, 'natural language processing': 1.0, 'text analysis': 1.0},
+        'context': {'nltk': 1.0, 'spacy': 1.0}
+    },
+    {
+        'template': 'angular_app',
+        'prompt': {'angular': 1.0, 'typescript': 1.0, 'react': -1.0, 'fastapi': -1.0},
+        'context': {'@angular': 1.0}
+    },
+    {
+        'template': 'java',
+        'prompt': {'java': 1.0, 'javac': 1.0, 'maven': 1.0, 'gradle': 1.0},
+        'context': {'java': 1.0, '.java': 1.0}
+    },
+    {
+        'template': 'c',
+        'prompt': {'c programming': 1.0, 'gcc': 1.0, 'c code': 1.0},
+        'context': {'.c': 1.0, '#include': 1.0, 'language: c': 1.0}
+    },
+    {
+        'template': 'flask_app',
+        'prompt': {'flask': 1.0},
+        'context': {'flask': 1.0}
+    },
+    {
+        'template': 'fastapi_app',
+        'prompt': {'fastapi': 1.0},
+        'context': {'fastapi': 1.0}
+    },
+    {
+        'template': 'react_app',
+        'prompt': {'react': 1.0, 'jsx': 1.0, 'tsx': 1.0},
+        'context': {'react': 1.0, '.jsx': 1.0, '.tsx': 1.0}
+    },
+    {
+        'template': 'data_analysis',
+        'prompt': {'analyze': 0.2, 'plot': 1.0, 'dataframe': 1.0, 'pandas': 1.0, 'matplotlib': 1.0},
+        'context': {'pandas': 1.0, 'matplotlib': 1.0}
+    },
+    {
+        'template': 'webapp',
+        'prompt': {'web app': 1.0},
+        'context': {'html': 1.0, 'css': 1.0, 'javascript': 1.0}
+    },
+    {
+        'template': 'nodejs',
+        'prompt': {'node.js': 1.0, 'nodejs': 1.0},
+        'context': {'node': 1.0, 'node.js': 1.0}
+    },
+    {
+        'template': 'python_script',
+        'prompt': {'python': 1.0},
+        'context': {'python': 1.0, '.py': 1.0}
+    },
+    {
+        'template': 'minimal',
+        'prompt': {'minimal': 0.5, 'script only': 0.5, 'just code': 0.5, 'no explanation': 0.5},
+        'context': {}
+    }
+]
+
+class PromptClassifier:
+    """Scores system prompt templates in a single regex pass over prompt and context"""
+
+    def __init__(self, rules: List[Dict[str, Any]], prompt_weight: float = 5.0,
+                 context_cap: float = 4.0, context_sample_chars: int = 20000):
+        self.templates = [rule['template'] for rule in rules]
+        self.prompt_weight = prompt_weight
+        self.context_cap = context_cap
+        self.context_sample_chars = context_sample_chars
+        self.prompt_weights: Dict[str, List[tuple]] = {}
+        self.context_weights: Dict[str, List[tuple]] = {}
+        for rule in rules:
+            for keyword, weight in rule['prompt'].items():
+                self.prompt_weights.setdefault(keyword.lower(), []).append((rule['template'], weight))
+            for keyword, weight in rule['context'].items():
+                self.context_weights.setdefault(keyword.lower(), []).append((rule['template'], weight))
+        self.pattern = self._compile(set(self.prompt_weights) | set(self.context_weights))
+
+    @staticmethod
+    def _compile(keywords) -> re.Pattern:
+        """Compile all keywords into one trie-shaped regex with word boundaries at word-character edges.
+
+        Factoring shared prefixes means each position in the text is rejected
+        after a single character test instead of one test per keyword.
+        """
+        def build_trie(words):
+            trie = {}
+            for word in words:
+                node = trie
+                for ch in word:
+                    node = node.setdefault(ch, {})
+                node[''] = True
+            return trie
+
+        def emit(node, last_char=''):
+            # Longer keywords are tried first; the end-of-keyword branch comes last
+            branches = [re.escape(ch) + emit(child, ch) for ch, child in sorted(node.items()) if ch]
+            if '' in node:
+                branches.append(r'(?!\w)' if re.match(r'\w', last_char) else '')
+            if len(branches) == 1:
+                return branches[0]
+            return '(?:' + '|'.join(branches) + ')'
+
+        word_start = [k for k in keywords if re.match(r'\w', k)]
+        other_start = [k for k in keywords if not re.match(r'\w', k)]
+        alternatives = []
+        if word_start:
+            alternatives.append(r'(?<!\w)' + emit(build_trie(word_start)))
+        if other_start:
+            alternatives.append(emit(build_trie(other_start)))
+        return re.compile('|'.join(alternatives), re.IGNORECASE)
+
+    def _sample_context(self, context: str) -> str:
+        """Bound the context scan to its head and tail"""
+        if len(context) <= self.context_sample_chars:
+            return context
+        half = self.context_sample_chars // 2
+        return context[:half] + '\n' + context[-half:]
+
+    def score(self, user_prompt: str, context: str = "") -> Dict[str, float]:
+        """Score every template; higher is a better match"""
+        scores = {template: 0.0 for template in self.templates}
+        for keyword in {m.group(0).lower() for m in self.pattern.finditer(user_prompt)}:
+            for template, weight in self.prompt_weights.get(keyword, ()):
+                scores[template] += weight * self.prompt_weight
+
+        if context:
+            context_scores = {template: 0.0 for template in self.templates}
+            for match in self.pattern.finditer(self._sample_context(context)):
+                for template, weight in self.context_weights.get(match.group(0).lower(), ()):
+                    context_scores[template] += weight
+            for template, value in context_scores.items():
+                scores[template] += min(value, self.context_cap)
+        return scores
+
+    def select(self, user_prompt: str, context: str = "") -> str:
+        scores = self.score(user_prompt, context)
+        # max() keeps the first of equal scores, i.e. the earlier rule
+        best = max(self.templates, key=lambda template: scores[template])
+        return best if scores[best] > 0 else 'default'
+
+prompt_classifier = PromptClassifier(
+    PROMPT_CLASSIFIER_RULES,
+    context_sample_chars=DEFAULT_CONFIG['classifierContextChars']
+)
+
 def select_system_prompt(user_prompt: str, context: str) -> str:
-    prompt = user_prompt.lower()
-    ctx = context.lower() if context else ""
-    # NLP app
-    if "nlp" in prompt or "natural language processing" in prompt or "text analysis" in prompt:
-        return "nlp_app"
-    # Angular app
-    if ("angular" in prompt or "typescript" in prompt) and not ("react" in prompt or "fastapi" in prompt):
-        return "angular_app"
-    # Java programming
-    if any(word in prompt for word in ["java", "javac", "maven", "gradle"]) or any(word in ctx for word in ["java", ".java"]):
-        return "java"
-    # C programming
-    if any(word in prompt for word in ["c programming", "gcc", "c code"]) or any(word in ctx for word in ["c", ".c"]):
-        return "c"
-    # Flask app
-    if any(word in prompt for word in ["flask"]) or "flask" in ctx:
-        return "flask_app"
-    # FastAPI app
-    if any(word in prompt for word in ["fastapi"]) or "fastapi" in ctx:
-        return "fastapi_app"
-    # React app
-    if any(word in prompt for word in ["react", "jsx", "tsx"]) or "react" in ctx:
-        return "react_app"
-    # Data analysis
-    if any(word in prompt for word in ["analyze", "plot", "dataframe", "pandas", "matplotlib"]) or "pandas" in ctx:
-        return "data_analysis"
-    # Web app (generic)
-    if any(word in ctx for word in ["html", "css", "javascript"]) or "web app" in prompt:
-        return "webapp"
-    # Node.js
-    if "node.js" in prompt or "nodejs" in prompt or "node" in ctx:
-        return "nodejs"
-    # Python script
-    if "python" in ctx or "py" in ctx or "python" in prompt:
-        return "python_script"
-    # Minimal (if user says minimal, script only, or similar)
-    if any(word in prompt for word in ["minimal", "script only", "just code", "no explanation"]):
-        return "minimal"
-    # Default
-    return "default"
+    return prompt_classifier.select(user_prompt, context or "")
+
+class CFamilyScanner:
+    """Linear-time declaration scanner for C-family sources (C, C++, Java, JS/TS).
+
+    One regex pass visits only braces, semicolons, comments, string/char
+    literals and preprocessor lines; everything between them is the header
+    of the next block. Brace depth is tracked with a stack, so bodies are
+    matched exactly regardless of nesting, and braces inside strings or
+    comments are ignored. Declarations are reported only when every
+    enclosing block is a type or namespace, i.e. top-level functions and
+    types plus the members of types, never code nested inside function bodies.
+    """
+
+    # Token alternatives; loops are unrolled so unterminated comments/literals stay linear
+    COMMENT = r'(?P<comment>//[^\n]*|/\*[^*]*(?:\*(?!/)[^*]*)*(?:\*/|\Z))'
+    STRING = r"""(?P<string>"[^"\\\n]*(?:\\.[^"\\\n]*)*(?:"|(?=\n)|\Z)|'[^'\\\n]*(?:\\.[^'\\\n]*)*(?:'|(?=\n)|\Z))"""
+    TEXT_BLOCK = r'(?P<textblock>"""[^"\\]*(?:(?:\\.|"(?!""))[^"\\]*)*(?:"""|\Z))'
+    TEMPLATE = r'(?P<template>`[^`\\]*(?:\\.[^`\\]*)*(?:`|\Z))'
+    DIRECTIVE = r'(?P<directive>(?<![^\n])[ \t]*\#[^\n\\]*(?:\\.[^\n\\]*)*)'
+    PUNCT = r'(?P<punct>[{};])'
+    _token_patterns: Dict[str, re.Pattern] = {}
+    _OPAQUE = ('block', None, None)
+
+    TYPE_PATTERN = re.compile(r'(?<![\w.])(class|interface|enum|struct|union|record|namespace)\b(?:\s+([A-Za-z_]\w*))?')
+    TRAILING_QUALIFIERS = ('const', 'noexcept', 'override', 'final')
+    NOT_FUNCTION_NAMES = {
+        'if', 'for', 'while', 'switch', 'catch', 'synchronized', 'return', 'sizeof',
+        'do', 'else', 'try', 'finally', 'new', 'throw', 'function'
+    }
+
+    def __init__(self, language: str = 'c'):
+        self.language = language
+        self.pattern = self._token_pattern(language)
+
+    @classmethod
+    def _token_pattern(cls, language: str) -> re.Pattern:
+        """Compile (once) the token pattern for a language: text blocks only exist in Java,
+        template literals in JavaScript/TypeScript, preprocessor directives in C/C++"""
+        if language not in cls._token_patterns:
+            parts = [cls.COMMENT]
+            if language == 'java':
+                parts.append(cls.TEXT_BLOCK)
+            parts.append(cls.STRING)
+            if language in ('javascript', 'typescript'):
+                parts.append(cls.TEMPLATE)
+            if language in ('c', 'cpp'):
+                parts.append(cls.DIRECTIVE)
+            parts.append(cls.PUNCT)
+            cls._token_patterns[language] = re.compile('|'.join(parts), re.DOTALL)
+        return cls._token_patterns[language]
+
+    def _mask(self, header: str) -> str:
+        """Blank out comments and literals in a header, keeping offsets intact"""
+        def blank(match):
+            return match.group(0) if match.lastgroup == 'punct' else ' ' * len(match.group(0))
+        return self.pattern.sub(blank, header)
+
+    @staticmethod
+    def _word_before(text: str, end: int) -> tuple:
+        """Return (word, start) for the identifier ending at `end`, skipping whitespace"""
+        while end > 0 and text[end - 1].isspace():
+            end -= 1
+        start = end
+        while start > 0 and (text[start - 1].isalnum() or text[start - 1] in '_$'):
+            start -= 1
+        return text[start:end], start
+
+    def _classify(self, header: str) -> tuple:
+        """Return (kind, name) for the block opened after `header`"""
+        text = self._mask(header).rstrip()
+        if not text or text.endswith(('=', '(', ',', '[', ':', '?', '=>', '->', 'return')):
+            return 'block', None
+
+        # Drop trailing qualifiers and a Java throws clause to expose a closing parenthesis
+        end = len(text)
+        while True:
+            word, start = self._word_before(text, end)
+            if word not in self.TRAILING_QUALIFIERS:
+                break
+            end = start
+        throws = text.rfind('throws', 0, end)
+        if throws > 0 and text[throws - 1] in ') \t\n' and \
+                all(ch.isalnum() or ch in '_$.<>, \t\n' for ch in text[throws + 6:end]):
+            end = throws
+        close = end
+        while close > 0 and text[close - 1].isspace():
+            close -= 1
+
+        if close > 0 and text[close - 1] == ')':
+            # Walk back from the closing parenthesis to its opener
+            depth = 0
+            index = close - 1
+            while index >= 0:
+                if text[index] == ')':
+                    depth += 1
+                elif text[index] == '(':
+                    depth -= 1
+                    if depth == 0:
+                        break
+                index -= 1
+            if depth == 0:
+                name, name_start = self._word_before(text, index)
+                previous, _ = self._word_before(text, name_start)
+                if name and not name[0].isdigit() and name not in self.NOT_FUNCTION_NAMES and previous != 'new':
+                    return 'function', name
+            return 'block', None
+
+        type_match = self.TYPE_PATTERN.search(text)
+        if type_match:
+            kind = 'namespace' if type_match.group(1) == 'namespace' else 'type'
+            return kind, type_match.group(2)
+        if text.endswith('"C"') and self._word_before(text, len(text) - 3)[0] == 'extern':
+            return 'namespace', None
+        return 'block', None
+
+    def scan(self, content: str) -> List[Dict[str, Any]]:
+        """Return declarations as dicts with kind, name, parent, start/body_start/end offsets and line"""
+        declarations = []
+        # Frames are (kind, declaration or None, name of the innermost enclosing type)
+        stack = []
+        opaque_depth = 0  # Open blocks that are not types/namespaces (function bodies, initializers, ...)
+        stmt_start = 0
+        blank_until = 0  # Everything in [stmt_start, blank_until) is known to be whitespace/comments
+        line = 1
+        line_pos = 0
+        length = len(content)
+
+        for match in self.pattern.finditer(content):
+            kind = match.lastgroup
+            start, end = match.span()
+
+            if kind != 'punct':
+                if blank_until >= 0:
+                    if kind in ('comment', 'directive') and not content[blank_until:start].strip():
+                        # Leading comments and directives are not part of the next declaration
+                        stmt_start = blank_until = end
+                    else:
+                        blank_until = -1
+                continue
+
+            char = content[start]
+            if opaque_depth:
+                # Inside a function body or initializer only the depth matters
+                if char == '{':
+                    opaque_depth += 1
+                    stack.append(self._OPAQUE)
+                elif char == '}':
+                    opaque_depth -= 1
+                    frame = stack.pop()
+                    if frame is not self._OPAQUE:
+                        # Closing the function/initializer that made this region opaque
+                        if frame[1]:
+                            frame[1]['end'] = end
+                        stmt_start = blank_until = end
+                continue
+
+            if char == '{':
+                enclosing_type = stack[-1][2] if stack else None
+                block_kind, name = self._classify(content[stmt_start:start])
+                declaration = None
+                if block_kind == 'block' or block_kind == 'function':
+                    opaque_depth += 1
+                if block_kind != 'block':
+                    header = content[stmt_start:start]
+                    header_start = stmt_start + len(header) - len(header.lstrip())
+                    line += content.count('\n', line_pos, header_start)
+                    line_pos = header_start
+                    declaration = {
+                        'kind': block_kind,
+                        'name': name,
+                        'parent': enclosing_type,
+                        'start': header_start,
+                        'body_start': start,
+                        'end': length,
+                        'line': line
+                    }
+                    declarations.append(declaration)
+                if block_kind == 'type':
+                    enclosing_type = name
+                stack.append((block_kind, declaration, enclosing_type))
+            elif char == '}' and stack:
+                # Only type/namespace frames can be open here
+                block_kind, declaration, _ = stack.pop()
+                if declaration:
+                    declaration['end'] = end
+                    if declaration['kind'] == 'type' and not declaration['name']:
+                        # typedef struct { ... } Name;
+                        trailing = re.match(r'\s*([A-Za-z_]\w*)', content[end:end + 256])
+                        if trailing:
+                            declaration['name'] = trailing.group(1)
+            stmt_start = blank_until = end
+        return declarations
+
+# --- ANALYSIS RECORDS ---
+# Analysis results are compact slotted records holding only derived fields.
+# The file text is never kept: a ContentRef lets the context builder re-read
+# the few files whose chunks it actually packs.
+
+class ContentRef:
+    """Where a file's text can be re-read from, valid while its mtime and size are unchanged"""
+    __slots__ = ('path', 'mtime_ns', 'size')
+
+    def __init__(self, path: str, mtime_ns: int, size: int):
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.size = size
+
+    def __getstate__(self):
+        return (self.path, self.mtime_ns, self.size)
+
+    def __setstate__(self, state):
+        self.path, self.mtime_ns, self.size = state
+
+    def load(self) -> Optional[str]:
+        """The file text, or None if the file is gone or changed since it was analyzed"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                stat = os.fstat(f.fileno())
+                if stat.st_mtime_ns != self.mtime_ns or stat.st_size != self.size:
+                    return None
+                return f.read()
+        except (OSError, UnicodeDecodeError):
+            return None
+
+class ChunkRecord:
+    """One function/class/block of a file: its line range, token count, symbols and body identifiers"""
+    __slots__ = ('kind', 'name', 'symbols', 'start_line', 'end_line', 'tokens', 'terms')
+
+    def __init__(self, kind: str, name: str, symbols: List[str], start_line: int, end_line: int, tokens: int, terms: tuple):
+        self.kind = kind
+        self.name = name
+        self.symbols = symbols
+        self.start_line = start_line
+        self.end_line = end_line
+        self.tokens = tokens
+        self.terms = terms
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    @classmethod
+    def from_chunk(cls, chunk: Dict[str, Any]) -> 'ChunkRecord':
+        # A tuple of interned strings: identifiers repeat across chunks and files, a set per chunk would not pay off
+        terms = tuple(sys.intern(word) for word in {word.lower() for word in IDENTIFIER_PATTERN.findall(chunk['text'])})
+        return cls(chunk['kind'], chunk['name'], chunk['symbols'], chunk['start_line'], chunk['end_line'], chunk['tokens'], terms)
+
+    def text(self, lines: List[str]) -> str:
+        return '\n'.join(lines[self.start_line - 1:self.end_line])
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__ if name != 'terms'}
+
+class AnalysisRecord:
+    """Derived analysis of one file. Reads like the result dicts it replaces
+    (`get`, `[]`, `in`), where an unset field counts as absent; fields only
+    some languages produce (tags, keys, includes, ...) live in `details`."""
+    __slots__ = ('file_path', 'language', 'structure', 'imports', 'functions', 'classes', 'variables',
+                 'complexity', 'main_program', 'token_count', 'lines', 'size', 'error', 'degraded',
+                 'degraded_reason', 'chunks', 'details', 'content_ref')
+    FIELDS = __slots__[:-2]
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any], content_ref: Optional[ContentRef] = None) -> 'AnalysisRecord':
+        """Build a record from an analyzer's result dict"""
+        fields = {name: data[name] for name in cls.FIELDS if name in data}
+        details = {key: value for key, value in data.items() if key not in cls.FIELDS}
+        if fields.get('chunks'):
+            fields['chunks'] = [ChunkRecord.from_chunk(chunk) for chunk in fields['chunks']]
+        return cls(details=details or None, content_ref=content_ref, **fields)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key in self.FIELDS:
+            value = getattr(self, key)
+        else:
+            value = self.details.get(key) if self.details else None
+        return default if value is None else value
+
+    def __getitem__(self, key: str) -> Any:
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def with_path(self, file_path: str) -> 'AnalysisRecord':
+        """A shallow copy reported under another path (e.g. an upload's client-side name)"""
+        record = AnalysisRecord.__new__(AnalysisRecord)
+        record.__setstate__(self.__getstate__())
+        record.file_path = file_path
+        return record
+
+    def load_lines(self) -> Optional[List[str]]:
+        """Re-read the file's lines for chunk text, or None if it is no longer available"""
+        content = self.content_ref.load() if self.content_ref else None
+        return content.split('\n') if content is not None else None
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = dict(self.details or {})
+        for name in self.FIELDS:
+            value = getattr(self, name)
+            if value is not None:
+                data[name] = [chunk.to_dict() for chunk in value] if name == 'chunks' else value
+        return data
+
+class CodeChunker:
+    """Split source files into whole functions, classes/types and top-level blocks.
+
+    Declarations come from the Python AST or from CFamilyScanner; the lines
+    between them become `block` chunks. A chunk larger than `chunkMaxTokens`
+    is split into its members (methods) where it has any, otherwise into
+    line windows. Every chunk carries an estimated token count (see
+    TokenEstimator) and the symbols it defines, so the context builder can
+    rank whole units by relevance; a chunk is counted exactly only when it
+    is packed.
+    """
+
+    BLOCK_SYMBOL_PATTERNS = {
+        'python': re.compile(r'^(?:([A-Za-z_]\w*)\s*(?::[^=\n]*)?=(?!=)|(?:from\s+\S+\s+)?import\s+([\w., ]+))', re.MULTILINE),
+        'c-family': re.compile(r'(?:\b(?:const|let|var|function|#define)\s+|^\s*(?:export\s+)?(?:default\s+)?)([A-Za-z_$][\w$]*)\s*[=(]', re.MULTILINE)
+    }
+
+    def __init__(self, max_chunk_tokens: Optional[int] = None):
+        self.max_chunk_tokens = max_chunk_tokens or DEFAULT_CONFIG.get('chunkMaxTokens', 400)
+
+    def chunk(self, content: str, language: str) -> List[Dict[str, Any]]:
+        self.language = language  # Chunk token counts are estimates for this language
+        lines = content.split('\n')
+        if language == 'python':
+            spans = self._python_spans(content)
+        elif language in ('java', 'c', 'cpp', 'javascript', 'typescript'):
+            spans = self._c_family_spans(content, language)
+        else:
+            spans = []
+        if spans is None:
+            spans = []  # Unparseable: fall back to line windows
+        symbol_pattern = self.BLOCK_SYMBOL_PATTERNS['python' if language == 'python' else 'c-family']
+
+        chunks = []
+        line = 1
+        for span in sorted(spans, key=lambda s: s['start_line']):
+            if span['start_line'] < line:
+                continue  # Overlaps an earlier span (e.g. two declarations on one line)
+            if span['start_line'] > line:
+                self._emit_block(lines, line, span['start_line'] - 1, symbol_pattern, chunks)
+            self._emit_span(lines, span, chunks)
+            line = span['end_line'] + 1
+        if line <= len(lines):
+            self._emit_block(lines, line, len(lines), symbol_pattern, chunks)
+        return chunks
+
+    def _python_spans(self, content: str) -> Optional[List[Dict[str, Any]]]:
+        try:
+            tree = ast.parse(content)
+        except (SyntaxError, ValueError):
+            return None
+
+        def start_of(node):
+            return min([node.lineno] + [d.lineno for d in getattr(node, 'decorator_list', [])])
+
+        spans = []
+        for node in tree.body:
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                spans.append({'kind': 'function', 'name': node.name, 'start_line': start_of(node),
+                              'end_line': node.end_lineno, 'members': []})
+            elif isinstance(node, ast.ClassDef):
+                members = [
+                    {'kind': 'method', 'name': f"{node.name}.{item.name}", 'start_line': start_of(item), 'end_line': item.end_lineno}
+                    for item in node.body if isinstance(item, (ast.FunctionDef, ast.AsyncFunctionDef))
+                ]
+                spans.append({'kind': 'class', 'name': node.name, 'start_line': start_of(node),
+                              'end_line': node.end_lineno, 'members': members})
+            elif isinstance(node, ast.If) and isinstance(node.test, ast.Compare) and \
+                    isinstance(node.test.left, ast.Name) and node.test.left.id == '__name__':
+                spans.append({'kind': 'main', 'name': '__main__', 'start_line': node.lineno,
+                              'end_line': node.end_lineno, 'members': []})
+        return spans
+
+    def _c_family_spans(self, content: str, language: str) -> List[Dict[str, Any]]:
+        line_starts = [0] + [match.end() for match in re.finditer('\n', content)]
+
+        def line_of(offset):
+            return bisect.bisect_right(line_starts, offset)
+
+        spans = []
+        by_name = {}
+        for declaration in CFamilyScanner(language).scan(content):
+            if declaration['kind'] == 'namespace':
+                continue
+            span = {
+                'kind': 'main' if declaration['name'] == 'main' else declaration['kind'],
+                'name': declaration['name'] or '',
+                'start_line': line_of(declaration['start']),
+                'end_line': line_of(max(declaration['end'] - 1, declaration['start'])),
+                'members': []
+            }
+            parent = declaration['parent']
+            if parent and parent in by_name:
+                span['name'] = f"{parent}.{span['name']}"
+                span['kind'] = 'method' if span['kind'] in ('function', 'main') else span['kind']
+                by_name[parent]['members'].append(span)
+            elif not parent:
+                spans.append(span)
+                if declaration['kind'] == 'type' and declaration['name']:
+                    by_name[declaration['name']] = span
+        return spans
+
+    def _make_chunk(self, lines: List[str], start: int, end: int, kind: str, name: str, symbols: List[str]) -> Dict[str, Any]:
+        text = '\n'.join(lines[start - 1:end])
+        return {
+            'kind': kind,
+            'name': name,
+            'symbols': symbols,
+            'start_line': start,
+            'end_line': end,
+            'text': text,
+            'tokens': token_estimator.estimate(text, self.language)
+        }
+
+    def _emit_span(self, lines: List[str], span: Dict[str, Any], chunks: List[Dict[str, Any]]):
+        symbols = [span['name']] + [member['name'] for member in span['members']] if span['name'] else []
+        chunk = self._make_chunk(lines, span['start_line'], span['end_line'], span['kind'], span['name'], symbols)
+        if chunk['tokens'] <= self.max_chunk_tokens:
+            chunks.append(chunk)
+        elif span['members']:
+            # Too big as a whole: the header/fields and each member become their own chunks
+            line = span['start_line']
+            for member in sorted(span['members'], key=lambda m: m['start_line']):
+                if member['start_line'] < line:
+                    continue
+                if member['start_line'] > line:
+                    chunks.extend(self._windows(lines, line, member['start_line'] - 1, span['kind'], span['name'], [span['name']]))
+                self._emit_span(lines, dict(member, members=[]), chunks)
+                line = member['end_line'] + 1
+            if line <= span['end_line']:
+                chunks.extend(self._windows(lines, line, span['end_line'], span['kind'], span['name'], [span['name']]))
+        else:
+            chunks.extend(self._windows(lines, span['start_line'], span['end_line'], span['kind'], span['name'], symbols))
+
+    def _emit_block(self, lines: List[str], start: int, end: int, pattern: re.Pattern, chunks: List[Dict[str, Any]]):
+        # Skip leading/trailing blank lines so blocks never consist of whitespace alone
+        while start <= end and not lines[start - 1].strip():
+            start += 1
+        while end >= start and not lines[end - 1].strip():
+            end -= 1
+        if start > end:
+            return
+        for chunk in self._windows(lines, start, end, 'block', '', None):
+            names = []
+            for match in pattern.finditer(chunk['text']):
+                for group in match.groups():
+                    if group:
+                        names.extend(name.split()[0] for name in group.split(',') if name.strip())
+            chunk['symbols'] = list(dict.fromkeys(names))
+            chunks.append(chunk)
+
+    def _windows(self, lines: List[str], start: int, end: int, kind: str, name: str,
+                 symbols: Optional[List[str]]) -> List[Dict[str, Any]]:
+        """Split a line range into chunks of at most max_chunk_tokens (a single long line may exceed it)"""
+        windows = []
+        window_start = start
+        window_tokens = 0
+        line_estimates = token_estimator.estimate_many(lines[start - 1:end], self.language)
+        for line in range(start, end + 1):
+            line_tokens = line_estimates[line - start] + 1
+            if window_tokens and window_tokens + line_tokens > self.max_chunk_tokens:
+                windows.append((window_start, line - 1))
+                window_start = line
+                window_tokens = 0
+            window_tokens += line_tokens
+        windows.append((window_start, end))
+        return [self._make_chunk(lines, a, b, kind, name, list(symbols or [])) for a, b in windows]
 
 class ASTContextAnalyzer:
     """Analyzes code using AST to extract relevant context with maximum accuracy"""
@@ -252,42 +1335,87 @@ class ASTContextAnalyzer:
             'Try', 'With', 'AsyncFunctionDef', 'AsyncFor', 'AsyncWith',
             'Call', 'Attribute', 'Name', 'Constant', 'List', 'Dict', 'Tuple'
         }
+        # Optional work, switched off when the request deadline is tight
+        self.extract_main_program = True
+        self.chunker = CodeChunker()
     
-    def analyze_file(self, file_path: str, language: str) -> Dict[str, Any]:
+    def analyze_file(self, file_path: str, language: str) -> AnalysisRecord:
         """Analyze a file and extract relevant context based on language with maximum accuracy"""
         try:
             with open(file_path, 'r', encoding='utf-8') as f:
+                stat = os.fstat(f.fileno())
                 content = f.read()
-            
-            if language == 'python':
-                return self._analyze_python_file(content, file_path)
-            elif language in ['javascript', 'typescript']:
-                return self._analyze_js_file(content, file_path)
-            elif language in ['html', 'css']:
-                return self._analyze_markup_file(content, file_path)
-            elif language == 'json':
-                return self._analyze_json_file(content, file_path)
-            elif language == 'yaml' or file_path.endswith(('.yml', '.yaml')):
-                return self._analyze_yaml_file(content, file_path)
-            elif language == 'xml':
-                return self._analyze_xml_file(content, file_path)
-            elif language == 'java':
-                return self._analyze_java_file(content, file_path)
-            elif language == 'c':
-                return self._analyze_c_file(content, file_path)
-            else:
-                return self._analyze_generic_file(content, file_path)
+            result = self._analyze_by_language(content, file_path, language)
+            if 'error' not in result:
+                result['chunks'] = self.chunker.chunk(content, result.get('language', language))
+            # Only derived fields survive; chunk text is re-read through the reference when packed
+            return AnalysisRecord.from_dict(result, ContentRef(file_path, stat.st_mtime_ns, stat.st_size))
         except Exception as e:
-            return {
-                'file_path': file_path,
-                'language': language,
-                'error': str(e),
-                'content': content[:500] if 'content' in locals() else '',
-                'token_count': count_tokens(content[:500]) if 'content' in locals() else 0
-            }
-    
-    def analyze_folder_structure(self, folder_path: str) -> Dict[str, Any]:
-        """Analyze folder structure and extract relevant information"""
+            return AnalysisRecord(
+                file_path=file_path,
+                language=language,
+                error=str(e),
+                token_count=token_estimator.estimate(content[:500], language) if 'content' in locals() else 0
+            )
+
+    def _analyze_by_language(self, content: str, file_path: str, language: str) -> Dict[str, Any]:
+        if language == 'python':
+            return self._analyze_python_file(content, file_path)
+        elif language in ['javascript', 'typescript']:
+            return self._analyze_js_file(content, file_path)
+        elif language in ['html', 'css']:
+            return self._analyze_markup_file(content, file_path)
+        elif language == 'json':
+            return self._analyze_json_file(content, file_path)
+        elif language == 'yaml' or file_path.endswith(('.yml', '.yaml')):
+            return self._analyze_yaml_file(content, file_path)
+        elif language == 'xml':
+            return self._analyze_xml_file(content, file_path)
+        elif language == 'java':
+            return self._analyze_java_file(content, file_path)
+        elif language == 'c':
+            return self._analyze_c_file(content, file_path)
+        else:
+            return self._analyze_generic_file(content, file_path)
+
+    def outline_file(self, file_path: str, language: str, reason: str) -> AnalysisRecord:
+        """Cheap fallback when full analysis is over budget: size, line count and the first lines"""
+        outline_lines = DEFAULT_CONFIG.get('degradedOutlineLines', 40)
+        try:
+            size = os.path.getsize(file_path)
+            head = []
+            line_count = 0
+            with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
+                for line in f:
+                    if line_count < outline_lines:
+                        head.append(line)
+                    line_count += 1
+            main_program = ''.join(head)
+        except Exception as e:
+            return AnalysisRecord(
+                file_path=file_path,
+                language=language,
+                error=str(e),
+                degraded=True,
+                degraded_reason=reason
+            )
+        return AnalysisRecord(
+            file_path=file_path,
+            language=language,
+            structure=f"Outline only ({reason}): {size} bytes, {line_count} lines",
+            main_program=main_program,
+            token_count=token_estimator.estimate_chars(size, language),
+            lines=line_count,
+            size=size,
+            degraded=True,
+            degraded_reason=reason
+        )
+
+    def analyze_folder_structure(self, folder_path: str, ignore_dirs: Optional[set] = None) -> Dict[str, Any]:
+        """Analyze folder structure and extract relevant information
+
+        Directories named in `ignore_dirs`, and hidden ones, are not descended into.
+        """
         try:
             structure = {
                 'folder_path': folder_path,
@@ -300,6 +1428,8 @@ class ASTContextAnalyzer:
             }
             
             for root, dirs, files in os.walk(folder_path):
+                if ignore_dirs is not None:
+                    dirs[:] = [d for d in dirs if not d.startswith('.') and d not in ignore_dirs]
                 rel_root = os.path.relpath(root, folder_path)
                 if rel_root == '.':
                     rel_root = ''
@@ -376,10 +1506,10 @@ class ASTContextAnalyzer:
             analyzer.visit(tree)
             
             # Extract main program
-            main_program = analyzer.extract_main_program(content)
+            main_program = analyzer.extract_main_program(content) if self.extract_main_program else ''
             
-            # Calculate token count
-            token_count = count_tokens(content)
+            # Estimated: the file's own count is only displayed, never budgeted against
+            token_count = token_estimator.estimate(content, 'python')
             
             return {
                 'file_path': file_path,
@@ -390,7 +1520,6 @@ class ASTContextAnalyzer:
                 'variables': analyzer.variables,
                 'structure': analyzer.get_structure_summary(),
                 'main_program': main_program,
-                'content': content,
                 'token_count': token_count,
                 'lines': len(content.split('\n')),
                 'complexity': analyzer.get_complexity_metrics()
@@ -400,14 +1529,14 @@ class ASTContextAnalyzer:
                 'file_path': file_path,
                 'language': 'python',
                 'error': f'Syntax error: {str(e)}',
-                'content': content[:500],
-                'token_count': count_tokens(content[:500])
+                'token_count': token_estimator.estimate(content[:500], 'python')
             }
     
     def _analyze_js_file(self, content: str, file_path: str) -> Dict[str, Any]:
         """Analyze JavaScript/TypeScript file with enhanced accuracy"""
         # Enhanced regex-based analysis for JS/TS
-        imports = re.findall(r'import\s+.*?from\s+[\'"]([^\'"]+)[\'"]', content)
+        # ES imports (also multi-line and side-effect only) and CommonJS require()
+        imports = re.findall(r'(?:\bimport\s+(?:[^;\'"]*?\s+from\s+)?|\brequire\s*\(\s*)[\'"]([^\'"]+)[\'"]', content)
         functions = re.findall(r'(?:function\s+(\w+)|const\s+(\w+)\s*=\s*\(|let\s+(\w+)\s*=\s*\(|var\s+(\w+)\s*=\s*\()', content)
         classes = re.findall(r'class\s+(\w+)', content)
         variables = re.findall(r'(?:const|let|var)\s+(\w+)', content)
@@ -417,9 +1546,9 @@ class ASTContextAnalyzer:
         async_functions = re.findall(r'async\s+(?:function\s+)?(\w+)', content)
         
         # Extract main program (entry point)
-        main_program = self._extract_js_main_program(content)
+        main_program = self._extract_js_main_program(content) if self.extract_main_program else ''
         
-        token_count = count_tokens(content)
+        token_count = token_estimator.estimate(content, 'javascript')
         
         return {
             'file_path': file_path,
@@ -431,7 +1560,6 @@ class ASTContextAnalyzer:
             'classes': classes,
             'variables': variables,
             'main_program': main_program,
-            'content': content,
             'token_count': token_count,
             'lines': len(content.split('\n'))
         }
@@ -441,13 +1569,12 @@ class ASTContextAnalyzer:
         if file_path.endswith('.html'):
             tags = re.findall(r'<(\w+)', content)
             # Extract main program (body content and scripts)
-            main_program = self._extract_html_main_program(content)
+            main_program = self._extract_html_main_program(content) if self.extract_main_program else ''
             return {
                 'file_path': file_path,
                 'language': 'html',
                 'tags': list(set(tags)),
                 'main_program': main_program,
-                'content': content
             }
         else:
             selectors = re.findall(r'([.#]?\w+)\s*{', content)
@@ -455,7 +1582,6 @@ class ASTContextAnalyzer:
                 'file_path': file_path,
                 'language': 'css',
                 'selectors': list(set(selectors)),
-                'content': content
             }
     
     def _analyze_generic_file(self, content: str, file_path: str) -> Dict[str, Any]:
@@ -467,7 +1593,6 @@ class ASTContextAnalyzer:
             'file_path': file_path,
             'language': 'unknown',
             'main_program': main_program,
-            'content': content[:1000]  # Limit content for unknown files
         }
     
     def optimize_context(self, context: str, max_length: int = 4000) -> str:
@@ -514,7 +1639,7 @@ class ASTContextAnalyzer:
         """Analyze JSON file"""
         try:
             data = json.loads(content)
-            token_count = count_tokens(content)
+            token_count = token_estimator.estimate(content, 'json')
             
             # Extract main program (the JSON content itself)
             main_program = content[:1000] if len(content) > 1000 else content
@@ -525,7 +1650,6 @@ class ASTContextAnalyzer:
                 'keys': list(data.keys()) if isinstance(data, dict) else [],
                 'type': type(data).__name__,
                 'main_program': main_program,
-                'content': content,
                 'token_count': token_count,
                 'lines': len(content.split('\n'))
             }
@@ -534,8 +1658,7 @@ class ASTContextAnalyzer:
                 'file_path': file_path,
                 'language': 'json',
                 'error': f'JSON decode error: {str(e)}',
-                'content': content[:500],
-                'token_count': count_tokens(content[:500])
+                'token_count': token_estimator.estimate(content[:500], 'json')
             }
     
     def _analyze_yaml_file(self, content: str, file_path: str) -> Dict[str, Any]:
@@ -543,7 +1666,7 @@ class ASTContextAnalyzer:
         try:
             import yaml
             data = yaml.safe_load(content)
-            token_count = count_tokens(content)
+            token_count = token_estimator.estimate(content, 'yaml')
             
             # Extract main program (the YAML content itself)
             main_program = content[:1000] if len(content) > 1000 else content
@@ -554,7 +1677,6 @@ class ASTContextAnalyzer:
                 'keys': list(data.keys()) if isinstance(data, dict) else [],
                 'type': type(data).__name__,
                 'main_program': main_program,
-                'content': content,
                 'token_count': token_count,
                 'lines': len(content.split('\n'))
             }
@@ -563,8 +1685,7 @@ class ASTContextAnalyzer:
                 'file_path': file_path,
                 'language': 'yaml',
                 'error': f'YAML parse error: {str(e)}',
-                'content': content[:500],
-                'token_count': count_tokens(content[:500])
+                'token_count': token_estimator.estimate(content[:500], 'yaml')
             }
     
     def _extract_js_main_program(self, content: str) -> str:
@@ -637,18 +1758,23 @@ class ASTContextAnalyzer:
         except Exception as e:
             return f"<!-- Error extracting main program: {str(e)} -->"
     
-    def _extract_java_main_program(self, content: str) -> str:
+    def _extract_java_main_program(self, content: str, declarations: Optional[List[Dict[str, Any]]] = None) -> str:
         """Extract the main program (entry point) from Java code"""
         try:
+            if declarations is None:
+                declarations = CFamilyScanner('java').scan(content)
+            methods = [d for d in declarations if d['kind'] == 'function']
+
             # Look for main method
-            main_match = re.search(r'public\s+static\s+void\s+main\s*\([^)]*\)\s*\{[^}]*\}', content, re.DOTALL)
-            if main_match:
-                return main_match.group(0)
-            
+            for method in methods:
+                if method['name'] == 'main' and re.search(r'\bstatic\b', content[method['start']:method['body_start']]):
+                    return content[method['start']:method['end']]
+
             # Look for any public static methods that might be entry points
-            static_methods = re.findall(r'public\s+static\s+\w+\s+\w+\s*\([^)]*\)\s*\{[^}]*\}', content, re.DOTALL)
-            if static_methods:
-                return static_methods[0]
+            for method in methods:
+                header = content[method['start']:method['body_start']]
+                if re.search(r'\bpublic\b', header) and re.search(r'\bstatic\b', header):
+                    return content[method['start']:method['end']]
             
             # If no main method found, return first few non-empty lines
             lines = content.split('\n')
@@ -657,18 +1783,21 @@ class ASTContextAnalyzer:
         except Exception as e:
             return f"// Error extracting main program: {str(e)}"
     
-    def _extract_c_main_program(self, content: str) -> str:
+    def _extract_c_main_program(self, content: str, declarations: Optional[List[Dict[str, Any]]] = None) -> str:
         """Extract the main program (entry point) from C code"""
         try:
+            if declarations is None:
+                declarations = CFamilyScanner('c').scan(content)
+            functions = [d for d in declarations if d['kind'] == 'function']
+
             # Look for main function
-            main_match = re.search(r'int\s+main\s*\([^)]*\)\s*\{[^}]*\}', content, re.DOTALL)
-            if main_match:
-                return main_match.group(0)
+            for function in functions:
+                if function['name'] == 'main':
+                    return content[function['start']:function['end']]
             
             # Look for any function that might be an entry point
-            functions = re.findall(r'\w+\s+\w+\s*\([^)]*\)\s*\{[^}]*\}', content, re.DOTALL)
             if functions:
-                return functions[0]
+                return content[functions[0]['start']:functions[0]['end']]
             
             # If no main function found, return first few non-empty lines
             lines = content.split('\n')
@@ -682,7 +1811,7 @@ class ASTContextAnalyzer:
         try:
             import xml.etree.ElementTree as ET
             root = ET.fromstring(content)
-            token_count = count_tokens(content)
+            token_count = token_estimator.estimate(content, 'xml')
             
             # Extract tags
             tags = set()
@@ -698,7 +1827,6 @@ class ASTContextAnalyzer:
                 'root_tag': root.tag,
                 'tags': list(tags),
                 'main_program': main_program,
-                'content': content,
                 'token_count': token_count,
                 'lines': len(content.split('\n'))
             }
@@ -707,68 +1835,57 @@ class ASTContextAnalyzer:
                 'file_path': file_path,
                 'language': 'xml',
                 'error': f'XML parse error: {str(e)}',
-                'content': content[:500],
-                'token_count': count_tokens(content[:500])
+                'token_count': token_estimator.estimate(content[:500], 'xml')
             }
     
     def _analyze_java_file(self, content: str, file_path: str) -> Dict[str, Any]:
         """Analyze Java file with enhanced accuracy"""
-        # Enhanced regex-based analysis for Java
+        # Declarations come from the brace-matching scanner; imports and fields from regexes
+        declarations = CFamilyScanner('java').scan(content)
         imports = re.findall(r'import\s+([^;]+);', content)
-        classes = re.findall(r'(?:public\s+)?class\s+(\w+)', content)
-        methods = re.findall(r'(?:public|private|protected)?\s*(?:static\s+)?(?:final\s+)?(?:<[^>]+>\s+)?(\w+)\s+(\w+)\s*\([^)]*\)\s*\{', content)
+        classes = [d['name'] for d in declarations if d['kind'] == 'type' and d['name']]
+        methods = [d['name'] for d in declarations if d['kind'] == 'function']
         variables = re.findall(r'(?:public|private|protected)?\s*(?:static\s+)?(?:final\s+)?(\w+)\s+(\w+)\s*[=;]', content)
         
-        # Extract main method
-        main_method = re.search(r'public\s+static\s+void\s+main\s*\([^)]*\)\s*\{[^}]*\}', content, re.DOTALL)
-        main_program = main_method.group(0) if main_method else ""
-        
         # Extract main program (entry point)
-        if not main_program:
-            main_program = self._extract_java_main_program(content)
+        main_program = self._extract_java_main_program(content, declarations) if self.extract_main_program else ''
         
-        token_count = count_tokens(content)
+        token_count = token_estimator.estimate(content, 'java')
         
         return {
             'file_path': file_path,
             'language': 'java',
             'imports': imports,
             'classes': classes,
-            'methods': [f"{method[1]}()" for method in methods if method[1] != 'main'],
+            'methods': [f"{method}()" for method in methods if method != 'main'],
             'variables': [f"{var[1]}" for var in variables],
             'main_program': main_program,
-            'content': content,
             'token_count': token_count,
             'lines': len(content.split('\n'))
         }
     
     def _analyze_c_file(self, content: str, file_path: str) -> Dict[str, Any]:
         """Analyze C file with enhanced accuracy"""
-        # Enhanced regex-based analysis for C
+        # Declarations come from the brace-matching scanner; includes, variables and defines from regexes
+        declarations = CFamilyScanner('c').scan(content)
         includes = re.findall(r'#include\s*[<"]([^>"]+)[>"]', content)
-        functions = re.findall(r'(\w+)\s+(\w+)\s*\([^)]*\)\s*\{', content)
+        functions = [d['name'] for d in declarations if d['kind'] == 'function']
         variables = re.findall(r'(?:int|char|float|double|long|short|unsigned)\s+(\w+)\s*[=;]', content)
         defines = re.findall(r'#define\s+(\w+)', content)
         
-        # Extract main function
-        main_function = re.search(r'int\s+main\s*\([^)]*\)\s*\{[^}]*\}', content, re.DOTALL)
-        main_program = main_function.group(0) if main_function else ""
-        
         # Extract main program (entry point)
-        if not main_program:
-            main_program = self._extract_c_main_program(content)
+        main_program = self._extract_c_main_program(content, declarations) if self.extract_main_program else ''
         
-        token_count = count_tokens(content)
+        token_count = token_estimator.estimate(content, 'c')
         
         return {
             'file_path': file_path,
             'language': 'c',
             'includes': includes,
-            'functions': [f"{func[1]}()" for func in functions if func[1] != 'main'],
+            'functions': [f"{func}()" for func in functions if func != 'main'],
             'variables': variables,
             'defines': defines,
             'main_program': main_program,
-            'content': content,
             'token_count': token_count,
             'lines': len(content.split('\n'))
         }
@@ -911,127 +2028,1224 @@ class PythonASTAnalyzer(ast.NodeVisitor):
         """Get detailed complexity metrics"""
         return self.complexity_metrics.copy()
 
-class ModelAPIClient:
-    def __init__(self, config):
-        self.config = config
-        self.context_analyzer = ASTContextAnalyzer()
-    
-    def generate_full_response(self, prompt: str, context: str = "") -> str:
-        try:
-            # Calculate token counts
-            prompt_tokens = count_tokens(prompt)
-            context_tokens = count_tokens(context) if context else 0
-            # --- Use dynamic system prompt selection ---
-            system_prompt_key = select_system_prompt(prompt, context)
-            system_prompt = SYSTEM_PROMPTS[system_prompt_key]
-            system_prompt_tokens = count_tokens(system_prompt)
-            total_input_tokens = prompt_tokens + context_tokens + system_prompt_tokens
-            # Check if we exceed input token limit
-            if total_input_tokens > self.config['maxInputTokens']:
-                # Optimize context to fit within token limit
-                available_tokens = self.config['maxInputTokens'] - prompt_tokens - system_prompt_tokens
-                if available_tokens > 0:
-                    context = self._optimize_context_by_tokens(context, available_tokens)
-                else:
-                    # If even without context we're over limit, truncate prompt
-                    context = ""
-                    prompt = self._truncate_text_by_tokens(prompt, self.config['maxInputTokens'] - system_prompt_tokens)
-            # --- Use selected system prompt ---
-            print(prompt)
-            print(system_prompt)
-            messages = [
-                {'role': 'system', 'content': system_prompt}
-            ]
-            if context:
-                messages.append({
-                    'role': 'user', 
-                    'content': f"Context:\n{context}\n\nUser Request: {prompt}"
-                })
-            else:
-                messages.append({'role': 'user', 'content': prompt})
-            print(context)
-            response = requests.post(
-                self.config['modelApiUrl'],
-                json={
-                    'model': self.config.get('model', 'llama3-8b-8192'),
-                    'messages': messages,
-                    'max_tokens': self.config.get('maxTokens', 4096),
-                    'temperature': 0.7,
-                    'top_p': 0.9
-                },
-                headers={
-                    'Authorization': self.config['apiKey'],
-                    'Content-Type': 'application/json'
-                },
-                timeout=self.config['timeout']
-            )
-            if response.status_code == 200:
-                data = response.json()
-                if data and 'choices' in data and len(data['choices']) > 0:
-                    return data['choices'][0]['message']['content']
-                else:
-                    raise Exception('No response from model API')
-            else:
-                raise Exception(f'API request failed with status {response.status_code}: {response.text}')
-        except Exception as error:
-            print(f'Error calling model API: {error}')
-            return f'Error: Unable to get a response from the model. {str(error)}'
-    
-    def _get_system_prompt(self) -> str:
-        """Get the enhanced system prompt"""
-        return """You are an expert AI coding assistant that analyzes, thinks, and executes based on user prompts.
+# --- REQUEST DEADLINES ---
+# A client may send its own timeout (X-Request-Timeout-Ms header or a
+# `timeout_ms` body field). The remaining budget is split across analysis,
+# context building and the upstream call, so the backend never starts work
+# the client has already stopped waiting for.
+request_deadline_var: contextvars.ContextVar = contextvars.ContextVar('request_deadline', default=None)
 
-ANALYSIS & EXECUTION GUIDELINES:
-1. **Analyze**: Understand the user's intent and requirements
-2. **Think**: Plan the solution with necessary packages, dependencies, and steps
-3. **Execute**: Provide complete, runnable solutions with installation commands
+class DeadlineExceeded(Exception):
+    """Raised when the request deadline leaves no time for a stage"""
 
-RESPONSE FORMAT:
-Always structure your response with these sections:
+def parse_request_timeout(headers, body) -> Optional[float]:
+    """Return the client's timeout in seconds from the request header or body, if any"""
+    raw = headers.get('X-Request-Timeout-Ms')
+    if raw is None and isinstance(body, dict):
+        raw = body.get('timeout_ms')
+    if raw is None:
+        default_timeout = DEFAULT_CONFIG.get('defaultRequestTimeout')
+        return float(default_timeout) if default_timeout else None
+    try:
+        timeout_ms = float(raw)
+    except (TypeError, ValueError):
+        return None
+    return timeout_ms / 1000.0 if timeout_ms > 0 else None
 
-## 📋 Analysis
-Brief analysis of the user's request
+def deadline_remaining() -> Optional[float]:
+    """Seconds left before the current request's deadline, or None when it has none"""
+    deadline = request_deadline_var.get()
+    return None if deadline is None else deadline - time.monotonic()
 
-## 🛠️ Required Packages
-List of necessary packages with installation commands:
-```bash
-pip install package1 package2
-npm install package1 package2
-# etc.
-```
+def stage_deadline(share: float, cap: Optional[float] = None) -> float:
+    """Absolute time.monotonic() deadline for a stage allowed `share` of the remaining budget, capped at `cap` seconds"""
+    remaining = deadline_remaining()
+    budget = float('inf') if remaining is None else max(0.0, remaining * share)
+    if cap is not None:
+        budget = min(budget, cap)
+    return time.monotonic() + budget
 
-## 💻 Solution
-Complete code with proper syntax highlighting:
-```language
-// Your complete code here
-```
+def deadline_is_tight() -> bool:
+    """True when too little time remains for optional work such as folder walks"""
+    remaining = deadline_remaining()
+    return remaining is not None and remaining < DEFAULT_CONFIG.get('deadlineTightSeconds', 5.0)
 
-## 🚀 Run Commands
-Commands to execute the solution:
-```bash
-python script.py
-node app.js
-# etc.
-```
+def model_call_budget() -> Optional[float]:
+    """Seconds the upstream call may take, keeping `deadlineReserveSeconds` to send the response"""
+    remaining = deadline_remaining()
+    if remaining is None:
+        return None
+    return remaining - DEFAULT_CONFIG.get('deadlineReserveSeconds', 0.25)
 
-## 📝 Usage Instructions
-Brief instructions on how to use the solution
+# --- PRIORITY SCHEDULING ---
+# Requests carry a priority (X-Request-Priority header or `priority` body
+# field): interactive, normal or bulk. Batches default to bulk, as does
+# background workspace indexing. Admission slots, analysis workers and
+# upstream rate-limit capacity hand out their queue in weighted-fair order,
+# and bulk work never holds more than `bulkMaxShare` of slots or workers.
+PRIORITIES = ('interactive', 'normal', 'bulk')
+request_priority_var: contextvars.ContextVar = contextvars.ContextVar('request_priority', default='normal')
 
-EXAMPLES:
-- For web apps: Include HTML, CSS, JS with run commands
-- For Python scripts: Include imports, main code, and execution commands
-- For Node.js: Include package.json, dependencies, and run commands
-- For data analysis: Include pandas, matplotlib, and visualization commands
+def parse_request_priority(headers, body, default: str = 'normal') -> str:
+    """Return the request's priority from the header or body, or `default` when missing or unknown"""
+    raw = headers.get('X-Request-Priority')
+    if raw is None and isinstance(body, dict):
+        raw = body.get('priority')
+    raw = str(raw).strip().lower() if raw is not None else ''
+    return raw if raw in PRIORITIES else default
 
-Always provide complete, copy-paste ready solutions with all necessary setup steps."""
-    
-    def _optimize_context_by_tokens(self, context: str, max_tokens: int) -> str:
-        """Optimize context to fit within token limit"""
-        if count_tokens(context) <= max_tokens:
-            return context
-        
-        # Split into sections and prioritize
-        sections = context.split('\n\n')
+def bulk_limit(slots: int) -> int:
+    """How many of `slots` bulk work may hold at once (always at least one)"""
+    return max(1, int(slots * DEFAULT_CONFIG.get('bulkMaxShare', 0.75)))
+
+class FairQueue:
+    """Waiters of several priority classes, served in weighted-fair (stride) order.
+
+    Each class has a virtual pass that advances by 1/weight whenever one of
+    its waiters is served; the non-empty class with the lowest pass goes
+    next, so under contention classes get service in proportion to their
+    weights. A class that was idle resumes at the current virtual time
+    instead of cashing in credit it built up while empty. Not thread-safe:
+    owners call it under their own lock.
+    """
+
+    def __init__(self, weights: Dict[str, float]):
+        self.weights = {priority: float(weights.get(priority, 1)) for priority in PRIORITIES}
+        self._queues = {priority: collections.deque() for priority in PRIORITIES}
+        self._pass = {priority: 0.0 for priority in PRIORITIES}
+        self._priority_of: Dict[Any, str] = {}
+        self._vtime = 0.0
+
+    def __len__(self) -> int:
+        return len(self._priority_of)
+
+    def depth(self, priority: str) -> int:
+        return len(self._queues[priority])
+
+    def push(self, ticket, priority: str):
+        queue_ = self._queues[priority]
+        if not queue_:
+            self._pass[priority] = max(self._pass[priority], self._vtime)
+        queue_.append(ticket)
+        self._priority_of[ticket] = priority
+
+    def head(self, eligible=None):
+        """The waiter to serve next, skipping classes for which `eligible(priority)` is False"""
+        best = None
+        for priority in PRIORITIES:
+            if self._queues[priority] and (eligible is None or eligible(priority)):
+                if best is None or self._pass[priority] < self._pass[best]:
+                    best = priority
+        return self._queues[best][0] if best else None
+
+    def served(self, ticket):
+        priority = self._priority_of.pop(ticket)
+        self._queues[priority].remove(ticket)
+        self._vtime = self._pass[priority]
+        self._pass[priority] += 1.0 / self.weights[priority]
+
+    def remove(self, ticket):
+        """Drop a waiter that gave up (timed out) without advancing its class"""
+        priority = self._priority_of.pop(ticket, None)
+        if priority is not None:
+            self._queues[priority].remove(ticket)
+
+# --- ANALYSIS BUDGETS ---
+# Analyzers run in worker processes so a pathological file (a regex blowing up,
+# a huge minified bundle) can be killed at its deadline instead of pinning a
+# request thread. Over-budget files fall back to ASTContextAnalyzer.outline_file.
+
+def _analysis_worker_main(conn):
+    """Worker process loop: analyze (file_path, language, extract_main_program, token ratios) jobs until the pipe closes"""
+    analyzer = ASTContextAnalyzer()
+    conn.send('ready')
+    while True:
+        try:
+            file_path, language, analyzer.extract_main_program, ratios = conn.recv()
+        except (EOFError, OSError, KeyboardInterrupt):
+            break
+        token_estimator.load_ratios(ratios)
+        conn.send(analyzer.analyze_file(file_path, language))
+
+class AnalysisStats:
+    """Counters for file analysis outcomes and worker restarts"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.analyzed = 0
+        self.degraded = collections.Counter()
+        self.skipped = collections.Counter()  # Inputs never analyzed because the context was already full
+        self.skipped_bytes = 0
+        self.duplicates = 0  # Files listed by name as near-duplicates of another input
+        self.duplicate_bytes = 0
+        self.duplicate_tokens = 0
+        self.worker_restarts = 0
+        self.in_process = 0  # Files analyzed on the request thread because no worker process could run
+        self.analysis_seconds = 0.0
+        self.max_analysis_seconds = 0.0
+        self.queued = 0
+        self.queue_seconds = 0.0
+        self.max_queue_seconds = 0.0
+
+    def record_analyzed(self, seconds: float, in_process: bool = False):
+        with self._lock:
+            self.analyzed += 1
+            self.in_process += in_process
+            self.analysis_seconds += seconds
+            self.max_analysis_seconds = max(self.max_analysis_seconds, seconds)
+
+    def record_queue_wait(self, seconds: float):
+        with self._lock:
+            self.queued += 1
+            self.queue_seconds += seconds
+            self.max_queue_seconds = max(self.max_queue_seconds, seconds)
+
+    def record_degraded(self, reason: str):
+        with self._lock:
+            self.degraded[reason] += 1
+
+    def record_skipped(self, reason: str, count: int, size: int):
+        with self._lock:
+            self.skipped[reason] += count
+            self.skipped_bytes += size
+
+    def record_duplicate(self, size: int, tokens: int):
+        with self._lock:
+            self.duplicates += 1
+            self.duplicate_bytes += size
+            self.duplicate_tokens += tokens
+
+    def record_restart(self):
+        with self._lock:
+            self.worker_restarts += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'analyzed': self.analyzed,
+                'degraded': sum(self.degraded.values()),
+                'degraded_by_reason': dict(self.degraded),
+                'skipped': sum(self.skipped.values()),
+                'skipped_by_reason': dict(self.skipped),
+                'skipped_bytes': self.skipped_bytes,
+                'near_duplicates': self.duplicates,
+                'duplicate_bytes_saved': self.duplicate_bytes,
+                'duplicate_tokens_saved': self.duplicate_tokens,
+                'worker_restarts': self.worker_restarts,
+                'analyzed_in_process': self.in_process,
+                'avg_analysis_ms': (self.analysis_seconds / self.analyzed * 1000) if self.analyzed else 0.0,
+                'max_analysis_ms': self.max_analysis_seconds * 1000,
+                'avg_queue_wait_ms': (self.queue_seconds / self.queued * 1000) if self.queued else 0.0,
+                'max_queue_wait_ms': self.max_queue_seconds * 1000
+            }
+
+class AnalysisQueueTimeout(Exception):
+    """Raised when no analysis worker became free before the request deadline"""
+
+class AnalysisWorkerPool:
+    """A fixed set of analyzer processes; a worker that overruns its deadline is killed and replaced.
+
+    A replacement that fails to start is retried with backoff. While no
+    worker is alive the pool reports itself unavailable, so callers analyze
+    in-process instead of queueing until their deadline.
+    """
+
+    def __init__(self, size: int, stats: AnalysisStats):
+        self.size = max(1, size)
+        self.stats = stats
+        self._idle: List[Any] = []
+        self._idle_cond = threading.Condition()
+        self._waiters = FairQueue(DEFAULT_CONFIG.get('priorityWeights', {}))
+        self._bulk_busy = 0
+        self._lock = threading.Lock()
+        self._workers: List[Any] = []
+        self._started = False
+        self._closed = threading.Event()
+        self.available = True
+
+    def _spawn(self):
+        # Never plain fork: a child forked while another thread holds a lock
+        # (logging, DNS resolution, tokenizer loading) can hang forever
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        context = multiprocessing.get_context(start_method)
+        parent_conn, child_conn = context.Pipe()
+        process = context.Process(target=_analysis_worker_main, args=(child_conn,), daemon=True)
+        process.start()
+        child_conn.close()
+        # Wait for the worker to finish importing so start-up never counts against a file's budget
+        if not parent_conn.poll(DEFAULT_CONFIG.get('analysisWorkerStartTimeout', 60)) or parent_conn.recv() != 'ready':
+            process.kill()
+            raise RuntimeError('analysis worker failed to start')
+        worker = (process, parent_conn)
+        with self._lock:
+            self._workers.append(worker)
+        return worker
+
+    def _ensure_started(self) -> bool:
+        if self._started:
+            return self.available
+        with self._lock:
+            if self._started:
+                return self.available
+            self._started = True
+        try:
+            for _ in range(self.size):
+                self._put_idle(self._spawn())
+        except Exception as e:
+            # Some sandboxes forbid subprocesses; analyze in-process without kill support
+            self.available = False
+            log_event('analysis_workers_unavailable', logging.WARNING, error=str(e))
+        return self.available
+
+    def _retire(self, worker):
+        process, conn = worker
+        with self._lock:
+            if worker in self._workers:
+                self._workers.remove(worker)
+        try:
+            process.kill()
+            process.join(1)
+        except Exception:
+            pass
+        conn.close()
+        self.stats.record_restart()
+        # Respawn off the request path; starting an interpreter can take a moment
+        threading.Thread(target=self._respawn, daemon=True).start()
+
+    def _respawn(self):
+        delay = DEFAULT_CONFIG.get('analysisRespawnBackoff', 1.0)
+        while not self._closed.is_set():
+            try:
+                worker = self._spawn()
+            except Exception as e:
+                with self._lock:
+                    live = len(self._workers)
+                log_event('analysis_worker_respawn_failed', logging.ERROR, error=str(e), live_workers=live, retry_in=delay)
+                if live == 0 and self.available:
+                    self._set_available(False)
+                    log_event('analysis_workers_unavailable', logging.WARNING, error=str(e))
+                self._closed.wait(delay)
+                delay = min(delay * 2, DEFAULT_CONFIG.get('analysisRespawnMaxBackoff', 60.0))
+                continue
+            self._put_idle(worker)
+            if not self.available:
+                self._set_available(True)
+                log_event('analysis_workers_available')
+            return
+
+    def _set_available(self, available: bool):
+        with self._idle_cond:
+            self.available = available
+            # Waiters for a worker give up at once rather than at their deadline
+            self._idle_cond.notify_all()
+
+    def _put_idle(self, worker):
+        with self._idle_cond:
+            self._idle.append(worker)
+            self._idle_cond.notify_all()
+
+    def _take_idle(self, priority: str, timeout: float):
+        """An idle worker handed out in weighted-fair priority order, or None after `timeout` seconds"""
+        deadline = time.monotonic() + timeout
+        ticket = object()
+        bulk_cap = bulk_limit(self.size)
+
+        def eligible(p):
+            return p != 'bulk' or self._bulk_busy < bulk_cap
+
+        with self._idle_cond:
+            self._waiters.push(ticket, priority)
+            try:
+                while not (self._idle and self._waiters.head(eligible) is ticket):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self.available:
+                        self._waiters.remove(ticket)
+                        return None
+                    self._idle_cond.wait(timeout=min(remaining, threading.TIMEOUT_MAX))
+                self._waiters.served(ticket)
+                if priority == 'bulk':
+                    self._bulk_busy += 1
+                return self._idle.pop()
+            finally:
+                self._idle_cond.notify_all()
+
+    def _job_done(self, priority: str):
+        if priority == 'bulk':
+            with self._idle_cond:
+                self._bulk_busy -= 1
+                self._idle_cond.notify_all()
+
+    def analyze(self, file_path: str, language: str, timeout: float, extract_main_program: bool = True,
+                priority: str = 'normal', deadline: Optional[float] = None) -> Optional[AnalysisRecord]:
+        """Analyze a file within `timeout` seconds of a worker picking it up, or return None if it overran.
+
+        Waiting for a free worker is bounded by `deadline` (a time.monotonic()
+        value, default `timeout` from now) and raises AnalysisQueueTimeout,
+        as does the pool losing its last worker while the file waits.
+        """
+        start = time.monotonic()
+        if deadline is None:
+            deadline = start + timeout
+        worker = self._take_idle(priority, max(0.0, deadline - start))
+        if worker is None:
+            raise AnalysisQueueTimeout(f'No analysis worker free within {deadline - start:.1f}s')
+        picked_up = time.monotonic()
+        self.stats.record_queue_wait(picked_up - start)
+        deadline = min(deadline, picked_up + timeout)
+        process, conn = worker
+        try:
+            conn.send((file_path, language, extract_main_program, token_estimator.ratios()))
+            if conn.poll(max(0.0, deadline - time.monotonic())):
+                result = conn.recv()
+                self._put_idle(worker)
+                self.stats.record_analyzed(time.monotonic() - picked_up)
+                return result
+        except (EOFError, OSError):
+            pass
+        finally:
+            self._job_done(priority)
+        self._retire(worker)
+        return None
+
+    def shutdown(self):
+        self._closed.set()
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for process, conn in workers:
+            conn.close()
+            process.kill()
+
+def analyze_in_process(analyzer: ASTContextAnalyzer, file_path: str, language: str) -> AnalysisRecord:
+    """Analyze on the calling thread, with no budget, for when no worker process can run"""
+    start = time.perf_counter()
+    result = analyzer.analyze_file(file_path, language)
+    analysis_stats.record_analyzed(time.perf_counter() - start, in_process=True)
+    return result
+
+def analyze_file_with_budget(analyzer: ASTContextAnalyzer, file_path: str, language: str, deadline: float) -> AnalysisRecord:
+    """Analyze one file within the per-file budget and the request `deadline` (a time.monotonic() value)"""
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        analysis_stats.record_degraded('request_budget')
+        return analyzer.outline_file(file_path, language, 'request budget exhausted')
+
+    file_budget = DEFAULT_CONFIG.get('analysisFileBudget', 5.0)
+    # Even a small file goes to the pool: a few KB of nested YAML or a
+    # backtracking regex can take seconds, and only a worker can be killed
+    if not analysis_pool._ensure_started():
+        return analyze_in_process(analyzer, file_path, language)
+    try:
+        result = analysis_pool.analyze(file_path, language, file_budget, analyzer.extract_main_program,
+                                       request_priority_var.get(), deadline)
+    except AnalysisQueueTimeout:
+        if not analysis_pool.available:
+            return analyze_in_process(analyzer, file_path, language)
+        analysis_stats.record_degraded('queue')
+        log_event('analysis_degraded', logging.WARNING, file_path=file_path, language=language,
+                  reason='queue', budget_ms=round(remaining * 1000, 1))
+        return analyzer.outline_file(file_path, language, 'no analysis worker free before the request deadline')
+
+    if result is None:
+        reason = 'request_budget' if time.monotonic() >= deadline else 'file_budget'
+        budget = remaining if reason == 'request_budget' else file_budget
+        analysis_stats.record_degraded(reason)
+        log_event('analysis_degraded', logging.WARNING, file_path=file_path, language=language,
+                  reason=reason, budget_ms=round(budget * 1000, 1))
+        return analyzer.outline_file(file_path, language, f"analysis exceeded {budget:.1f}s budget")
+    return result
+
+analysis_stats = AnalysisStats()
+analysis_pool = AnalysisWorkerPool(DEFAULT_CONFIG['analysisWorkers'], analysis_stats)
+atexit.register(analysis_pool.shutdown)
+
+def parse_reset_duration(value: Optional[str]) -> Optional[float]:
+    """Parse rate-limit reset values such as '7.66s', '2m59.56s', '350ms' or '12' into seconds"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', value)
+    if not parts:
+        return None
+    scale = {'h': 3600.0, 'm': 60.0, 's': 1.0, 'ms': 0.001}
+    return sum(float(number) * scale[unit] for number, unit in parts)
+
+class RateLimitTimeout(Exception):
+    """Raised when a call cannot be admitted under the upstream rate limits in time"""
+
+class Reservation:
+    """Tokens held against the upstream token bucket for one call"""
+    __slots__ = ('prompt', 'completion')
+
+    def __init__(self, prompt: float, completion: float):
+        self.prompt = prompt
+        self.completion = completion
+
+    @property
+    def total(self) -> float:
+        return self.prompt + self.completion
+
+class UpstreamRateLimiter:
+    """Client-side token buckets for upstream requests/minute and tokens/minute.
+
+    Callers reserve one request plus their estimated input and output tokens
+    before calling the model and queue in FIFO order until both buckets can
+    cover the reservation. Once the response arrives the reservation is
+    reconciled with the reported `usage` (failed calls get back what they did
+    not use), and the rate-limit response headers are used to correct the
+    bucket sizes and levels.
+    """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int, max_wait: float,
+                 expected_output_tokens: int = 1024):
+        self._cond = threading.Condition()
+        self.request_capacity = float(requests_per_minute)
+        self.token_capacity = float(tokens_per_minute)
+        self.request_level = self.request_capacity
+        self.token_level = self.token_capacity
+        self.max_wait = max_wait
+        self.expected_output_tokens = float(expected_output_tokens)
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters = FairQueue(DEFAULT_CONFIG.get('priorityWeights', {}))
+        # Metrics
+        self.admitted = 0
+        self.delayed = 0
+        self.timeouts = 0
+        self.rate_limited_responses = 0
+        self.max_queue_depth = 0
+        self.total_wait = 0.0
+        self.max_wait_seen = 0.0
+
+    def _refill(self, now: float):
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self.request_level = min(self.request_capacity, self.request_level + elapsed * self.request_capacity / 60.0)
+        self.token_level = min(self.token_capacity, self.token_level + elapsed * self.token_capacity / 60.0)
+
+    def _seconds_until_available(self, now: float, tokens: float) -> float:
+        waits = [self._paused_until - now]
+        if self.request_level < 1:
+            waits.append((1 - self.request_level) * 60.0 / self.request_capacity)
+        # A reservation larger than the whole bucket is admitted once the bucket is full
+        needed = min(tokens, self.token_capacity)
+        if self.token_level < needed:
+            waits.append((needed - self.token_level) * 60.0 / self.token_capacity)
+        return max(waits)
+
+    def acquire(self, input_tokens: int, max_wait: Optional[float] = None, priority: str = 'normal',
+                max_output_tokens: Optional[int] = None) -> Reservation:
+        """Block until one request and the estimated tokens fit; return the reservation.
+
+        Queued callers are served in weighted-fair order of their priority.
+        The output estimate never exceeds the call's `max_output_tokens`.
+        """
+        expected_output = self.expected_output_tokens if max_output_tokens is None else \
+            min(self.expected_output_tokens, float(max_output_tokens))
+        reservation = Reservation(float(input_tokens), expected_output)
+        reserved = reservation.total
+        limit = self.max_wait if max_wait is None else min(self.max_wait, max_wait)
+        start = time.monotonic()
+        ticket = object()
+        with self._cond:
+            self._waiters.push(ticket, priority)
+            self.max_queue_depth = max(self.max_queue_depth, len(self._waiters))
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    wait = self._seconds_until_available(now, reserved)
+                    if self._waiters.head() is ticket and wait <= 0:
+                        self._waiters.served(ticket)
+                        break
+                    if now - start + max(wait, 0) > limit:
+                        self.timeouts += 1
+                        raise RateLimitTimeout(f'Upstream rate limit: call would wait more than {limit:.1f}s')
+                    # Re-check when capacity should be available, or when the queue head changes
+                    self._cond.wait(timeout=wait if wait > 0 and self._waiters.head() is ticket else 0.5)
+                self.request_level -= 1
+                self.token_level -= reserved
+            finally:
+                self._waiters.remove(ticket)
+                self._cond.notify_all()
+
+            waited = time.monotonic() - start
+            self.admitted += 1
+            if waited > 0.001:
+                self.delayed += 1
+            self.total_wait += waited
+            self.max_wait_seen = max(self.max_wait_seen, waited)
+        return reservation
+
+    def complete(self, reservation: Reservation, usage: Optional[Dict[str, Any]] = None, headers=None,
+                 reached: bool = True):
+        """Reconcile a reservation with actual usage and calibrate from response headers.
+
+        Without usage nothing was generated, so the completion part is refunded;
+        the prompt part is refunded too when the call never `reached` upstream.
+        """
+        with self._cond:
+            if usage and 'total_tokens' in usage:
+                actual = float(usage['total_tokens'])
+                self.token_level += reservation.total - actual
+                completion = usage.get('completion_tokens')
+                if completion is not None:
+                    # Exponential moving average of observed completion sizes
+                    self.expected_output_tokens = 0.8 * self.expected_output_tokens + 0.2 * float(completion)
+            else:
+                self.token_level += reservation.completion if reached else reservation.total
+            if headers:
+                self._calibrate(headers)
+            self._cond.notify_all()
+
+    def _calibrate(self, headers):
+        limit_tokens = headers.get('x-ratelimit-limit-tokens')
+        remaining_tokens = headers.get('x-ratelimit-remaining-tokens')
+        remaining_requests = headers.get('x-ratelimit-remaining-requests')
+        try:
+            if limit_tokens:
+                self.token_capacity = float(limit_tokens)
+            if remaining_tokens is not None:
+                self.token_level = min(self.token_level, float(remaining_tokens))
+            if remaining_requests is not None:
+                self.request_level = min(self.request_level, float(remaining_requests))
+        except ValueError:
+            pass
+        if remaining_requests is not None and self.request_level < 1:
+            reset = parse_reset_duration(headers.get('x-ratelimit-reset-requests'))
+            if reset:
+                self._paused_until = max(self._paused_until, time.monotonic() + reset)
+
+    def on_rate_limited(self, reservation: Reservation, headers):
+        """Handle a 429: refund the reservation and pause everyone until the upstream resets"""
+        with self._cond:
+            self.rate_limited_responses += 1
+            self.token_level += reservation.total
+            retry_after = parse_reset_duration(headers.get('retry-after')) or \
+                parse_reset_duration(headers.get('x-ratelimit-reset-tokens')) or 1.0
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            self._calibrate(headers)
+            self._cond.notify_all()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._cond:
+            self._refill(time.monotonic())
+            return {
+                'queue_depth': len(self._waiters),
+                'queue_depth_by_priority': {priority: self._waiters.depth(priority) for priority in PRIORITIES},
+                'max_queue_depth': self.max_queue_depth,
+                'admitted': self.admitted,
+                'delayed': self.delayed,
+                'timeouts': self.timeouts,
+                'rate_limited_responses': self.rate_limited_responses,
+                'avg_wait_ms': (self.total_wait / self.admitted * 1000) if self.admitted else 0.0,
+                'max_wait_ms': self.max_wait_seen * 1000,
+                'requests_available': round(self.request_level, 2),
+                'tokens_available': round(self.token_level, 1),
+                'tokens_per_minute': self.token_capacity,
+                'requests_per_minute': self.request_capacity,
+                'expected_output_tokens': round(self.expected_output_tokens, 1)
+            }
+
+class AttemptCancelled(Exception):
+    """Raised in a hedged call that lost to another endpoint"""
+
+class AbortableAdapter(requests.adapters.HTTPAdapter):
+    """HTTP adapter that remembers its sockets so another thread can shut them down mid-request"""
+
+    def __init__(self, *args, **kwargs):
+        self._sockets = set()
+        self._sockets_lock = threading.Lock()
+        self.aborted = False
+        super().__init__(*args, **kwargs)
+
+    def _track(self, manager):
+        adapter = self
+
+        def tracked(pool_class):
+            class Connection(pool_class.ConnectionCls):
+                def connect(self):
+                    super().connect()
+                    with adapter._sockets_lock:
+                        adapter._sockets.add(self.sock)
+                        aborted = adapter.aborted
+                    if aborted:
+                        self.sock.shutdown(socket.SHUT_RDWR)
+            return type(pool_class.__name__, (pool_class,), {'ConnectionCls': Connection})
+
+        manager.pool_classes_by_scheme = {scheme: tracked(cls) for scheme, cls in manager.pool_classes_by_scheme.items()}
+        return manager
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self._track(self.poolmanager)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        if proxy not in self.proxy_manager:
+            self._track(super().proxy_manager_for(proxy, **proxy_kwargs))
+        return self.proxy_manager[proxy]
+
+    def abort(self):
+        """Shut down every socket this adapter opened; blocked reads fail at once"""
+        with self._sockets_lock:
+            self.aborted = True
+            sockets = list(self._sockets)
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+class EndpointAttempt:
+    """One hedged call's own HTTP session, so the losing call can be aborted"""
+
+    def __init__(self):
+        self.cancelled = False
+        self.adapter = AbortableAdapter()
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+
+    def cancel(self):
+        self.cancelled = True
+        self.adapter.abort()
+
+    def close(self):
+        self.session.close()
+
+class ModelEndpoint:
+    """One OpenAI-compatible upstream with its own rate limiter, latency history and circuit breaker"""
+
+    def __init__(self, url: str, api_key: str, model: Optional[str], weight: float, config: Dict[str, Any]):
+        self.url = url
+        self.api_key = api_key
+        self.model = model
+        self.weight = weight
+        self.config = config
+        self.rate_limiter = UpstreamRateLimiter(
+            config['rateLimitRequestsPerMinute'],
+            config['rateLimitTokensPerMinute'],
+            config['rateLimitMaxWait'],
+            expected_output_tokens=min(config.get('maxTokens', 4096), 1024)
+        )
+        self._lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=config['latencyWindow'])
+        self.outcomes = collections.deque(maxlen=config['circuitWindow'])
+        self.circuit = 'closed'
+        self.open_until = 0.0
+        self.calls = 0
+        self.errors = 0
+
+    def available(self) -> bool:
+        """Closed circuits take traffic; an open circuit allows one half-open trial once it expires"""
+        with self._lock:
+            if self.circuit == 'closed':
+                return True
+            if self.circuit == 'open' and time.monotonic() >= self.open_until:
+                self.circuit = 'half_open'
+                return True
+            return False
+
+    def record(self, success: bool, latency: float):
+        with self._lock:
+            self.calls += 1
+            self.outcomes.append(success)
+            if success:
+                self.latencies.append(latency)
+                if self.circuit == 'half_open':
+                    self.circuit = 'closed'
+                    self.outcomes.clear()
+                return
+            self.errors += 1
+            failures = self.outcomes.count(False)
+            if self.circuit == 'half_open' or (
+                    len(self.outcomes) >= self.config['circuitMinCalls'] and
+                    failures / len(self.outcomes) >= self.config['circuitErrorRate']):
+                self.circuit = 'open'
+                self.open_until = time.monotonic() + self.config['circuitOpenSeconds']
+                log_event('endpoint_circuit_open', logging.WARNING, url=self.url, failures=failures)
+
+    def latency_percentile(self, percentile: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self.latencies)
+        if len(samples) < 5:
+            return None
+        index = min(len(samples) - 1, int(round(percentile / 100.0 * (len(samples) - 1))))
+        return samples[index]
+
+    def post(self, payload: Dict[str, Any], input_tokens: int, deadline: Optional[float] = None,
+             priority: str = 'normal', hedge: Optional[EndpointAttempt] = None) -> Dict[str, Any]:
+        """POST a chat completion within this endpoint's rate limits and the request deadline, retrying on 429.
+
+        A hedged call passes its `hedge` attempt; once it is cancelled the call
+        fails with AttemptCancelled and its reservation is refunded.
+        """
+        http = hedge.session if hedge is not None else requests
+        if self.model:
+            payload = dict(payload, model=self.model)
+        for attempt in range(self.config['maxRetries'] + 1):
+            timeout = self.config['timeout']
+            max_wait = None
+            if deadline is not None:
+                max_wait = deadline - time.monotonic()
+                if max_wait <= 0:
+                    raise DeadlineExceeded('Request deadline reached before the upstream call')
+            reservation = self.rate_limiter.acquire(input_tokens, max_wait, priority, payload.get('max_tokens'))
+            if hedge is not None and hedge.cancelled:
+                self.rate_limiter.complete(reservation, reached=False)
+                raise AttemptCancelled(f'Hedged call to {self.url} lost')
+            if deadline is not None:
+                timeout = max(0.001, min(timeout, deadline - time.monotonic()))
+            try:
+                response = http.post(
+                    self.url,
+                    json=payload,
+                    headers={
+                        'Authorization': self.api_key,
+                        'Content-Type': 'application/json'
+                    },
+                    timeout=timeout
+                )
+            except Exception as error:
+                if hedge is not None and hedge.cancelled:
+                    # Aborted because another endpoint answered first; its answer is all that counts
+                    self.rate_limiter.complete(reservation, reached=False)
+                    raise AttemptCancelled(f'Hedged call to {self.url} lost') from error
+                # Refused or timed-out connects: the request was (almost always) never sent
+                self.rate_limiter.complete(reservation, reached=not isinstance(error, requests.exceptions.ConnectionError))
+                if isinstance(error, requests.exceptions.Timeout) and deadline is not None and time.monotonic() >= deadline:
+                    # The timeout was the caller's deadline, not the endpoint's
+                    raise DeadlineExceeded(f'Request deadline reached while waiting on {self.url}') from error
+                raise
+            if response.status_code == 200:
+                try:
+                    data = response.json()
+                except ValueError:
+                    # The call was served but its usage is unreadable: keep the prompt, refund the rest
+                    self.rate_limiter.complete(reservation, {}, response.headers)
+                    raise
+                self.rate_limiter.complete(reservation, (data or {}).get('usage') or {}, response.headers)
+                return data
+            if response.status_code == 429:
+                self.rate_limiter.on_rate_limited(reservation, response.headers)
+                log_event('model_rate_limited', logging.WARNING, url=self.url, attempt=attempt + 1, retry_after=response.headers.get('retry-after'))
+                if attempt < self.config['maxRetries']:
+                    continue
+            else:
+                self.rate_limiter.complete(reservation, {}, response.headers)
+            raise Exception(f'API request failed with status {response.status_code}: {response.text}')
+
+    def snapshot(self) -> Dict[str, Any]:
+        p50 = self.latency_percentile(50)
+        p95 = self.latency_percentile(95)
+        return {
+            'url': self.url,
+            'weight': self.weight,
+            'circuit': self.circuit,
+            'calls': self.calls,
+            'errors': self.errors,
+            'p50_ms': round(p50 * 1000, 1) if p50 is not None else None,
+            'p95_ms': round(p95 * 1000, 1) if p95 is not None else None,
+            'rate_limiter': self.rate_limiter.snapshot()
+        }
+
+class EndpointRouter:
+    """Routes chat completions across weighted endpoints with hedging and failover.
+
+    The primary endpoint is a weighted pick among endpoints whose circuit is
+    not open. If it has not answered within its own latency percentile
+    (`hedgePercentile`), a duplicate request goes to the next endpoint and the
+    first success wins. Failures move on to the next endpoint immediately,
+    except an expired request deadline, which no endpoint could meet; it and
+    a local rate-limit timeout are not counted against the circuit.
+    Each attempt runs on its own HTTP session; the loser's sockets are shut
+    down as soon as the winner answers, its rate-limiter reservation is
+    refunded, and the abort does not count against its circuit.
+    """
+
+    def __init__(self, endpoints: List[ModelEndpoint], config: Dict[str, Any]):
+        self.endpoints = endpoints
+        self.config = config
+        self._executor = ThreadPoolExecutor(max_workers=config['hedgeWorkers'], thread_name_prefix='model-endpoint')
+        self._lock = threading.Lock()
+        self.hedges_launched = 0
+        self.hedges_won = 0
+        self.failovers = 0
+        self.discarded = 0
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> 'EndpointRouter':
+        endpoint_configs = config.get('modelEndpoints') or [
+            {'url': config['modelApiUrl'], 'apiKey': config['apiKey'], 'model': config.get('model')}
+        ]
+        endpoints = [
+            ModelEndpoint(
+                item['url'],
+                item.get('apiKey', config['apiKey']),
+                item.get('model', config.get('model')),
+                float(item.get('weight', 1.0)),
+                config
+            )
+            for item in endpoint_configs
+        ]
+        return cls(endpoints, config)
+
+    def _candidates(self) -> List[ModelEndpoint]:
+        """Weighted primary first, then the remaining healthy endpoints in configured order"""
+        healthy = [endpoint for endpoint in self.endpoints if endpoint.available()]
+        if not healthy:
+            # Every circuit is open: trying is better than failing without a request
+            healthy = list(self.endpoints)
+        primary = random.choices(healthy, weights=[max(e.weight, 0.0) or 1e-9 for e in healthy])[0]
+        return [primary] + [endpoint for endpoint in healthy if endpoint is not primary]
+
+    def _attempt(self, endpoint: ModelEndpoint, payload: Dict[str, Any], input_tokens: int, deadline: Optional[float],
+                 priority: str = 'normal', attempt: Optional[EndpointAttempt] = None) -> Dict[str, Any]:
+        start = time.monotonic()
+        try:
+            data = endpoint.post(payload, input_tokens, deadline, priority, attempt)
+        except (AttemptCancelled, DeadlineExceeded, RateLimitTimeout):
+            # Lost races, expired deadlines and local rate limits say nothing about the endpoint's health
+            raise
+        except Exception:
+            endpoint.record(False, time.monotonic() - start)
+            raise
+        finally:
+            if attempt is not None:
+                attempt.close()
+        endpoint.record(True, time.monotonic() - start)
+        return data
+
+    def _submit(self, endpoint: ModelEndpoint, payload: Dict[str, Any], input_tokens: int, deadline: Optional[float],
+                priority: str, attempts: Dict[Any, EndpointAttempt]):
+        attempt = EndpointAttempt()
+        future = self._executor.submit(self._attempt, endpoint, payload, input_tokens, deadline, priority, attempt)
+        attempts[future] = attempt
+        return future
+
+    @staticmethod
+    def _abandon(pending, attempts: Dict[Any, EndpointAttempt]):
+        """Drop attempts not yet started and abort the ones in flight"""
+        for future in pending:
+            if future.cancel():
+                attempts[future].close()
+            else:
+                attempts[future].cancel()
+
+    def _hedge_delay(self, endpoint: ModelEndpoint) -> float:
+        observed = endpoint.latency_percentile(self.config['hedgePercentile'])
+        delay = observed if observed is not None else self.config['hedgeDefaultDelay']
+        return max(delay, self.config['hedgeMinDelay'])
+
+    def call(self, payload: Dict[str, Any], input_tokens: int, deadline: Optional[float] = None,
+             priority: Optional[str] = None) -> Dict[str, Any]:
+        """Return the first successful completion; `deadline` is an absolute time.monotonic() bound.
+
+        `priority` defaults to the calling request's priority.
+        """
+        if priority is None:
+            priority = request_priority_var.get()
+        candidates = self._candidates()
+        if len(candidates) == 1:
+            return self._attempt(candidates[0], payload, input_tokens, deadline, priority)
+
+        attempts: Dict[Any, EndpointAttempt] = {}
+        futures = {self._submit(candidates[0], payload, input_tokens, deadline, priority, attempts): candidates[0]}
+        pending = set(futures)
+        next_index = 1
+        hedge_delay = self._hedge_delay(candidates[0]) if self.config['hedgeEnabled'] else None
+        errors = []
+        while pending:
+            can_hedge = hedge_delay is not None and next_index < len(candidates)
+            done, pending = wait(pending, timeout=hedge_delay if can_hedge else None, return_when=FIRST_COMPLETED)
+            if not done:
+                # Primary is slower than its usual percentile: send a hedged duplicate
+                future = self._submit(candidates[next_index], payload, input_tokens, deadline, priority, attempts)
+                futures[future] = candidates[next_index]
+                pending.add(future)
+                log_event('model_hedge', primary=candidates[0].url, hedge=candidates[next_index].url, delay_ms=round(hedge_delay * 1000, 1))
+                with self._lock:
+                    self.hedges_launched += 1
+                next_index += 1
+                hedge_delay = None
+                continue
+            for future in done:
+                try:
+                    data = future.result()
+                except DeadlineExceeded:
+                    # Every other endpoint would hit the same deadline
+                    self._abandon(pending, attempts)
+                    raise
+                except Exception as error:
+                    errors.append(error)
+                    continue
+                with self._lock:
+                    if futures[future] is not candidates[0]:
+                        self.hedges_won += 1
+                    self.discarded += len(pending)
+                self._abandon(pending, attempts)
+                return data
+            if not pending and next_index < len(candidates):
+                # Everything in flight failed: fail over to the next endpoint
+                with self._lock:
+                    self.failovers += 1
+                future = self._submit(candidates[next_index], payload, input_tokens, deadline, priority, attempts)
+                futures[future] = candidates[next_index]
+                pending.add(future)
+                next_index += 1
+        raise errors[-1]
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = {
+                'hedges_launched': self.hedges_launched,
+                'hedges_won': self.hedges_won,
+                'failovers': self.failovers,
+                'discarded_responses': self.discarded
+            }
+        counters['endpoints'] = [endpoint.snapshot() for endpoint in self.endpoints]
+        return counters
+
+# --- OUTPUT SIZE PREDICTION ---
+# A fixed max_tokens of 4096 reserves far more output than most templates
+# ever produce, and providers count the limit against tokens/minute. The
+# model learns completion sizes per template and prompt shape and asks for
+# a high percentile of them plus headroom; a response cut off at that limit
+# is retried with a larger one, up to maxTokens.
+OUTPUT_PROMPT_BUCKETS = ((40, 'short'), (200, 'medium'))  # Prompt tokens below each bound; 'long' beyond
+
+def output_features(prompt_tokens: int, has_context: bool) -> str:
+    """Prompt shape the output size is learned under, e.g. 'short+context'"""
+    size = next((label for bound, label in OUTPUT_PROMPT_BUCKETS if prompt_tokens < bound), 'long')
+    return f"{size}+context" if has_context else size
+
+class OutputSizeModel:
+    """Observed completion tokens per (template, prompt shape), and the max_tokens they call for.
+
+    A shape with fewer than `outputMinSamples` observations falls back to
+    its template's samples, then to maxTokens. Truncated responses are
+    recorded at the limit they hit, so a too-small limit only pushes the
+    percentile up.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.window = DEFAULT_CONFIG.get('outputSampleWindow', 200)
+        self._samples: Dict[tuple, collections.deque] = {}
+        self._templates: Dict[str, Dict[str, int]] = {}
+
+    def _percentile(self, key: tuple) -> Optional[int]:
+        samples = self._samples.get(key)
+        if not samples or len(samples) < DEFAULT_CONFIG.get('outputMinSamples', 20):
+            return None
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(round(DEFAULT_CONFIG.get('outputPercentile', 95) / 100.0 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def predict(self, template: str, features: str) -> int:
+        """max_tokens for a call: the shape's (or template's) high percentile plus headroom, within maxTokens"""
+        ceiling = DEFAULT_CONFIG.get('maxTokens', 4096)
+        with self._lock:
+            observed = self._percentile((template, features))
+            if observed is None:
+                observed = self._percentile((template, None))
+        if observed is None:
+            return ceiling
+        limit = int(observed * (1 + DEFAULT_CONFIG.get('outputHeadroom', 0.25)))
+        return max(min(limit, ceiling), min(DEFAULT_CONFIG.get('outputMinTokens', 256), ceiling))
+
+    def record(self, template: str, features: str, completion_tokens: int, reserved: int, truncated: bool):
+        """One upstream call: tokens generated under a `reserved` max_tokens"""
+        with self._lock:
+            for key in ((template, features), (template, None)):
+                self._samples.setdefault(key, collections.deque(maxlen=self.window)).append(completion_tokens)
+            counters = self._templates.setdefault(template, collections.Counter())
+            counters['calls'] += 1
+            counters['reserved'] += reserved
+            counters['used'] += completion_tokens
+            counters['truncated'] += 1 if truncated else 0
+
+    def record_retry(self, template: str):
+        with self._lock:
+            self._templates.setdefault(template, collections.Counter())['retries'] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            templates = {name: dict(counters) for name, counters in self._templates.items()}
+        for name, counters in templates.items():
+            counters['utilization'] = round(counters['used'] / counters['reserved'], 3) if counters.get('reserved') else 0.0
+            counters['max_tokens'] = self.predict(name, None)
+        reserved = sum(counters.get('reserved', 0) for counters in templates.values())
+        used = sum(counters.get('used', 0) for counters in templates.values())
+        return {
+            'reserved_tokens': reserved,
+            'used_tokens': used,
+            'utilization': round(used / reserved, 3) if reserved else 0.0,
+            'truncated': sum(counters.get('truncated', 0) for counters in templates.values()),
+            'retries': sum(counters.get('retries', 0) for counters in templates.values()),
+            'templates': templates
+        }
+
+output_size_model = OutputSizeModel()
+
+class ModelAPIClient:
+    def __init__(self, config):
+        self.config = config
+        self.context_analyzer = ASTContextAnalyzer()
+        self.router = EndpointRouter.from_config(config)
+    
+    def generate_full_response(self, prompt: str, context: str = "", history: Optional[List[Dict[str, str]]] = None, history_tokens: int = 0,
+                               report: Optional[Dict[str, Any]] = None) -> str:
+        """Call the model; `history` holds prior conversation messages costing `history_tokens`.
+
+        `report`, when given, gets 'truncated': True if the answer returned was
+        cut off at its max_tokens.
+        """
+        try:
+            # Calculate token counts
+            prompt_tokens = count_tokens(prompt) + history_tokens
+            context_tokens = count_tokens(context) if context else 0
+            # --- Use dynamic system prompt selection ---
+            system_prompt_key = select_system_prompt(prompt, context)
+            template = prompt_registry.get(system_prompt_key)
+            # Fixed parts of the input come from the registry, not the tokenizer
+            fixed_tokens = template['token_count'] + (prompt_registry.context_framing_tokens if context else 0)
+            total_input_tokens = prompt_tokens + context_tokens + fixed_tokens
+            # Check if we exceed input token limit
+            if total_input_tokens > self.config['maxInputTokens']:
+                # Optimize context to fit within token limit
+                available_tokens = self.config['maxInputTokens'] - prompt_tokens - fixed_tokens
+                if available_tokens > 0:
+                    context = self._optimize_context_by_tokens(context, available_tokens)
+                else:
+                    # If even without context we're over limit, drop the oldest turns, then truncate the prompt
+                    context = ""
+                    fixed_tokens = template['token_count']  # The context framing only wraps a context
+                    room = max(0, self.config['maxInputTokens'] - fixed_tokens)
+                    history, history_tokens = self._trim_history(history or [], max(0, room - (prompt_tokens - history_tokens)))
+                    prompt = self._truncate_text_by_tokens(prompt, max(0, room - history_tokens))
+                    prompt_tokens = count_tokens(prompt) + history_tokens
+                    total_input_tokens = prompt_tokens + fixed_tokens
+            # --- Use selected system prompt ---
+            log_event(
+                'model_request',
+                template=system_prompt_key,
+                input_tokens=total_input_tokens,
+                prompt=prompt,
+                context=context
+            )
+            messages = [template['system_message']] + list(history or [])
+            if context:
+                messages.append({
+                    'role': 'user', 
+                    'content': CONTEXT_MESSAGE_TEMPLATE.format(context=context, prompt=prompt)
+                })
+            else:
+                messages.append({'role': 'user', 'content': prompt})
+            # Ask for what this template usually produces; grow the limit only when a response hits it
+            features = output_features(prompt_tokens - history_tokens, bool(context))
+            max_tokens = output_size_model.predict(system_prompt_key, features)
+            payload = {
+                'model': self.config.get('model', 'llama3-8b-8192'),
+                'messages': messages,
+                'max_tokens': max_tokens,
+                'temperature': 0.7,
+                'top_p': 0.9
+            }
+            budget = model_call_budget()
+            deadline = None if budget is None else time.monotonic() + budget
+            output = None
+            while True:
+                try:
+                    data = self.router.call(payload, min(total_input_tokens, self.config['maxInputTokens']), deadline)
+                except Exception:
+                    if output is None:
+                        raise
+                    # The retry failed; the truncated answer is better than none, but it is not a whole answer
+                    if report is not None:
+                        report['truncated'] = True
+                    return output
+                if not (data and 'choices' in data and len(data['choices']) > 0):
+                    raise Exception('No response from model API')
+                choice = data['choices'][0]
+                output = choice['message']['content']
+                completion_tokens = (data.get('usage') or {}).get('completion_tokens')
+                if completion_tokens is None:
+                    completion_tokens = count_tokens(output)
+                truncated = choice.get('finish_reason') == 'length'
+                output_size_model.record(system_prompt_key, features, completion_tokens, max_tokens, truncated)
+                ceiling = self.config.get('maxTokens', 4096)
+                if not truncated or max_tokens >= ceiling:
+                    if report is not None:
+                        report['truncated'] = truncated
+                    return output
+                max_tokens = min(ceiling, int(max_tokens * self.config.get('outputRetryGrowth', 2.0)))
+                output_size_model.record_retry(system_prompt_key)
+                log_event('model_output_truncated', logging.WARNING, template=system_prompt_key,
+                          completion_tokens=completion_tokens, retry_max_tokens=max_tokens)
+                payload = dict(payload, max_tokens=max_tokens)
+        except Exception as error:
+            log_event('model_error', logging.ERROR, error=str(error))
+            return f'Error: Unable to get a response from the model. {str(error)}'
+    
+    def _get_system_prompt(self) -> str:
+        """Get the enhanced system prompt"""
+        return """You are an expert AI coding assistant that analyzes, thinks, and executes based on user prompts.
+
+ANALYSIS & EXECUTION GUIDELINES:
+1. **Analyze**: Understand the user's intent and requirements
+2. **Think**: Plan the solution with necessary packages, dependencies, and steps
+3. **Execute**: Provide complete, runnable solutions with installation commands
+
+RESPONSE FORMAT:
+Always structure your response with these sections:
+
+## 📋 Analysis
+Brief analysis of the user's request
+
+## 🛠️ Required Packages
+List of necessary packages with installation commands:
+```bash
+pip install package1 package2
+npm install package1 package2
+# etc.
+```
+
+## 💻 Solution
+Complete code with proper syntax highlighting:
+```language
+// Your complete code here
+```
+
+## 🚀 Run Commands
+Commands to execute the solution:
+```bash
+python script.py
+node app.js
+# etc.
+```
+
+## 📝 Usage Instructions
+Brief instructions on how to use the solution
+
+EXAMPLES:
+- For web apps: Include HTML, CSS, JS with run commands
+- For Python scripts: Include imports, main code, and execution commands
+- For Node.js: Include package.json, dependencies, and run commands
+- For data analysis: Include pandas, matplotlib, and visualization commands
+
+Always provide complete, copy-paste ready solutions with all necessary setup steps."""
+    
+    def _optimize_context_by_tokens(self, context: str, max_tokens: int) -> str:
+        """Optimize context to fit within token limit"""
+        if count_tokens(context) <= max_tokens:
+            return context
+        
+        # Split into sections and prioritize
+        sections = context.split('\n\n')
         optimized_sections = []
         current_tokens = 0
         
@@ -1075,6 +3289,14 @@ Always provide complete, copy-paste ready solutions with all necessary setup ste
         
         return '\n'.join(key_lines)
     
+    def _trim_history(self, history: List[Dict[str, str]], max_tokens: int):
+        """Drop the oldest turns until `history` fits in `max_tokens`, as (messages, token_count)"""
+        counts = [count_tokens(message['content']) for message in history]
+        start = 0
+        while start < len(history) and sum(counts[start:]) > max_tokens:
+            start += 2  # A user message and its answer go together
+        return history[start:], sum(counts[start:])
+
     def _truncate_text_by_tokens(self, text: str, max_tokens: int) -> str:
         """Truncate text to fit within token limit"""
         if count_tokens(text) <= max_tokens:
@@ -1180,283 +3402,2362 @@ Always provide complete, copy-paste ready solutions with all necessary setup ste
 # Initialize the model client
 model_client = ModelAPIClient(DEFAULT_CONFIG)
 
-@app.route('/api/analyze-and-execute', methods=['POST'])
-def analyze_and_execute():
-    def minimal_sections_response(analysis_msg):
-        return {
-            'analysis': analysis_msg,
-            'packages': [],
-            'solution': '',
-            'run_commands': [],
-            'usage': '',
-            'files': []
-        }
+GREETINGS = ["hello", "hi", "hey", "greetings", "good morning", "good afternoon", "good evening"]
+UNCLEAR_PHRASES = [
+    "i don't know", "not sure", "can't tell", "unable to", "don't understand", "unclear", "?", "help", "what", "who are you", "explain yourself"
+]
 
-    try:
-        data = request.get_json()
-        if not data or 'prompt' not in data:
-            return jsonify({
-                'success': False,
-                'error': 'Missing prompt in request body'
-            }), 400
+def minimal_sections_response(analysis_msg):
+    return {
+        'analysis': analysis_msg,
+        'packages': [],
+        'solution': '',
+        'run_commands': [],
+        'usage': '',
+        'files': []
+    }
 
-        user_prompt = data['prompt']
-        context = data.get('context', '')
-        files = data.get('files', None)
-        folders = data.get('folders', None)
+def analysis_message_response(user_prompt: str, analysis_msg: str) -> Dict[str, Any]:
+    """Build the response body used when only a short analysis message is returned"""
+    return {
+        'success': True,
+        'type': 'analysis',
+        'output': analysis_msg,
+        'sections': minimal_sections_response(analysis_msg),
+        'prompt': user_prompt,
+        'context_tokens': 0,
+        'total_analyzed': 0,
+        'analyzed_files': [],
+        'files': []
+    }
 
-        # --- Handle greetings and unclear prompts before any analysis ---
-        prompt_lower = user_prompt.strip().lower()
-        greetings = ["hello", "hi", "hey", "greetings", "good morning", "good afternoon", "good evening"]
-        unclear_phrases = [
-            "i don't know", "not sure", "can't tell", "unable to", "don't understand", "unclear", "?", "help", "what", "who are you", "explain yourself"
-        ]
-        if any(prompt_lower == g for g in greetings):
-            analysis_msg = "Hello! How can I assist you today?"
-            return jsonify({
-                'success': True,
-                'type': 'analysis',
-                'output': analysis_msg,
-                'sections': minimal_sections_response(analysis_msg),
-                'prompt': user_prompt,
-                'context_tokens': 0,
-                'total_analyzed': 0,
-                'analyzed_files': [],
-                'files': []
-            })
-        if (not user_prompt.strip() or len(user_prompt.strip()) < 3 or any(phrase in prompt_lower for phrase in unclear_phrases)):
-            analysis_msg = "Sorry, I couldn't understand your request. Please provide more details."
-            return jsonify({
-                'success': True,
-                'type': 'analysis',
-                'output': analysis_msg,
-                'sections': minimal_sections_response(analysis_msg),
-                'prompt': user_prompt,
-                'context_tokens': 0,
-                'total_analyzed': 0,
-                'analyzed_files': [],
-                'files': []
-            })
+def quick_reply(user_prompt: str) -> Optional[str]:
+    """Return a canned reply for greetings and unclear prompts, or None if the prompt needs the model"""
+    prompt_lower = user_prompt.strip().lower()
+    if any(prompt_lower == g for g in GREETINGS):
+        return "Hello! How can I assist you today?"
+    if (not user_prompt.strip() or len(user_prompt.strip()) < 3 or any(phrase in prompt_lower for phrase in UNCLEAR_PHRASES)):
+        return "Sorry, I couldn't understand your request. Please provide more details."
+    return None
 
-        # Initialize analyzer
-        analyzer = ASTContextAnalyzer()
-        analysis_results = []
-        temp_files = []
-        
+UPLOAD_LANGUAGES = {'.py': 'python', '.js': 'javascript', '.ts': 'typescript', '.html': 'html', '.css': 'css', '.json': 'json', '.yml': 'yaml', '.yaml': 'yaml', '.xml': 'xml'}
+
+def analysis_stage():
+    """Return (analyzer, deadline, tight) for this request's analysis stage"""
+    analyzer = ASTContextAnalyzer()
+    deadline = stage_deadline(DEFAULT_CONFIG.get('deadlineAnalysisShare', 0.4), DEFAULT_CONFIG.get('analysisRequestBudget', 15.0))
+    tight = deadline_is_tight()
+    analyzer.extract_main_program = not tight
+    return analyzer, deadline, tight
+
+def analyze_folder_with_budget(analyzer: ASTContextAnalyzer, folder_path: str, deadline: float, tight: bool) -> Dict[str, Any]:
+    """Walk a folder unless the request deadline is tight or already spent"""
+    if tight or time.monotonic() >= deadline:
+        # Folder walks are optional: skip them rather than overrun the client's deadline
+        return {'folder_path': folder_path, 'skipped': 'request deadline'}
+    return analyzer.analyze_folder_structure(folder_path)
+
+def write_upload(file_bytes: bytes, name: str, temp_files: List[str]) -> str:
+    """Save uploaded file bytes to a temp file (removed by the caller) and return its path.
+
+    Analysis records only reference the file, so it must outlive the
+    analysis until the context has been built from it.
+    """
+    suffix = os.path.splitext(name)[1]
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix, mode='wb') as tmp:
+        tmp.write(file_bytes)
+        temp_path = tmp.name
+    temp_files.append(temp_path)
+    return temp_path
+
+def remove_temp_files(temp_files: List[str]):
+    for temp_path in temp_files:
         try:
-            # Analyze folders if provided
-            if folders:
-                for folder_info in folders:
-                    if 'path' in folder_info and os.path.exists(folder_info['path']):
-                        folder_analysis = analyzer.analyze_folder_structure(folder_info['path'])
-                        analysis_results.append({
-                            'type': 'folder',
-                            'data': folder_analysis
-                        })
-            
-            # Analyze files if provided
-            if files:
-                for file_info in files:
-                    # Support both {path, language} and {name, type, content}
-                    if 'path' in file_info and os.path.exists(file_info['path']):
-                        file_path = file_info['path']
-                        language = file_info.get('language', 'unknown')
-                        result = analyzer.analyze_file(file_path, language)
-                        analysis_results.append({
-                            'type': 'file',
-                            'data': result
-                        })
-                    elif 'content' in file_info and 'name' in file_info:
-                        # Save base64 content to a temp file
-                        file_bytes = base64.b64decode(file_info['content'])
-                        suffix = os.path.splitext(file_info['name'])[1]
-                        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix, mode='wb') as tmp:
-                            tmp.write(file_bytes)
-                            temp_path = tmp.name
-                        temp_files.append(temp_path)
-                        # Guess language from extension
-                        ext = suffix.lower()
-                        language_map = {'.py': 'python', '.js': 'javascript', '.ts': 'typescript', '.html': 'html', '.css': 'css', '.json': 'json', '.yml': 'yaml', '.yaml': 'yaml', '.xml': 'xml'}
-                        language = language_map.get(ext, 'unknown')
-                        result = analyzer.analyze_file(temp_path, language)
-                        analysis_results.append({
-                            'type': 'file',
-                            'data': result
-                        })
-            
-            # Create optimized context with token awareness
-            context_parts = []
-            total_tokens = 0
-            max_context_tokens = DEFAULT_CONFIG.get('maxInputTokens', 6000) - count_tokens(user_prompt) - 1000  # Reserve space for system prompt and response
-            
-            for result in analysis_results:
-                if result['type'] == 'folder':
-                    folder_data = result['data']
-                    if 'error' not in folder_data:
-                        folder_summary = f"📁 Folder: {folder_data.get('folder_path', '')}\n"
-                        folder_summary += f"📊 {folder_data.get('summary', '')}\n"
-                        folder_summary += f"📁 Directories: {folder_data.get('total_dirs', 0)}\n"
-                        folder_summary += f"📄 Files: {folder_data.get('total_files', 0)}\n"
-                        
-                        # Add file type breakdown
-                        for lang, count in folder_data.get('file_types', {}).items():
-                            if count > 0:
-                                folder_summary += f"  • {count} {lang} files\n"
-                        
-                        folder_tokens = count_tokens(folder_summary)
-                        if total_tokens + folder_tokens <= max_context_tokens:
-                            context_parts.append(folder_summary)
-                            total_tokens += folder_tokens
-                
-                elif result['type'] == 'file':
-                    file_data = result['data']
-                    if 'error' not in file_data:
-                        file_summary = f"📄 File: {file_data.get('file_path', file_data.get('name', ''))}\n"
-                        file_summary += f"🔤 Language: {file_data.get('language', 'unknown')}\n"
-                        
-                        # Add structure information
-                        if 'structure' in file_data:
-                            file_summary += f"🏗️ Structure: {file_data['structure']}\n"
-                        
-                        # Add imports
-                        if 'imports' in file_data and file_data['imports']:
-                            imports_str = ', '.join(file_data['imports'][:3])  # Limit to 3 imports
-                            file_summary += f"📦 Imports: {imports_str}\n"
-                        
-                        # Add functions/classes
-                        if 'functions' in file_data and file_data['functions']:
-                            func_names = []
-                            for func in file_data['functions'][:3]:  # Limit to 3 functions
-                                if isinstance(func, dict) and 'name' in func:
-                                    func_names.append(func['name'])
-                                elif isinstance(func, str):
-                                    func_names.append(func)
-                            if func_names:
-                                file_summary += f"⚙️ Functions: {', '.join(func_names)}\n"
-                        
-                        # Add complexity metrics
-                        if 'complexity' in file_data:
-                            comp = file_data['complexity']
-                            file_summary += f"📈 Complexity: {comp.get('function_count', 0)} functions, {comp.get('class_count', 0)} classes, max nesting: {comp.get('max_nesting', 0)}\n"
-                        
-                        # Add main program if available
-                        if 'main_program' in file_data and file_data['main_program']:
-                            main_program = file_data['main_program']
-                            # Limit main program to reasonable size
-                            if len(main_program) > 500:
-                                main_program = main_program[:500] + "\n# ... (truncated)"
-                            file_summary += f"🚀 Main Program:\n```{file_data.get('language', 'text')}\n{main_program}\n```\n"
-                        
-                        # Add token count
-                        if 'token_count' in file_data:
-                            file_summary += f"🔢 Tokens: {file_data['token_count']}\n"
-                        
-                        file_tokens = count_tokens(file_summary)
-                        if total_tokens + file_tokens <= max_context_tokens:
-                            context_parts.append(file_summary)
-                            total_tokens += file_tokens
-                        else:
-                            # Add a truncated version
-                            truncated_summary = f"📄 File: {file_data.get('file_path', file_data.get('name', ''))} ({file_data.get('language', 'unknown')}) - {file_data.get('token_count', 0)} tokens\n"
-                            truncated_tokens = count_tokens(truncated_summary)
-                            if total_tokens + truncated_tokens <= max_context_tokens:
-                                context_parts.append(truncated_summary)
-                                total_tokens += truncated_tokens
-            
-            # Combine context parts
-            optimized_context = '\n\n'.join(context_parts)
-            context = optimized_context
-            
-        finally:
-            # Clean up temp files
-            for temp_path in temp_files:
+            os.remove(temp_path)
+        except Exception:
+            pass
+
+# --- NEAR-DUPLICATE DETECTION ---
+# Selected folders often hold copies: dist/ next to src/, vendored
+# libraries, compiled out/*.js next to src/*.ts. As the pipeline pulls each
+# file it is MinHashed and looked up in an LSH index of the files pulled
+# before it; a near-duplicate joins that file's cluster and is listed by
+# name instead of being analyzed and packed again.
+MINHASH_EMPTY = 1 << 64
+MINHASH_TOKEN_PATTERN = re.compile(r'\w+')
+COMPILED_EXTENSIONS = {'.ts': '.js', '.tsx': '.js', '.mts': '.mjs', '.cts': '.cjs'}  # Source -> compiled output
+
+def minhash_signature(tokens: List[str], shingle: int, bins: int) -> tuple:
+    """One-permutation MinHash: each shingle hash lands in one of `bins` bins, which keep their minimum"""
+    mins = [MINHASH_EMPTY] * bins
+    for index in range(max(1, len(tokens) - shingle + 1)):
+        value = hash(tuple(tokens[index:index + shingle])) & 0xFFFFFFFFFFFFFFFF
+        bin_index = value % bins
+        if value // bins < mins[bin_index]:
+            mins[bin_index] = value // bins
+    return tuple(mins)
+
+def minhash_similarity(a: tuple, b: tuple) -> float:
+    """Estimated Jaccard similarity of two signatures (bins empty in both are ignored)"""
+    used = equal = 0
+    for x, y in zip(a, b):
+        if x != MINHASH_EMPTY or y != MINHASH_EMPTY:
+            used += 1
+            equal += x == y
+    return equal / used if used else 0.0
+
+class NearDuplicateIndex:
+    """Clusters of near-identical files, built incrementally in one pass.
+
+    Files are compared by MinHash of their 3-token shingles; LSH banding
+    means each file is only compared with the earlier files it shares a
+    band with. A compiled file and its source with the same name (x.ts and
+    x.js) are compared by token sets instead, since compilation rewrites
+    too much for shingles to match.
+    """
+
+    def __init__(self):
+        self.threshold = DEFAULT_CONFIG.get('nearDuplicateThreshold', 0.8)
+        self.compiled_threshold = DEFAULT_CONFIG.get('compiledDuplicateThreshold', 0.6)
+        self.bins = DEFAULT_CONFIG.get('minhashBins', 128)
+        self.bands = max(1, min(DEFAULT_CONFIG.get('minhashBands', 32), self.bins))
+        self.rows = self.bins // self.bands
+        self._buckets: Dict[tuple, List[int]] = {}
+        self._representatives: List[tuple] = []  # (name, signature)
+        self._compiled: Dict[tuple, List[tuple]] = {}  # (stem, compiled extension) -> [(name, token-set signature)]
+
+    def match(self, name: str, content: bytes):
+        """(representative name, similarity) if `name` nearly duplicates an earlier file; otherwise index it and return None"""
+        tokens = MINHASH_TOKEN_PATTERN.findall(content.decode('utf-8', errors='replace'))
+        if len(tokens) < 3:
+            return None
+        signature = minhash_signature(tokens, 3, self.bins)
+        keys = [(band, signature[band * self.rows:(band + 1) * self.rows]) for band in range(self.bands)]
+        best = None
+        for index in {index for key in keys for index in self._buckets.get(key, ())}:
+            representative, other = self._representatives[index]
+            similarity = minhash_similarity(signature, other)
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (representative, similarity)
+
+        stem, extension = os.path.splitext(os.path.basename(name))
+        family = COMPILED_EXTENSIONS.get(extension.lower(), extension.lower())
+        compiled_key = (stem, family) if family in COMPILED_EXTENSIONS.values() else None
+        token_signature = None
+        if best is None and compiled_key is not None:
+            token_signature = minhash_signature(tokens, 1, self.bins)
+            for representative, other in self._compiled.get(compiled_key, ()):
+                if os.path.splitext(representative)[1].lower() != extension.lower():
+                    similarity = minhash_similarity(token_signature, other)
+                    if similarity >= self.compiled_threshold and (best is None or similarity > best[1]):
+                        best = (representative, similarity)
+        if best is not None:
+            return best
+
+        for key in keys:
+            self._buckets.setdefault(key, []).append(len(self._representatives))
+        self._representatives.append((name, signature))
+        if compiled_key is not None:
+            self._compiled.setdefault(compiled_key, []).append((name, token_signature or minhash_signature(tokens, 1, self.bins)))
+        return None
+
+def near_duplicate_report(analysis_results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Files left out as near-duplicates of another input, and the bytes and estimated tokens that saved"""
+    duplicates = [result['data'] for result in analysis_results
+                  if result['type'] == 'file' and result['data'].get('duplicate_of')]
+    return {
+        'near_duplicates': len(duplicates),
+        'duplicate_bytes_saved': sum(data.get('size') or 0 for data in duplicates),
+        'duplicate_tokens_saved': sum(data.get('token_count') or 0 for data in duplicates)
+    }
+
+class AnalysisPipeline:
+    """Analyze request inputs lazily, in priority order, as build_context pulls them.
+
+    Only cheap metadata (name, size) is gathered up front. Folders come
+    first, then files ranked by how many of their name's terms the prompt
+    mentions, in request order otherwise. Uploads are decoded only when
+    pulled. Inputs still pending when the context builder stops are recorded
+    as skipped rather than analyzed. Uploads go to `temp_files`, which the
+    caller removes once the context has been built.
+    """
+
+    def __init__(self, files, folders, user_prompt: str, temp_files: List[str]):
+        self.analyzer, self.deadline, self.tight = analysis_stage()
+        self.temp_files = temp_files
+        self.results: List[Dict[str, Any]] = []
+        self.pending = collections.deque(self._plan(files or [], folders or [], user_prompt))
+        self.duplicates = NearDuplicateIndex()
+
+    def _plan(self, files, folders, user_prompt: str) -> List[Dict[str, Any]]:
+        inputs = []
+        for folder_info in folders:
+            if 'path' in folder_info and os.path.exists(folder_info['path']):
+                inputs.append({'type': 'folder', 'name': folder_info['path'], 'size': 0, 'info': folder_info})
+        prompt_terms = identifier_terms(user_prompt)
+        ranked = []
+        for order, file_info in enumerate(files):
+            # Support both {path, language} and {name, type, content}
+            if 'path' in file_info and os.path.exists(file_info['path']):
+                name = file_info['path']
+                size = os.path.getsize(name)
+            elif 'content' in file_info and 'name' in file_info:
+                name = file_info['name']
+                size = len(file_info['content']) * 3 // 4  # Decoded size of the base64 payload
+            else:
+                continue
+            relevance = len(prompt_terms & identifier_terms(os.path.splitext(os.path.basename(name))[0]))
+            ranked.append((-relevance, order, {'type': 'file', 'name': name, 'size': size, 'info': file_info}))
+        ranked.sort(key=lambda item: item[:2])
+        return inputs + [item[2] for item in ranked]
+
+    def _analyze(self, item: Dict[str, Any]) -> Dict[str, Any]:
+        info = item['info']
+        if item['type'] == 'folder':
+            data = workspace_registry.lookup_folder(info['path']) or \
+                analyze_folder_with_budget(self.analyzer, info['path'], self.deadline, self.tight)
+        elif 'path' in info:
+            language = info.get('language', 'unknown')
+            data = self._duplicate(item, language, None) or workspace_registry.lookup_file(info['path']) or \
+                analyze_file_with_budget(self.analyzer, info['path'], language, self.deadline)
+        else:
+            # Save base64 content to a temp file and guess the language from its extension
+            content = base64.b64decode(info['content'])
+            language = UPLOAD_LANGUAGES.get(os.path.splitext(info['name'])[1].lower(), 'unknown')
+            data = self._duplicate(item, language, content)
+            if data is None:
+                temp_path = write_upload(content, info['name'], self.temp_files)
+                # Named by the client path, which near-duplicates of this upload refer to
+                data = analyze_file_with_budget(self.analyzer, temp_path, language, self.deadline).with_path(info['name'])
+        return {'type': item['type'], 'data': data}
+
+    def _duplicate(self, item: Dict[str, Any], language: str, content: Optional[bytes]) -> Optional[AnalysisRecord]:
+        """A stand-in record if this file nearly duplicates one pulled earlier, else None"""
+        if not DEFAULT_CONFIG.get('nearDuplicateThreshold') or \
+                not DEFAULT_CONFIG.get('nearDuplicateMinBytes', 256) <= item['size'] <= DEFAULT_CONFIG.get('nearDuplicateMaxBytes', 1048576):
+            return None
+        if content is None:
+            try:
+                with open(item['name'], 'rb') as f:
+                    content = f.read()
+            except OSError:
+                return None
+        match = self.duplicates.match(item['name'], content)
+        if match is None:
+            return None
+        representative, similarity = match
+        token_count = token_estimator.estimate_chars(len(content), language)
+        analysis_stats.record_duplicate(len(content), token_count)
+        return AnalysisRecord(file_path=item['name'], language=language, size=len(content), token_count=token_count,
+                              details={'duplicate_of': representative, 'similarity': round(similarity, 3)})
+
+    def __iter__(self):
+        while self.pending:
+            result = self._analyze(self.pending.popleft())
+            self.results.append(result)
+            yield result
+
+    def finish(self) -> List[Dict[str, Any]]:
+        """All results in pull order, followed by a skipped entry for every input never pulled"""
+        if self.pending:
+            budget = model_call_budget()
+            reason = 'request deadline' if budget is not None and budget < DEFAULT_CONFIG.get('deadlineMinModelSeconds', 1.0) \
+                else 'context budget'
+            size = sum(item['size'] for item in self.pending)
+            analysis_stats.record_skipped(reason, len(self.pending), size)
+            log_event('analysis_skipped', logging.INFO, reason=reason, inputs=len(self.pending), bytes=size)
+            for item in self.pending:
+                if item['type'] == 'folder':
+                    data = {'folder_path': item['name'], 'skipped': reason}
+                else:
+                    language = item['info'].get('language') or \
+                        UPLOAD_LANGUAGES.get(os.path.splitext(item['name'])[1].lower(), 'unknown')
+                    data = AnalysisRecord(file_path=item['name'], language=language,
+                                          size=item['size'], token_count=item['size'] // 4, details={'skipped': reason})
+                self.results.append({'type': item['type'], 'data': data})
+            self.pending.clear()
+        return self.results
+
+IDENTIFIER_PATTERN = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+CAMEL_CASE_PATTERN = re.compile(r'[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+')
+RELEVANCE_STOP_WORDS = {
+    'the', 'and', 'for', 'with', 'this', 'that', 'from', 'into', 'what', 'how', 'does', 'why', 'can',
+    'you', 'please', 'code', 'file', 'function', 'class', 'method', 'add', 'make', 'use', 'get', 'set',
+    'self', 'return', 'def', 'import', 'const', 'let', 'var', 'new', 'public', 'static', 'void', 'int'
+}
+
+def identifier_terms(text: str) -> set:
+    """Lowercased identifiers of 3+ characters plus their snake_case/camelCase parts"""
+    terms = set()
+    for identifier in IDENTIFIER_PATTERN.findall(text):
+        for term in [identifier] + identifier.split('_') + CAMEL_CASE_PATTERN.findall(identifier):
+            term = term.lower()
+            if len(term) >= 3 and term not in RELEVANCE_STOP_WORDS:
+                terms.add(term)
+    return terms
+
+def score_chunk(chunk: ChunkRecord, prompt_terms: set) -> float:
+    """A symbol named exactly in the prompt counts most, then shared name parts, then terms used in the body"""
+    if not prompt_terms:
+        return 0.0
+    symbols = chunk.symbols or []
+    exact_hits = sum(1 for symbol in symbols if symbol.rsplit('.', 1)[-1].lower() in prompt_terms)
+    part_hits = len(prompt_terms & identifier_terms(' '.join(symbols)))
+    body_hits = len(prompt_terms.intersection(chunk.terms))
+    return 10.0 * exact_hits + 2.0 * part_hits + min(body_hits, 3)
+
+# --- DEPENDENCY GRAPH ---
+# A chunk depends on the functions and classes it names. Names resolve to
+# other chunks in the same file, or to chunks in files it imports (Python
+# modules, relative JS import/require specifiers). Per-file nodes are cached
+# by path and rebuilt only when the file or its chunk boundaries changed, so
+# the graph over a workspace is maintained incrementally across requests.
+JS_EXTENSIONS = ('', '.js', '.ts', '.jsx', '.tsx', '.mjs', '.cjs', '/index.js', '/index.ts')
+
+class DependencyNode:
+    """What one file contributes to the graph: the module names it answers to, what it imports, what it defines"""
+    __slots__ = ('stamp', 'modules', 'imports', 'js_targets', 'defines')
+
+    def __init__(self, record: AnalysisRecord, stamp):
+        self.stamp = stamp
+        path = os.path.splitext(os.path.abspath(record.file_path or ''))[0]
+        self.modules = set()
+        self.imports = set()  # Imported module names (Python)
+        self.js_targets = set()  # Extension-less absolute paths of relative JS imports
+        if record.language == 'python':
+            parts = [part for part in path.split(os.sep) if part]
+            if parts and parts[-1] == '__init__':
+                parts.pop()
+            # Every dotted suffix: 'models', 'shop.models', ... whichever root the importer uses
+            self.modules = {'.'.join(parts[i:]) for i in range(len(parts))}
+            for statement in record.imports or []:
+                if statement.startswith('from ') and ' import ' in statement:
+                    # Relative imports arrive without their dots: `from . import x` is 'from  import x'
+                    module, names = statement[len('from '):].split(' import ', 1)
+                    module = module.strip()
+                    if module:
+                        self.imports.add(module)
+                    # `from pkg import mod` may import a submodule rather than a name
+                    self.imports.update(f"{module}.{name.strip()}" if module else name.strip()
+                                        for name in names.split(',') if name.strip() != '*')
+                elif statement.startswith('import '):
+                    self.imports.add(statement.split()[1])
+        elif record.language in ('javascript', 'typescript'):
+            directory = os.path.dirname(path)
+            for specifier in record.imports or []:
+                if specifier.startswith('.'):
+                    self.js_targets.add(os.path.splitext(os.path.normpath(os.path.join(directory, specifier)))[0])
+        self.defines: Dict[str, List[int]] = {}
+        for index, chunk in enumerate(record.chunks or []):
+            # Blocks only hold imports and loose statements; what they name is not a definition worth following
+            if chunk.kind == 'block':
+                continue
+            for symbol in chunk.symbols or []:
+                self.defines.setdefault(symbol.rsplit('.', 1)[-1].lower(), []).append(index)
+
+class DependencyGraph:
+    """LRU of per-file dependency nodes, and distance-ranked closures over a request's chunks"""
+
+    def __init__(self, max_files: int):
+        self.max_files = max_files
+        self._nodes: 'collections.OrderedDict[str, DependencyNode]' = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.builds = 0
+        self.closures = 0
+        self.chunks_added = 0
+
+    def node(self, record: AnalysisRecord) -> DependencyNode:
+        """The record's node, rebuilt only when its file or its chunking changed since it was last seen"""
+        ref = record.content_ref
+        # Chunk boundaries of an unchanged file still move as the token estimator recalibrates
+        chunking = hash(tuple((chunk.start_line, chunk.end_line) for chunk in record.chunks or ()))
+        stamp = (ref.mtime_ns, ref.size, chunking) if ref is not None else None
+        key = record.file_path or ''
+        with self._lock:
+            node = self._nodes.get(key)
+            if node is not None and stamp is not None and node.stamp == stamp:
+                self._nodes.move_to_end(key)
+                self.hits += 1
+                return node
+        node = DependencyNode(record, stamp)
+        with self._lock:
+            self.builds += 1
+            self._nodes[key] = node
+            self._nodes.move_to_end(key)
+            while len(self._nodes) > self.max_files:
+                self._nodes.popitem(last=False)
+        return node
+
+    def closure(self, records: List[AnalysisRecord], seeds: Iterable[tuple], max_depth: int) -> Dict[tuple, int]:
+        """{(file index, chunk index): distance} of chunks reachable from `seeds` within `max_depth` hops"""
+        nodes = [self.node(record) for record in records]
+        by_module: Dict[str, List[int]] = {}
+        by_path: Dict[str, int] = {}
+        for file_index, (record, node) in enumerate(zip(records, nodes)):
+            for module in node.modules:
+                by_module.setdefault(module, []).append(file_index)
+            by_path[os.path.splitext(os.path.abspath(record.file_path or ''))[0]] = file_index
+
+        imported: Dict[int, List[int]] = {}
+
+        def imported_files(file_index: int) -> List[int]:
+            if file_index not in imported:
+                node = nodes[file_index]
+                targets = {target for module in node.imports for target in by_module.get(module, ())}
+                for base in node.js_targets:
+                    for extension in JS_EXTENSIONS:
+                        stripped = os.path.splitext(base + extension)[0]
+                        if stripped in by_path:
+                            targets.add(by_path[stripped])
+                targets.discard(file_index)
+                imported[file_index] = sorted(targets)
+            return imported[file_index]
+
+        distances = {seed: 0 for seed in seeds}
+        frontier = list(distances)
+        for depth in range(1, max_depth + 1):
+            next_frontier = []
+            for file_index, chunk_index in frontier:
+                terms = records[file_index].chunks[chunk_index].terms
+                for target in [file_index] + imported_files(file_index):
+                    defines = nodes[target].defines
+                    for term in terms:
+                        for target_chunk in defines.get(term, ()):
+                            key = (target, target_chunk)
+                            if key not in distances:
+                                distances[key] = depth
+                                next_frontier.append(key)
+            frontier = next_frontier
+        with self._lock:
+            self.closures += 1
+            self.chunks_added += len(distances) - sum(1 for distance in distances.values() if distance == 0)
+        return distances
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'files': len(self._nodes),
+                'max_files': self.max_files,
+                'hits': self.hits,
+                'builds': self.builds,
+                'closures': self.closures,
+                'dependency_chunks_found': self.chunks_added
+            }
+
+dependency_graph = DependencyGraph(DEFAULT_CONFIG.get('dependencyGraphFiles', 20000))
+
+def select_chunks(chunked_files: List[AnalysisRecord], user_prompt: str, budget: int,
+                  dedup: Optional['ContextDeduplicator'] = None) -> Dict[int, List[Any]]:
+    """Pick whole chunks by relevance to the prompt until `budget` tokens are used.
+
+    Returns {file index: [(chunk, rendered text)]}. Chunks scoring below
+    `chunkMinRelevance` of the best chunk are left out. The relevant chunks
+    come first, then what they use (see DependencyGraph), nearest first,
+    and chunks with no relevance only if they are a file's entry point.
+    Only files with a chosen chunk are re-read, and a file that changed
+    since it was analyzed contributes no chunks. With `dedup`, code already
+    in the context is replaced by a reference before a chunk is charged.
+    """
+    prompt_terms = identifier_terms(user_prompt)
+    candidates = []
+    for file_index, file_data in enumerate(chunked_files):
+        for chunk_index, chunk in enumerate(file_data.chunks):
+            score = score_chunk(chunk, prompt_terms)
+            if score > 0 or chunk.kind == 'main':
+                candidates.append((score, chunk.kind == 'main', -chunk.tokens, file_index, chunk_index))
+    candidates.sort(key=lambda c: c[:3], reverse=True)
+    if candidates:
+        floor = candidates[0][0] * DEFAULT_CONFIG.get('chunkMinRelevance', 0.5)
+        candidates = [c for c in candidates if c[0] >= floor or (c[0] == 0 and c[1])]
+    order = [c[3:] for c in candidates if c[0] > 0]
+    entry_points = [c[3:] for c in candidates if c[0] == 0]
+    max_depth = DEFAULT_CONFIG.get('dependencyMaxDepth', 2)
+    if order and max_depth > 0:
+        listed = set(order)
+        distances = dependency_graph.closure(chunked_files, order, max_depth)
+        dependencies = sorted(
+            (distance, chunked_files[key[0]].chunks[key[1]].tokens, key)
+            for key, distance in distances.items() if key not in listed
+        )
+        order += [key for _, _, key in dependencies]
+        entry_points = [key for key in entry_points if key not in distances]
+    order += entry_points
+
+    selected: Dict[int, List[Any]] = {}
+    file_lines: Dict[int, Optional[List[str]]] = {}
+    used = 0
+    for file_index, chunk_index in order:
+        chunk = chunked_files[file_index].chunks[chunk_index]
+        language = chunked_files[file_index].get('language', 'text')
+        label = f"🧩 {chunk.kind} {chunk.name} (lines {chunk.start_line}-{chunk.end_line}):\n```{language}\n"
+        # Chunk sizes are estimates: they rule out chunks that clearly do not fit, and packed chunks are counted exactly
+        estimate = chunk.tokens + token_estimator.estimate(label) + 2
+        if token_estimator.fits(estimate, budget - used) is False:
+            continue
+        if file_index not in file_lines:
+            file_lines[file_index] = chunked_files[file_index].load_lines()
+        lines = file_lines[file_index]
+        if lines is None:
+            continue
+        text = chunk.text(lines)
+        pending = None
+        saved = 0
+        if dedup is not None:
+            deduped, pending = dedup.dedupe(text, chunked_files[file_index].get('file_path', ''), chunk.start_line)
+            if deduped != text:
+                saved = estimate - (token_estimator.estimate(deduped, language) + token_estimator.estimate(label) + 2)
+                text = deduped
+        cost = token_estimator.count(text, language) + count_tokens(label) + 2
+        if cost > budget - used:
+            continue
+        used += cost
+        if pending is not None:
+            dedup.commit(pending, saved)
+        selected.setdefault(file_index, []).append((chunk, label + text + "\n```\n"))
+    return selected
+
+SUMMARY_LEVELS = ('full', 'compact', 'one_line')
+
+def summary_function_names(file_data) -> List[str]:
+    func_names = []
+    for func in file_data.get('functions', [])[:3]:  # Limit to 3 functions
+        if isinstance(func, dict) and 'name' in func:
+            func_names.append(func['name'])
+        elif isinstance(func, str):
+            func_names.append(func)
+    return func_names
+
+def render_file_summary(file_data, level: str = 'full') -> str:
+    """A file's context summary at one of SUMMARY_LEVELS: everything, header/structure/functions, or one line"""
+    name = file_data.get('file_path', file_data.get('name', ''))
+    if 'duplicate_of' in file_data:
+        return f"📄 File: {name} ≈ {file_data['duplicate_of']} ({file_data.get('similarity', 0):.0%} similar, not repeated)\n"
+    if level == 'one_line':
+        return f"📄 File: {name} ({file_data.get('language', 'unknown')}) - {file_data.get('token_count', 0)} tokens\n"
+    if level == 'compact':
+        file_summary = f"📄 File: {name} ({file_data.get('language', 'unknown')})\n"
+        if 'structure' in file_data:
+            file_summary += f"🏗️ Structure: {file_data['structure']}\n"
+        func_names = summary_function_names(file_data)
+        if func_names:
+            file_summary += f"⚙️ Functions: {', '.join(func_names)}\n"
+        return file_summary
+
+    file_summary = f"📄 File: {name}\n"
+    file_summary += f"🔤 Language: {file_data.get('language', 'unknown')}\n"
+
+    # Add structure information
+    if 'structure' in file_data:
+        file_summary += f"🏗️ Structure: {file_data['structure']}\n"
+
+    # Add imports
+    if 'imports' in file_data and file_data['imports']:
+        imports_str = ', '.join(file_data['imports'][:3])  # Limit to 3 imports
+        file_summary += f"📦 Imports: {imports_str}\n"
+
+    # Add functions/classes
+    func_names = summary_function_names(file_data)
+    if func_names:
+        file_summary += f"⚙️ Functions: {', '.join(func_names)}\n"
+
+    # Add complexity metrics
+    if 'complexity' in file_data:
+        comp = file_data['complexity']
+        file_summary += f"📈 Complexity: {comp.get('function_count', 0)} functions, {comp.get('class_count', 0)} classes, max nesting: {comp.get('max_nesting', 0)}\n"
+
+    # Add main program if available (chunked files get their code in the second pass)
+    if file_data.get('main_program') and not file_data.get('chunks'):
+        main_program = file_data['main_program']
+        # Limit main program to reasonable size
+        if len(main_program) > 500:
+            main_program = main_program[:500] + "\n# ... (truncated)"
+        file_summary += f"🚀 Main Program:\n```{file_data.get('language', 'text')}\n{main_program}\n```\n"
+
+    # Add token count
+    if 'token_count' in file_data:
+        file_summary += f"🔢 Tokens: {file_data['token_count']}\n"
+    return file_summary
+
+def render_folder_summary(folder_data: Dict[str, Any]) -> str:
+    folder_summary = f"📁 Folder: {folder_data.get('folder_path', '')}\n"
+    folder_summary += f"📊 {folder_data.get('summary', '')}\n"
+    folder_summary += f"📁 Directories: {folder_data.get('total_dirs', 0)}\n"
+    folder_summary += f"📄 Files: {folder_data.get('total_files', 0)}\n"
+
+    # Add file type breakdown
+    for lang, count in folder_data.get('file_types', {}).items():
+        if count > 0:
+            folder_summary += f"  • {count} {lang} files\n"
+    return folder_summary
+
+class SummaryCache:
+    """LRU of rendered summaries and their token counts.
+
+    Entries are keyed by a digest of exactly the analysis fields a summary is
+    rendered from, plus the detail level, so an unchanged file costs a hash
+    instead of a render and a tokenizer pass, and a changed one can never
+    hit a stale entry.
+    """
+
+    FILE_FIELDS = ('file_path', 'name', 'language', 'structure', 'imports', 'functions', 'complexity', 'main_program', 'token_count',
+                   'duplicate_of', 'similarity', 'skipped')
+    FOLDER_FIELDS = ('folder_path', 'summary', 'total_dirs', 'total_files', 'file_types')
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: 'collections.OrderedDict[Any, tuple]' = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _digest(values: List[Any]) -> str:
+        return hashlib.sha1(json.dumps(values, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def file_digest(self, file_data) -> str:
+        values = [file_data.get(name) for name in self.FILE_FIELDS]
+        values[self.FILE_FIELDS.index('imports')] = (file_data.get('imports') or [])[:3]
+        values[self.FILE_FIELDS.index('functions')] = summary_function_names(file_data)
+        # The full summary leaves out the main program when the file's code comes as chunks
+        return self._digest(values + [bool(file_data.get('chunks'))])
+
+    def _get(self, key, render) -> tuple:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+        text = render()
+        entry = (text, count_tokens(text))
+        with self._lock:
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return entry
+
+    def file_summary(self, file_data, level: str = 'full', digest: Optional[str] = None) -> tuple:
+        """(text, tokens) of a file's summary at `level`; pass `digest` when asking for several levels"""
+        digest = digest or self.file_digest(file_data)
+        return self._get((digest, level), lambda: render_file_summary(file_data, level))
+
+    def file_summaries(self, file_data) -> Dict[str, tuple]:
+        """{level: (text, tokens)} for every level in SUMMARY_LEVELS"""
+        digest = self.file_digest(file_data)
+        return {level: self.file_summary(file_data, level, digest) for level in SUMMARY_LEVELS}
+
+    def folder_summary(self, folder_data: Dict[str, Any]) -> tuple:
+        digest = self._digest([folder_data.get(name) for name in self.FOLDER_FIELDS])
+        return self._get((digest, 'folder'), lambda: render_folder_summary(folder_data))
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+summary_cache = SummaryCache(DEFAULT_CONFIG['summaryCacheEntries'])
+
+# --- CONTEXT DEDUPLICATION ---
+# License headers, import blocks, generated stubs and copied config repeat
+# across files. While a context is packed, every run of at least
+# `dedupMinLines` code lines seen earlier in the same context is replaced by
+# a one-line reference to its first copy, before the piece's tokens are
+# charged to the budget. Only code is deduplicated (chunk bodies and fenced
+# excerpts), never the summary lines describing each file.
+DEDUP_HASH_BASE = 1000003
+DEDUP_HASH_MOD = (1 << 61) - 1
+
+class DedupStats:
+    """Blocks replaced and tokens saved by context deduplication, across requests"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.contexts = 0
+        self.deduplicated_contexts = 0
+        self.blocks = 0
+        self.tokens_saved = 0
+
+    def record(self, blocks: int, tokens_saved: int):
+        with self._lock:
+            self.contexts += 1
+            self.deduplicated_contexts += 1 if blocks else 0
+            self.blocks += blocks
+            self.tokens_saved += tokens_saved
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'contexts': self.contexts,
+                'deduplicated_contexts': self.deduplicated_contexts,
+                'blocks': self.blocks,
+                'tokens_saved': self.tokens_saved
+            }
+
+dedup_stats = DedupStats()
+
+class ContextDeduplicator:
+    """Windows of code lines already in one context, found with a rolling hash over whitespace-trimmed lines"""
+
+    def __init__(self, min_lines: Optional[int] = None):
+        self.min_lines = max(2, min_lines or DEFAULT_CONFIG.get('dedupMinLines', 4))
+        self._seen: Dict[int, str] = {}  # window hash -> where its first copy is
+        self.blocks = 0
+        self.tokens_saved = 0
+
+    def _windows(self, lines: List[str], code: List[int]) -> List[int]:
+        """Rolling hash of every `min_lines` consecutive code lines"""
+        k = self.min_lines
+        line_hashes = [hash(lines[index].strip()) % DEDUP_HASH_MOD for index in code]
+        top = pow(DEDUP_HASH_BASE, k - 1, DEDUP_HASH_MOD)
+        window = 0
+        hashes = []
+        for position, line_hash in enumerate(line_hashes):
+            if position >= k:
+                window = (window - line_hashes[position - k] * top) % DEDUP_HASH_MOD
+            window = (window * DEDUP_HASH_BASE + line_hash) % DEDUP_HASH_MOD
+            if position >= k - 1:
+                hashes.append(window)
+        return hashes
+
+    def dedupe(self, text: str, source: str, first_line: Optional[int] = None):
+        """Return (text with repeated blocks replaced, pending) without remembering anything yet.
+
+        With `first_line` the whole text is code starting at that line of
+        `source`; otherwise only lines inside ``` fences are considered.
+        Pass `pending` to commit() once the text is actually used.
+        """
+        lines = text.split('\n')
+        code = []
+        fenced = False
+        for index, line in enumerate(lines):
+            if first_line is None and line.lstrip().startswith('```'):
+                fenced = not fenced
+            elif (fenced or first_line is not None) and line.strip():
+                code.append(index)
+        if len(code) < self.min_lines:
+            return text, ([], 0)
+        hashes = self._windows(lines, code)
+        k = self.min_lines
+
+        duplicate = [False] * len(code)
+        for position, window in enumerate(hashes):
+            if window in self._seen:
+                duplicate[position:position + k] = [True] * k
+        new_windows = []
+        for position, window in enumerate(hashes):
+            if window not in self._seen and not duplicate[position]:
+                where = f"{source}:{first_line + code[position]}" if first_line is not None else source
+                new_windows.append((window, where))
+        if not any(duplicate):
+            return text, (new_windows, 0)
+
+        output = []
+        blocks = 0
+        position = 0
+        index = 0
+        while index < len(lines):
+            if position < len(code) and code[position] == index and duplicate[position]:
+                start = position
+                while position + 1 < len(code) and duplicate[position + 1]:
+                    position += 1
+                span = lines[code[start]:code[position] + 1]
+                marker = f"⋯ {len(span)} lines same as {self._seen[hashes[start]]} ⋯"
+                if sum(len(line) for line in span) > len(marker):
+                    indent = span[0][:len(span[0]) - len(span[0].lstrip())]
+                    output.append(indent + marker)
+                    blocks += 1
+                else:
+                    output.extend(span)
+                index = code[position] + 1
+                position += 1
+                continue
+            if position < len(code) and code[position] == index:
+                position += 1
+            output.append(lines[index])
+            index += 1
+        return '\n'.join(output), (new_windows, blocks)
+
+    def commit(self, pending, tokens_saved: int = 0):
+        """Remember a used text's windows as first copies, and count what deduplicating it saved"""
+        new_windows, blocks = pending
+        for window, where in new_windows:
+            self._seen.setdefault(window, where)
+        self.blocks += blocks
+        self.tokens_saved += max(0, tokens_saved)
+
+def build_context(analysis_results: Iterable[Dict[str, Any]], user_prompt: str, reserved_tokens: int = 0,
+                  report: Optional[Dict[str, Any]] = None) -> str:
+    """Create optimized context with token awareness, leaving `reserved_tokens` for e.g. conversation history.
+
+    Every folder and file gets a short summary first. The remaining budget is
+    then filled with whole code chunks (functions, classes, blocks) ranked by
+    relevance to the prompt; files without chunks fall back to their main program.
+    `analysis_results` may be an AnalysisPipeline: results are pulled one at a
+    time, and none are pulled once not even a one-line summary would fit.
+    Code repeated across files is emitted once (see ContextDeduplicator);
+    `report`, if given, receives the blocks replaced and tokens saved.
+    """
+    context_parts = []
+    chunked_files = []  # Files whose code is added as chunks, with their index in context_parts
+    chunked_part_index = []
+    total_tokens = 0
+    # Reserve space for the prompt, the largest system prompt template and the context framing
+    fixed_tokens = prompt_registry.max_token_count + prompt_registry.context_framing_tokens
+    max_context_tokens = DEFAULT_CONFIG.get('maxInputTokens', 6000) - count_tokens(user_prompt) - fixed_tokens - reserved_tokens
+
+    # The shortest summary any file gets; pulling (and analyzing) more is pointless once it no longer fits
+    min_summary_tokens = count_tokens("📄 File: x (text) - 0 tokens\n")
+    dedup = ContextDeduplicator() if DEFAULT_CONFIG.get('dedupMinLines', 4) else None
+    results = iter(analysis_results)
+    while True:
+        budget = model_call_budget()
+        if budget is not None and budget < DEFAULT_CONFIG.get('deadlineMinModelSeconds', 1.0):
+            # Leave the upstream call its minimum budget rather than summarize more files
+            log_event('context_deadline_reached', logging.WARNING, included=len(context_parts))
+            break
+        if max_context_tokens - total_tokens < min_summary_tokens:
+            log_event('context_budget_reached', included=len(context_parts))
+            break
+        result = next(results, None)
+        if result is None:
+            break
+        if result['type'] == 'folder':
+            folder_data = result['data']
+            if 'error' not in folder_data and 'skipped' not in folder_data:
+                folder_summary, folder_tokens = summary_cache.folder_summary(folder_data)
+                if total_tokens + folder_tokens <= max_context_tokens:
+                    context_parts.append(folder_summary)
+                    total_tokens += folder_tokens
+
+        elif result['type'] == 'file':
+            file_data = result['data']
+            if 'error' not in file_data:
+                # Take the most detailed summary that still fits; token counts come precomputed
+                digest = summary_cache.file_digest(file_data)
+                for level in SUMMARY_LEVELS:
+                    file_summary, file_tokens = summary_cache.file_summary(file_data, level, digest)
+                    pending = None
+                    saved = 0
+                    if dedup is not None and '```' in file_summary:
+                        # A main program excerpt copied from another file
+                        deduped, pending = dedup.dedupe(file_summary, file_data.get('file_path', file_data.get('name', '')))
+                        if deduped != file_summary:
+                            deduped_tokens = count_tokens(deduped)
+                            saved = file_tokens - deduped_tokens
+                            file_summary, file_tokens = deduped, deduped_tokens
+                    if total_tokens + file_tokens <= max_context_tokens:
+                        if file_data.get('chunks') and level != 'one_line':
+                            chunked_files.append(file_data)
+                            chunked_part_index.append(len(context_parts))
+                        context_parts.append(file_summary)
+                        total_tokens += file_tokens
+                        if pending is not None:
+                            dedup.commit(pending, saved)
+                        break
+
+    if chunked_files:
+        selected = select_chunks(chunked_files, user_prompt, max_context_tokens - total_tokens, dedup)
+        for file_index, chosen in selected.items():
+            # Chunks appear in source order under their file's summary
+            chosen.sort(key=lambda item: item[0].start_line)
+            part_index = chunked_part_index[file_index]
+            context_parts[part_index] += ''.join(rendered for _, rendered in chosen)
+
+    if dedup is not None:
+        dedup_stats.record(dedup.blocks, dedup.tokens_saved)
+        if dedup.blocks:
+            log_event('context_deduplicated', blocks=dedup.blocks, tokens_saved=dedup.tokens_saved)
+        if report is not None:
+            report.update(dedup_blocks=dedup.blocks, dedup_tokens_saved=dedup.tokens_saved)
+
+    # Combine context parts
+    return '\n\n'.join(context_parts)
+
+def collect_analyzed_files(analysis_results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Collect file information for response"""
+    analyzed_files = []
+    for result in analysis_results:
+        if result['type'] == 'file':
+            file_data = result['data']
+            file_info = {
+                'name': file_data.get('file_path', file_data.get('name', '')),
+                'language': file_data.get('language', 'unknown'),
+                'token_count': file_data.get('token_count', 0),
+                'lines': file_data.get('lines', 0),
+                'structure': file_data.get('structure', ''),
+                'degraded': file_data.get('degraded', False),
+                'skipped': file_data.get('skipped', None),
+                'duplicate_of': file_data.get('duplicate_of', None),
+                'error': file_data.get('error', None)
+            }
+            analyzed_files.append(file_info)
+        elif result['type'] == 'folder':
+            folder_data = result['data']
+            folder_info = {
+                'name': folder_data.get('folder_path', ''),
+                'type': 'folder',
+                'total_files': folder_data.get('total_files', 0),
+                'total_dirs': folder_data.get('total_dirs', 0),
+                'summary': folder_data.get('summary', ''),
+                'skipped': folder_data.get('skipped', None),
+                'error': folder_data.get('error', None)
+            }
+            analyzed_files.append(folder_info)
+    return analyzed_files
+
+def analysis_is_partial(analysis_results: List[Dict[str, Any]]) -> bool:
+    """True when any file was degraded to an outline or any input was skipped"""
+    return any(result['data'].get('degraded') or result['data'].get('skipped') for result in analysis_results)
+
+def partial_analysis_response(user_prompt: str, context: str, analysis_results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Return the analysis gathered so far when no time is left for the model"""
+    analysis_msg = "The request deadline was reached before the model could answer. Returning the file analysis only."
+    response = analysis_message_response(user_prompt, analysis_msg)
+    response.update({
+        'partial': True,
+        'context_tokens': count_tokens(context),
+        'total_analyzed': len(analysis_results),
+        'analyzed_files': collect_analyzed_files(analysis_results)
+    })
+    return response
+
+def generate_analysis_response(user_prompt: str, context: str, analysis_results: List[Dict[str, Any]],
+                               history: Optional[List[Dict[str, str]]] = None, history_tokens: int = 0) -> Dict[str, Any]:
+    """Call the model for one prompt and shape the result like /api/analyze-and-execute"""
+    budget = model_call_budget()
+    if budget is not None and budget < DEFAULT_CONFIG.get('deadlineMinModelSeconds', 1.0):
+        log_event('model_skipped_deadline', logging.WARNING, budget_ms=round(budget * 1000, 1))
+        return partial_analysis_response(user_prompt, context, analysis_results)
+
+    # Generate comprehensive response with analyze-think-execute approach
+    output_report = {}
+    model_output = model_client.generate_full_response(user_prompt, context, history, history_tokens, output_report)
+
+    # Parse the response into structured sections
+    try:
+        sections = model_client.parse_response_sections(model_output)
+    except Exception as parse_error:
+        analysis_msg = f"Sorry, I was unable to process the model's response. ({str(parse_error)})"
+        return analysis_message_response(user_prompt, analysis_msg)
+
+    # If the model_output is an error message (starts with 'Error:'), handle gracefully
+    if isinstance(model_output, str) and model_output.strip().lower().startswith('error:'):
+        budget = model_call_budget()
+        if budget is not None and budget <= 0:
+            # The upstream call ran out the clock: the analysis is still worth returning
+            return partial_analysis_response(user_prompt, context, analysis_results)
+        analysis_msg = f"Sorry, I was unable to generate a response for your request. {model_output}"
+        return analysis_message_response(user_prompt, analysis_msg)
+
+    analyzed_files = collect_analyzed_files(analysis_results)
+    log_event('model_response', output=model_output, sections=sections)
+    return {
+        'success': True,
+        'type': 'analysis',
+        'output': model_output,
+        'sections': sections,
+        'prompt': user_prompt,
+        'context_tokens': count_tokens(context),
+        'total_analyzed': len(analysis_results),
+        'analyzed_files': analyzed_files,
+        # A cut-off answer is returned but, being partial, never stored as a session turn
+        'partial': analysis_is_partial(analysis_results) or output_report.get('truncated', False),
+        'truncated': output_report.get('truncated', False),
+        'files': sections.get('files', [])  # New: add files array to response
+    }
+
+# --- CONVERSATION SESSIONS ---
+# A session keeps analyzed files (with their code chunks) and prior turns on
+# the server, so follow-up turns only upload and re-analyze what changed.
+
+class ConversationSession:
+    """Analyzed inputs and prior turns of one conversation"""
+
+    def __init__(self, session_id: str):
+        self.id = session_id
+        self.created = time.time()
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()  # One turn or attach at a time
+        self.in_use = 0  # Requests holding the session; guarded by the store's lock
+        self.retired = False  # Deleted or evicted while in use; closed when the last request releases it
+        self.entries: Dict[str, Dict[str, Any]] = {}  # key -> {'fingerprint', 'result', 'size', 'upload'}
+        self.turns: collections.deque = collections.deque()  # {'role', 'content', 'tokens'}
+        self.analysis_bytes = 0
+        self.turn_bytes = 0
+
+    @property
+    def size(self) -> int:
+        return self.analysis_bytes + self.turn_bytes
+
+    def analysis_results(self) -> List[Dict[str, Any]]:
+        return [entry['result'] for entry in self.entries.values()]
+
+    def put(self, key: str, fingerprint: str, result: Dict[str, Any], max_bytes: int, upload: Optional[str] = None) -> bool:
+        """Store an analysis result, or return False if it would not fit in `max_bytes` of analysis.
+
+        `upload` is the temp file an uploaded file's record reads its chunks
+        from; the session owns it from here on and removes it with the entry.
+        """
+        data = result['data']
+        size = len(json.dumps(data.to_dict() if isinstance(data, AnalysisRecord) else data, default=str))
+        previous = self.entries.get(key)
+        if self.analysis_bytes - (previous['size'] if previous else 0) + size > max_bytes:
+            return False
+        self.remove(key)
+        self.entries[key] = {'fingerprint': fingerprint, 'result': result, 'size': size, 'upload': upload}
+        self.analysis_bytes += size
+        return True
+
+    def remove(self, key: str) -> bool:
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return False
+        self.analysis_bytes -= entry['size']
+        if entry['upload']:
+            remove_temp_files([entry['upload']])
+        return True
+
+    def close(self):
+        """Remove the session's uploaded files once it is deleted or evicted"""
+        remove_temp_files([entry['upload'] for entry in self.entries.values() if entry['upload']])
+
+    def add_turn(self, prompt: str, output: str, max_bytes: int):
+        for role, content in (('user', prompt), ('assistant', output)):
+            self.turns.append({'role': role, 'content': content, 'tokens': count_tokens(content)})
+            self.turn_bytes += len(content)
+        self.trim(max_bytes)
+
+    def trim(self, max_bytes: int):
+        # Oldest turns go first when the session is over its memory cap
+        while self.size > max_bytes and self.turns:
+            self.turn_bytes -= len(self.turns.popleft()['content'])
+
+    def history(self, max_tokens: int):
+        """Most recent whole turns within `max_tokens`, as (messages, token_count)"""
+        messages = []
+        total = 0
+        turns = list(self.turns)
+        for index in range(len(turns) - 2, -1, -2):
+            pair = turns[index:index + 2]
+            tokens = sum(turn['tokens'] for turn in pair)
+            if total + tokens > max_tokens:
+                break
+            messages[:0] = [{'role': turn['role'], 'content': turn['content']} for turn in pair]
+            total += tokens
+        return messages, total
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            'session_id': self.id,
+            'created': self.created,
+            'idle_seconds': round(time.monotonic() - self.last_used, 1),
+            'attached': sorted(self.entries),
+            'turns': len(self.turns) // 2,
+            'bytes': self.size
+        }
+
+class SessionStore:
+    """Bounded set of conversation sessions with idle and least-recently-used eviction.
+
+    Requests check a session out for the length of an attach or turn. Sessions
+    that are checked out are never evicted, and a deleted one is only closed
+    (its uploads removed) once the last request releases it.
+    """
+
+    def __init__(self, max_sessions: int, idle_seconds: float):
+        self.max_sessions = max_sessions
+        self.idle_seconds = idle_seconds
+        self._sessions: 'collections.OrderedDict[str, ConversationSession]' = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.evicted_idle = 0
+        self.evicted_capacity = 0
+
+    def _sweep(self, now: float):
+        for session_id in [sid for sid, s in self._sessions.items()
+                           if not s.in_use and now - s.last_used > self.idle_seconds]:
+            self._sessions.pop(session_id).close()
+            self.evicted_idle += 1
+
+    def create(self) -> ConversationSession:
+        """A new session, checked out to the caller"""
+        session = ConversationSession(uuid.uuid4().hex)
+        session.in_use = 1
+        with self._lock:
+            self._sweep(time.monotonic())
+            # Least recently used first; while every session is busy the store runs over its cap
+            idle = [sid for sid, s in self._sessions.items() if not s.in_use]
+            for session_id in idle[:max(0, len(self._sessions) - self.max_sessions + 1)]:
+                self._sessions.pop(session_id).close()
+                self.evicted_capacity += 1
+            self._sessions[session.id] = session
+            self.created += 1
+        return session
+
+    def checkout(self, session_id: str) -> Optional[ConversationSession]:
+        """Like get(), but the session is not evicted or closed until release()"""
+        with self._lock:
+            session = self._get(session_id)
+            if session is not None:
+                session.in_use += 1
+            return session
+
+    def release(self, session: ConversationSession):
+        with self._lock:
+            session.in_use -= 1
+            session.last_used = time.monotonic()
+            close = session.retired and not session.in_use
+        if close:
+            session.close()
+
+    def _get(self, session_id: str) -> Optional[ConversationSession]:
+        now = time.monotonic()
+        self._sweep(now)
+        session = self._sessions.get(session_id)
+        if session is not None:
+            session.last_used = now
+            self._sessions.move_to_end(session_id)
+        return session
+
+    def get(self, session_id: str) -> Optional[ConversationSession]:
+        with self._lock:
+            return self._get(session_id)
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+            if session is None:
+                return False
+            session.retired = True
+            if session.in_use:
+                return True
+        session.close()
+        return True
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            self._sweep(time.monotonic())
+            return {
+                'active': len(self._sessions),
+                'in_use': sum(1 for session in self._sessions.values() if session.in_use),
+                'created': self.created,
+                'evicted_idle': self.evicted_idle,
+                'evicted_capacity': self.evicted_capacity,
+                'bytes': sum(session.size for session in self._sessions.values())
+            }
+
+session_store = SessionStore(DEFAULT_CONFIG['maxSessions'], DEFAULT_CONFIG['sessionIdleSeconds'])
+
+def attach_session_inputs(session: ConversationSession, data: Dict[str, Any]) -> Dict[str, Any]:
+    """Apply a files/folders/remove delta to a session, analyzing only new or changed inputs.
+
+    Uploaded files are keyed by `relativePath` or `name` and fingerprinted by
+    the SHA-256 of their bytes; a client may send {"name", "sha256"} without
+    content for a file it already uploaded. Path files are fingerprinted by
+    mtime and size, and folders are walked once unless `refresh` is set.
+    Inputs that would push the session's analysis past `sessionMaxBytes`
+    are reported as rejected. `analysis_ms` is the time spent here, which
+    clients uploading in several requests add up against their own.
+    """
+    start = time.perf_counter()
+    summary = {'analyzed': [], 'unchanged': [], 'missing': [], 'removed': [], 'rejected': []}
+    max_bytes = DEFAULT_CONFIG['sessionMaxBytes']
+    for key in data.get('remove') or []:
+        if session.remove(key):
+            summary['removed'].append(key)
+
+    analyzer, deadline, tight = analysis_stage()
+    temp_files = []
+    try:
+        for folder_info in data.get('folders') or []:
+            folder_path = folder_info.get('path')
+            if not folder_path or not os.path.exists(folder_path):
+                continue
+            key = f"folder:{folder_path}"
+            if key in session.entries and not folder_info.get('refresh'):
+                summary['unchanged'].append(key)
+                continue
+            folder_analysis = analyze_folder_with_budget(analyzer, folder_path, deadline, tight)
+            if session.put(key, '', {'type': 'folder', 'data': folder_analysis}, max_bytes):
+                summary['analyzed'].append(key)
+            else:
+                summary['rejected'].append(key)
+
+        for file_info in data.get('files') or []:
+            if 'path' in file_info and os.path.exists(file_info['path']):
+                key = file_path = file_info['path']
+                stat = os.stat(file_path)
+                fingerprint = f"{stat.st_mtime_ns}:{stat.st_size}"
+                language = file_info.get('language', 'unknown')
+            elif 'name' in file_info:
+                key = file_info.get('relativePath') or file_info['name']
+                if 'content' not in file_info:
+                    entry = session.entries.get(key)
+                    if entry is not None and entry['fingerprint'] == file_info.get('sha256'):
+                        summary['unchanged'].append(key)
+                    else:
+                        summary['missing'].append(key)
+                    continue
+                file_bytes = base64.b64decode(file_info['content'])
+                fingerprint = hashlib.sha256(file_bytes).hexdigest()
+                file_path = None
+                # Folder uploads carry everything the workspace walker picks, Java and C included
+                language = WORKSPACE_LANGUAGES.get(os.path.splitext(file_info['name'])[1].lower(), 'unknown')
+            else:
+                continue
+
+            entry = session.entries.get(key)
+            if entry is not None and entry['fingerprint'] == fingerprint:
+                summary['unchanged'].append(key)
+                continue
+            upload = None
+            if file_path is None:
+                file_path = upload = write_upload(file_bytes, file_info['name'], temp_files)
+                result = analyze_file_with_budget(analyzer, file_path, language, deadline)
+            else:
+                result = workspace_registry.lookup_file(file_path) or analyze_file_with_budget(analyzer, file_path, language, deadline)
+            # Name uploads by their client path, not the temp file holding their bytes
+            result = result.with_path(key)
+            if session.put(key, fingerprint, {'type': 'file', 'data': result}, max_bytes, upload):
+                if upload:
+                    temp_files.remove(upload)
+                summary['analyzed'].append(key)
+            else:
+                summary['rejected'].append(key)
+    finally:
+        remove_temp_files(temp_files)
+
+    session.trim(max_bytes)
+    summary['analysis_ms'] = round((time.perf_counter() - start) * 1000, 1)
+    return summary
+
+# --- WORKSPACE INDEXING ---
+# Registered folders are walked and analyzed in the background and kept warm
+# by a watcher, so requests that reference them only pay for a stat and a
+# dictionary lookup.
+
+WORKSPACE_LANGUAGES = dict(UPLOAD_LANGUAGES, **{'.java': 'java', '.c': 'c', '.h': 'c'})
+WORKSPACE_CHANGE_EVENTS = ('created', 'deleted', 'modified', 'moved')  # watchdog event types that change the tree
+
+def workspace_walk_rules() -> Dict[str, Any]:
+    """What the workspace walker indexes, so clients collecting a folder themselves pick the same files"""
+    return {
+        'ignoreDirs': list(DEFAULT_CONFIG['workspaceIgnoreDirs']),
+        'ignoreHidden': True,
+        'extensions': sorted(WORKSPACE_LANGUAGES),
+        'maxFiles': DEFAULT_CONFIG['workspaceMaxFiles'],
+        'maxFileBytes': DEFAULT_CONFIG['workspaceMaxFileBytes']
+    }
+
+class WorkspaceIndex:
+    """Warm analysis results for one registered folder"""
+
+    def __init__(self, root: str):
+        self.root = root
+        self.id = hashlib.sha1(root.encode('utf-8')).hexdigest()[:12]
+        self.registered = time.time()
+        self.files: Dict[str, Dict[str, Any]] = {}  # path -> {'mtime_ns', 'size', 'language', 'result'}
+        self.pending: Dict[str, float] = {}  # path -> time.monotonic() the change was seen
+        self.structure: Optional[Dict[str, Any]] = None
+        self.structure_stale = True
+        self.rescan_requested = True
+        self.next_scan = 0.0
+        self.watch_mode = 'polling'
+        self.observer = None
+        self.state = 'scanning'
+        self.error: Optional[str] = None
+        self.skipped = 0
+        self.hits = 0
+        self.misses = 0
+        self.last_indexed: Optional[float] = None
+
+    def contains(self, path: str) -> bool:
+        return path == self.root or path.startswith(self.root + os.sep)
+
+    def visible(self, path: str, is_directory: bool = False) -> bool:
+        """Whether the walker would reach `path`: it is not hidden and not inside (or itself) an ignored directory"""
+        if path == self.root:
+            return True
+        rel_parts = os.path.relpath(path, self.root).split(os.sep)
+        if rel_parts[0] == os.pardir:
+            return False
+        ignored = set(DEFAULT_CONFIG['workspaceIgnoreDirs'])
+        if any(part.startswith('.') or part in ignored for part in rel_parts[:-1]) or rel_parts[-1].startswith('.'):
+            return False
+        return not (is_directory and rel_parts[-1] in ignored)
+
+    def wanted(self, path: str) -> bool:
+        """Only source files outside hidden and ignored directories are indexed"""
+        return self.visible(path) and os.path.splitext(path)[1].lower() in WORKSPACE_LANGUAGES
+
+    def scan(self) -> Dict[str, os.stat_result]:
+        """Walk the tree and return the stat of every file that should be indexed"""
+        found = {}
+        ignored = set(DEFAULT_CONFIG['workspaceIgnoreDirs'])
+        limit = DEFAULT_CONFIG['workspaceMaxFiles']
+        for root, dirs, names in os.walk(self.root):
+            dirs[:] = [d for d in dirs if not d.startswith('.') and d not in ignored]
+            for name in names:
+                path = os.path.join(root, name)
+                if name.startswith('.') or os.path.splitext(name)[1].lower() not in WORKSPACE_LANGUAGES:
+                    continue
                 try:
-                    os.remove(temp_path)
-                except Exception:
-                    pass
+                    found[path] = os.stat(path)
+                except OSError:
+                    continue
+                if len(found) >= limit:
+                    return found
+        return found
+
+    def describe(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        indexed = sum(1 for entry in self.files.values() if entry.get('result') is not None)
+        return {
+            'id': self.id,
+            'path': self.root,
+            'state': self.state,
+            'error': self.error,
+            'watch': self.watch_mode,
+            'files_indexed': indexed,
+            'files_total': len(self.files),
+            'files_skipped': self.skipped,
+            'pending': len(self.pending),
+            'lag_seconds': round(now - min(self.pending.values()), 2) if self.pending else 0.0,
+            'last_indexed_at': self.last_indexed,
+            'lookups': {'hits': self.hits, 'misses': self.misses}
+        }
+
+class WorkspaceRegistry:
+    """Registered workspaces and the single background thread that indexes them.
+
+    The indexer analyzes one file at a time through the analysis worker pool
+    and then sleeps so it stays within `workspaceIndexDutyCycle` of one core;
+    rescans and folder-structure rebuilds are charged the same way. Changes
+    come from watchdog (inotify/FSEvents/ReadDirectoryChangesW) when it is
+    installed, or from a rescan every `workspacePollSeconds`. Events under
+    hidden or ignored directories are dropped before they cost anything. A
+    failing rescan, file or rebuild marks its workspace 'error' and the
+    indexer carries on with the rest.
+    """
 
-        # Generate comprehensive response with analyze-think-execute approach
-        model_output = model_client.generate_full_response(user_prompt, context)
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.workspaces: Dict[str, WorkspaceIndex] = {}
+
+    def register(self, path: str) -> WorkspaceIndex:
+        root = os.path.realpath(path)
+        with self._lock:
+            for workspace in self.workspaces.values():
+                if workspace.root == root:
+                    return workspace
+            workspace = WorkspaceIndex(root)
+            self.workspaces[workspace.id] = workspace
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='workspace-indexer', daemon=True)
+                self._thread.start()
+        self._start_watcher(workspace)
+        self._wake.set()
+        log_event('workspace_registered', path=root, watch=workspace.watch_mode)
+        return workspace
+
+    def unregister(self, workspace_id: str) -> bool:
+        with self._lock:
+            workspace = self.workspaces.pop(workspace_id, None)
+        if workspace is None:
+            return False
+        if workspace.observer is not None:
+            workspace.observer.stop()
+        return True
 
-        # Parse the response into structured sections
+    def get(self, workspace_id: str) -> Optional[WorkspaceIndex]:
+        with self._lock:
+            return self.workspaces.get(workspace_id)
+
+    def _start_watcher(self, workspace: WorkspaceIndex):
         try:
-            sections = model_client.parse_response_sections(model_output)
-        except Exception as parse_error:
-            analysis_msg = f"Sorry, I was unable to process the model's response. ({str(parse_error)})"
-            return jsonify({
-                'success': True,
-                'type': 'analysis',
-                'output': analysis_msg,
-                'sections': minimal_sections_response(analysis_msg),
-                'prompt': user_prompt,
-                'context_tokens': 0,
-                'total_analyzed': 0,
-                'analyzed_files': [],
-                'files': []
+            from watchdog.observers import Observer
+            from watchdog.events import FileSystemEventHandler
+        except ImportError:
+            return  # Polling fallback
+
+        registry = self
+
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                paths = [path for path in (event.src_path, getattr(event, 'dest_path', '')) if path]
+                if registry._on_change(workspace, event.event_type, paths, event.is_directory):
+                    registry._wake.set()
+
+        try:
+            observer = Observer()
+            observer.schedule(Handler(), workspace.root, recursive=True)
+            observer.daemon = True
+            observer.start()
+        except Exception as e:
+            log_event('workspace_watch_failed', logging.WARNING, path=workspace.root, error=str(e))
+            return
+        workspace.observer = observer
+        workspace.watch_mode = 'watchdog'
+
+    def _on_change(self, workspace: WorkspaceIndex, event_type: str, paths: List[str], is_directory: bool) -> bool:
+        """Apply one watcher event; returns whether the indexer has anything new to do"""
+        if event_type not in WORKSPACE_CHANGE_EVENTS:
+            return False  # opened/closed without writing
+        if is_directory and event_type == 'modified':
+            return False  # Reported for the parent of every changed file, which has its own event
+        visible = [path for path in paths if workspace.visible(path, is_directory)]
+        if not visible:
+            return False
+        with self._lock:
+            if is_directory:
+                # A created or moved directory may hold many files: rescan it all
+                workspace.rescan_requested = True
+            else:
+                for path in visible:
+                    if workspace.wanted(path):
+                        workspace.pending.setdefault(path, time.monotonic())
+            workspace.structure_stale = True
+        return True
+
+    def _reconcile(self, workspace: WorkspaceIndex):
+        """Diff a full scan against the index and queue what changed"""
+        found = workspace.scan()
+        now = time.monotonic()
+        with self._lock:
+            for path in [p for p in workspace.files if p not in found]:
+                del workspace.files[path]
+                workspace.pending.pop(path, None)
+                workspace.structure_stale = True
+            for path, stat in found.items():
+                entry = workspace.files.get(path)
+                if entry is None or entry['mtime_ns'] != stat.st_mtime_ns or entry['size'] != stat.st_size:
+                    workspace.pending.setdefault(path, now)
+                    workspace.structure_stale = True
+            workspace.rescan_requested = False
+            if workspace.state in ('scanning', 'error'):
+                workspace.state = 'indexing'
+
+    def _next_job(self):
+        """Oldest pending change across all workspaces"""
+        with self._lock:
+            best = None
+            for workspace in self.workspaces.values():
+                for path, seen in workspace.pending.items():
+                    if best is None or seen < best[2]:
+                        best = (workspace, path, seen)
+            return best
+
+    def _index_file(self, workspace: WorkspaceIndex, path: str):
+        with self._lock:
+            workspace.pending.pop(path, None)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            with self._lock:
+                workspace.files.pop(path, None)
+            return
+        language = WORKSPACE_LANGUAGES.get(os.path.splitext(path)[1].lower(), 'unknown')
+        entry = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'language': language, 'result': None}
+        if stat.st_size > DEFAULT_CONFIG['workspaceMaxFileBytes']:
+            workspace.skipped += 1
+        else:
+            entry['result'] = analyze_file_with_budget(ASTContextAnalyzer(), path, language, float('inf'))
+            if token_estimator.needs_calibration(language):
+                # Indexing runs off the request path: a good time to learn the language's token ratio
+                content = entry['result'].content_ref.load() if entry['result'].content_ref else None
+                if content:
+                    token_estimator.count(content, language)
+        with self._lock:
+            if workspace.id in self.workspaces:
+                workspace.files[path] = entry
+                workspace.last_indexed = time.time()
+
+    @staticmethod
+    def _throttle(start: float):
+        """Sleep off the work since `start` so indexing stays within the duty cycle and never starves request handling"""
+        duty = min(max(DEFAULT_CONFIG['workspaceIndexDutyCycle'], 0.05), 1.0)
+        time.sleep((time.monotonic() - start) * (1.0 - duty) / duty)
+
+    def _failed(self, workspace: WorkspaceIndex, event: str, error: Exception, **fields):
+        with self._lock:
+            workspace.state = 'error'
+            workspace.error = str(error)
+        log_event(event, logging.ERROR, path=workspace.root, error=str(error), **fields)
+
+    def _run(self):
+        # Background indexing must never delay a request
+        request_priority_var.set('bulk')
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                workspaces = list(self.workspaces.values())
+            for workspace in workspaces:
+                if workspace.rescan_requested or (workspace.watch_mode == 'polling' and now >= workspace.next_scan):
+                    start = time.monotonic()
+                    try:
+                        self._reconcile(workspace)
+                    except Exception as e:
+                        self._failed(workspace, 'workspace_scan_failed', e)
+                    workspace.next_scan = time.monotonic() + DEFAULT_CONFIG['workspacePollSeconds']
+                    self._throttle(start)
+
+            job = self._next_job()
+            if job is not None:
+                start = time.monotonic()
+                try:
+                    self._index_file(job[0], job[1])
+                except Exception as e:
+                    with self._lock:
+                        job[0].pending.pop(job[1], None)  # Retried on the next rescan, not in a loop
+                    self._failed(job[0], 'workspace_index_failed', e, file=job[1])
+                self._throttle(start)
+                continue
+
+            for workspace in workspaces:
+                if workspace.structure_stale and workspace.state != 'scanning':
+                    start = time.monotonic()
+                    try:
+                        workspace.structure = ASTContextAnalyzer().analyze_folder_structure(
+                            workspace.root, set(DEFAULT_CONFIG['workspaceIgnoreDirs']))
+                        workspace.structure_stale = False
+                    except Exception as e:
+                        self._failed(workspace, 'workspace_index_failed', e, file=workspace.root)
+                    self._throttle(start)
+                if workspace.state == 'indexing' and not workspace.pending:
+                    workspace.state = 'ready'
+                    log_event('workspace_ready', path=workspace.root, files=len(workspace.files))
+            self._wake.wait(timeout=DEFAULT_CONFIG['workspacePollSeconds'])
+            self._wake.clear()
+
+    def lookup_file(self, path: str) -> Optional[AnalysisRecord]:
+        """Cached analysis of a file in a registered workspace, if it is still current"""
+        if not self.workspaces:
+            return None
+        real = os.path.realpath(path)
+        with self._lock:
+            workspace = next((w for w in self.workspaces.values() if w.contains(real)), None)
+            entry = workspace.files.get(real) if workspace else None
+        if workspace is None:
+            return None
+        try:
+            stat = os.stat(real)
+        except OSError:
+            return None
+        current = entry is not None and entry['result'] is not None and \
+            entry['mtime_ns'] == stat.st_mtime_ns and entry['size'] == stat.st_size
+        with self._lock:
+            if current:
+                workspace.hits += 1
+            else:
+                workspace.misses += 1
+        return entry['result'].with_path(path) if current else None
+
+    def lookup_folder(self, path: str) -> Optional[Dict[str, Any]]:
+        """Cached folder structure of a registered workspace root"""
+        if not self.workspaces:
+            return None
+        real = os.path.realpath(path)
+        with self._lock:
+            workspace = next((w for w in self.workspaces.values() if w.root == real), None)
+            if workspace is None or workspace.structure is None or workspace.structure_stale:
+                return None
+            workspace.hits += 1
+            return dict(workspace.structure, folder_path=path)
+
+    def describe(self, workspace: WorkspaceIndex) -> Dict[str, Any]:
+        with self._lock:
+            return workspace.describe()
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [workspace.describe() for workspace in self.workspaces.values()]
+
+workspace_registry = WorkspaceRegistry()
+
+# --- ADMISSION CONTROL ---
+# Model-bound requests get one of `maxConcurrentRequests` slots. Up to
+# `admissionQueueSize` more wait for one in arrival order; anything beyond
+# that is shed at once with 429 and a Retry-After derived from how fast the
+# queue has been draining, so overload degrades instead of piling up.
+
+class AdmissionRejected(Exception):
+    """Raised when a request is shed; `retry_after` is the suggested wait in seconds"""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+class AdmissionController:
+    """A concurrency limit with a bounded, weighted-fair priority wait queue"""
+
+    def __init__(self, max_concurrent: int, queue_size: int, max_wait: float, rate_window: float):
+        self.max_concurrent = max(1, max_concurrent)
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.rate_window = rate_window
+        self.bulk_cap = bulk_limit(self.max_concurrent)
+        self._cond = threading.Condition()
+        self._waiters = FairQueue(DEFAULT_CONFIG.get('priorityWeights', {}))
+        self._completions = collections.deque()  # time.monotonic() of recent releases
+        self.active = 0
+        self.active_by_priority = collections.Counter()
+        self.waited_by_priority = collections.Counter()
+        self.wait_by_priority = collections.Counter()
+        # Metrics
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = collections.Counter()
+        self.max_queue_depth = 0
+        self.total_wait = 0.0
+        self.max_wait_seen = 0.0
+
+    def _drain_rate(self, now: float) -> float:
+        """Releases per second over the rate window, or 0.0 without history"""
+        while self._completions and now - self._completions[0] > self.rate_window:
+            self._completions.popleft()
+        if len(self._completions) < 2:
+            return 0.0
+        return len(self._completions) / max(now - self._completions[0], 1e-3)
+
+    def _retry_after(self, now: float) -> int:
+        # Time for everyone already queued, plus this request, to get a slot
+        rate = self._drain_rate(now)
+        seconds = (len(self._waiters) + 1) / rate if rate else self.max_wait
+        return int(min(max(math.ceil(seconds), 1), 120))
+
+    def _eligible(self, priority: str) -> bool:
+        return priority != 'bulk' or self.active_by_priority['bulk'] < self.bulk_cap
+
+    def _admit(self, priority: str):
+        self.active += 1
+        self.active_by_priority[priority] += 1
+        self.admitted += 1
+
+    def acquire(self, max_wait: Optional[float] = None, priority: str = 'normal'):
+        """Take a slot, queueing up to `max_wait` seconds; raise AdmissionRejected when shed"""
+        limit = self.max_wait if max_wait is None else max(0.0, min(self.max_wait, max_wait))
+        start = time.monotonic()
+        with self._cond:
+            if self.active < self.max_concurrent and not self._waiters and self._eligible(priority):
+                self._admit(priority)
+                return
+            if len(self._waiters) >= self.queue_size:
+                self.rejected['queue_full'] += 1
+                raise AdmissionRejected('queue_full', self._retry_after(start))
+            ticket = object()
+            self._waiters.push(ticket, priority)
+            self.queued += 1
+            self.max_queue_depth = max(self.max_queue_depth, len(self._waiters))
+            try:
+                while not (self.active < self.max_concurrent and self._waiters.head(self._eligible) is ticket):
+                    remaining = limit - (time.monotonic() - start)
+                    if remaining <= 0:
+                        self.rejected['wait_timeout'] += 1
+                        raise AdmissionRejected('wait_timeout', self._retry_after(time.monotonic()))
+                    self._cond.wait(timeout=remaining)
+                self._waiters.served(ticket)
+                self._admit(priority)
+            finally:
+                self._waiters.remove(ticket)
+                self._cond.notify_all()
+            waited = time.monotonic() - start
+            self.total_wait += waited
+            self.max_wait_seen = max(self.max_wait_seen, waited)
+            self.waited_by_priority[priority] += 1
+            self.wait_by_priority[priority] += waited
+
+    def release(self, priority: str = 'normal'):
+        with self._cond:
+            self.active -= 1
+            self.active_by_priority[priority] -= 1
+            self._completions.append(time.monotonic())
+            self._cond.notify_all()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._cond:
+            now = time.monotonic()
+            return {
+                'active': self.active,
+                'max_concurrent': self.max_concurrent,
+                'queue_depth': len(self._waiters),
+                'max_queue_depth': self.max_queue_depth,
+                'admitted': self.admitted,
+                'queued': self.queued,
+                'rejected': sum(self.rejected.values()),
+                'rejected_by_reason': dict(self.rejected),
+                'avg_wait_ms': (self.total_wait / self.queued * 1000) if self.queued else 0.0,
+                'max_wait_ms': self.max_wait_seen * 1000,
+                'drain_rate_per_second': round(self._drain_rate(now), 3),
+                'retry_after_seconds': self._retry_after(now),
+                'bulk_cap': self.bulk_cap,
+                'by_priority': {
+                    priority: {
+                        'active': self.active_by_priority[priority],
+                        'queue_depth': self._waiters.depth(priority),
+                        'avg_wait_ms': (self.wait_by_priority[priority] / self.waited_by_priority[priority] * 1000)
+                        if self.waited_by_priority[priority] else 0.0
+                    }
+                    for priority in PRIORITIES
+                }
+            }
+
+admission = AdmissionController(DEFAULT_CONFIG['maxConcurrentRequests'], DEFAULT_CONFIG['admissionQueueSize'],
+                                DEFAULT_CONFIG['admissionMaxWait'], DEFAULT_CONFIG['admissionRateWindow'])
+
+def admission_controlled(view):
+    """Run a model-bound view under admission control; shed requests get 429 with Retry-After"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        priority = request_priority_var.get()
+        try:
+            # Never queue past the client's own deadline
+            admission.acquire(deadline_remaining(), priority)
+        except AdmissionRejected as rejected:
+            log_event('request_shed', logging.WARNING, reason=rejected.reason, retry_after=rejected.retry_after)
+            response = jsonify({
+                'success': False,
+                'error': 'Server is overloaded, retry later',
+                'retry_after': rejected.retry_after
             })
+            response.status_code = 429
+            response.headers['Retry-After'] = str(rejected.retry_after)
+            return response
+        streaming = False
+        try:
+            response = view(*args, **kwargs)
+            if isinstance(response, Response) and response.is_streamed:
+                # A streamed batch keeps calling the model after the view returns
+                response.call_on_close(lambda: admission.release(priority))
+                streaming = True
+            return response
+        finally:
+            if not streaming:
+                admission.release(priority)
+    return wrapper
 
-        # If the model_output is an error message (starts with 'Error:'), handle gracefully
-        if isinstance(model_output, str) and model_output.strip().lower().startswith('error:'):
-            analysis_msg = f"Sorry, I was unable to generate a response for your request. {model_output}"
-            return jsonify({
-                'success': True,
-                'type': 'analysis',
-                'output': analysis_msg,
-                'sections': minimal_sections_response(analysis_msg),
-                'prompt': user_prompt,
-                'context_tokens': 0,
-                'total_analyzed': 0,
-                'analyzed_files': [],
-                'files': []
+# --- MEMORY DIAGNOSTICS ---
+# tracemalloc is off by default and costs nothing until an admin starts it
+# through /api/debug/memory. While tracing, allocation sites are reported
+# grouped by module and function, named snapshots can be diffed, and each
+# request records how far it raised the traced peak.
+
+def _module_name(filename: str) -> str:
+    """Dotted module name for a source file, relative to the longest matching sys.path entry"""
+    best = ''
+    for entry in sys.path:
+        entry = os.path.abspath(entry or '.')
+        if filename.startswith(entry + os.sep) and len(entry) > len(best):
+            best = entry
+    relative = filename[len(best) + 1:] if best else os.path.basename(filename)
+    module = os.path.splitext(relative)[0].replace(os.sep, '.')
+    return module[:-len('.__init__')] if module.endswith('.__init__') else module
+
+@functools.lru_cache(maxsize=512)
+def _function_spans(filename: str) -> tuple:
+    """(start, end, qualified name) of every function and class in a source file, innermost last"""
+    # Read directly: linecache would keep every source around and show up in the report itself
+    try:
+        with open(filename, 'rb') as f:
+            tree = ast.parse(f.read())
+    except (OSError, SyntaxError, ValueError):
+        return ()
+    spans = []
+
+    def visit(node, prefix):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                name = f"{prefix}{child.name}"
+                spans.append((child.lineno, child.end_lineno or child.lineno, name))
+                visit(child, name + '.')
+            else:
+                visit(child, prefix)
+
+    visit(tree, '')
+    return tuple(spans)
+
+def allocation_site(filename: str, lineno: int, group: str) -> str:
+    """`module` or `module:function` for a traced allocation frame"""
+    module = _module_name(filename)
+    if group == 'module':
+        return module
+    function = '<module>'
+    for start, end, name in _function_spans(filename):
+        if start <= lineno <= end:
+            function = name  # Later spans are nested deeper
+    return f"{module}:{function}"
+
+class MemoryProfiler:
+    """Admin-controlled tracemalloc sessions, named snapshots and per-request peak memory"""
+
+    SNAPSHOT_FILTERS = (
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+        tracemalloc.Filter(False, '<unknown>'),
+    )
+
+    def __init__(self, max_snapshots: int, request_history: int):
+        self.max_snapshots = max_snapshots
+        self._lock = threading.Lock()
+        self._snapshots = collections.OrderedDict()  # label -> (taken_at, tracemalloc.Snapshot)
+        self._requests = collections.deque(maxlen=request_history)
+        self._by_endpoint: Dict[str, Dict[str, float]] = {}
+        self._in_flight = 0
+        self._overlapped = False  # Another request ran alongside since tracing was last idle
+        self.started_at: Optional[float] = None
+        self.frames = 0
+
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self, frames: int = 1):
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(max(1, frames))
+                self.frames = max(1, frames)
+                self.started_at = time.time()
+                self._requests.clear()
+                self._by_endpoint.clear()
+
+    def stop(self):
+        with self._lock:
+            tracemalloc.stop()
+            self._snapshots.clear()
+            self.started_at = None
+            _function_spans.cache_clear()
+
+    def take_snapshot(self, label: Optional[str] = None) -> str:
+        """Store a snapshot of current allocations under `label`; the oldest beyond max_snapshots are dropped"""
+        if not tracemalloc.is_tracing():
+            raise RuntimeError('Memory tracing is not running')
+        snapshot = tracemalloc.take_snapshot().filter_traces(self.SNAPSHOT_FILTERS)
+        with self._lock:
+            label = label or f"s{len(self._snapshots) + 1}-{int(time.time())}"
+            self._snapshots.pop(label, None)
+            self._snapshots[label] = (time.time(), snapshot)
+            while len(self._snapshots) > self.max_snapshots:
+                self._snapshots.popitem(last=False)
+        return label
+
+    def _snapshot(self, label: str):
+        with self._lock:
+            entry = self._snapshots.get(label)
+        if entry is None:
+            raise KeyError(label)
+        return entry[1]
+
+    def top(self, label: Optional[str] = None, group: str = 'function', limit: int = 25) -> List[Dict[str, Any]]:
+        """Largest allocation sites in a stored snapshot (or a fresh one), grouped by module or function"""
+        snapshot = self._snapshot(label) if label else \
+            tracemalloc.take_snapshot().filter_traces(self.SNAPSHOT_FILTERS)
+        sites = collections.defaultdict(lambda: [0, 0])
+        for stat in snapshot.statistics('lineno'):
+            frame = stat.traceback[0]
+            site = sites[allocation_site(frame.filename, frame.lineno, group)]
+            site[0] += stat.size
+            site[1] += stat.count
+        ranked = sorted(sites.items(), key=lambda item: item[1][0], reverse=True)[:limit]
+        return [{'site': site, 'bytes': size, 'blocks': count} for site, (size, count) in ranked]
+
+    def diff(self, before: str, after: Optional[str] = None, group: str = 'function',
+             limit: int = 25) -> List[Dict[str, Any]]:
+        """Allocation sites that grew (or shrank) most between two snapshots; `after` defaults to now"""
+        old = self._snapshot(before)
+        new = self._snapshot(after) if after else \
+            tracemalloc.take_snapshot().filter_traces(self.SNAPSHOT_FILTERS)
+        sites = collections.defaultdict(lambda: [0, 0, 0])
+        for stat in new.compare_to(old, 'lineno'):
+            frame = stat.traceback[0]
+            site = sites[allocation_site(frame.filename, frame.lineno, group)]
+            site[0] += stat.size_diff
+            site[1] += stat.count_diff
+            site[2] += stat.size
+        ranked = sorted(sites.items(), key=lambda item: abs(item[1][0]), reverse=True)[:limit]
+        return [{'site': site, 'bytes_diff': size_diff, 'blocks_diff': count_diff, 'bytes': size}
+                for site, (size_diff, count_diff, size) in ranked if size_diff or count_diff]
+
+    def request_started(self) -> Optional[int]:
+        """Traced bytes at the start of a request, or None when not tracing"""
+        if not tracemalloc.is_tracing():
+            return None
+        with self._lock:
+            if self._in_flight == 0:
+                # Alone: the peak from here on belongs to this request
+                tracemalloc.reset_peak()
+            else:
+                self._overlapped = True
+            self._in_flight += 1
+            return tracemalloc.get_traced_memory()[0]
+
+    def request_finished(self, start_bytes: Optional[int], endpoint: str) -> Optional[int]:
+        """Record how far the request raised the traced peak above its starting level; returns that in bytes"""
+        if start_bytes is None:
+            return None
+        with self._lock:
+            self._in_flight = max(0, self._in_flight - 1)
+            if not tracemalloc.is_tracing():
+                return None
+            current, peak = tracemalloc.get_traced_memory()
+            # Overlapping requests share one peak, so theirs is an upper bound
+            concurrent = self._overlapped
+            if self._in_flight == 0:
+                self._overlapped = False
+            peak_bytes = max(0, peak - start_bytes)
+            self._requests.append({
+                'request_id': request_id_var.get(),
+                'endpoint': endpoint,
+                'peak_bytes': peak_bytes,
+                'retained_bytes': current - start_bytes,
+                'concurrent': concurrent
             })
+            stats = self._by_endpoint.setdefault(endpoint, {'requests': 0, 'total_peak_bytes': 0, 'max_peak_bytes': 0})
+            stats['requests'] += 1
+            stats['total_peak_bytes'] += peak_bytes
+            stats['max_peak_bytes'] = max(stats['max_peak_bytes'], peak_bytes)
+        return peak_bytes
 
-        # Collect file information for response
-        analyzed_files = []
-        for result in analysis_results:
-            if result['type'] == 'file':
-                file_data = result['data']
-                file_info = {
-                    'name': file_data.get('file_path', file_data.get('name', '')),
-                    'language': file_data.get('language', 'unknown'),
-                    'token_count': file_data.get('token_count', 0),
-                    'lines': file_data.get('lines', 0),
-                    'structure': file_data.get('structure', ''),
-                    'error': file_data.get('error', None)
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                return {'tracing': False}
+            current, peak = tracemalloc.get_traced_memory()
+            return {
+                'tracing': True,
+                'frames': self.frames,
+                'started_at': self.started_at,
+                'traced_bytes': current,
+                'peak_bytes': peak,
+                'tracemalloc_overhead_bytes': tracemalloc.get_tracemalloc_memory(),
+                'snapshots': [{'label': label, 'taken_at': taken_at} for label, (taken_at, _) in self._snapshots.items()],
+                'requests': list(self._requests),
+                'by_endpoint': {
+                    endpoint: dict(stats, avg_peak_bytes=stats['total_peak_bytes'] / stats['requests'])
+                    for endpoint, stats in self._by_endpoint.items()
                 }
-                analyzed_files.append(file_info)
-            elif result['type'] == 'folder':
-                folder_data = result['data']
-                folder_info = {
-                    'name': folder_data.get('folder_path', ''),
-                    'type': 'folder',
-                    'total_files': folder_data.get('total_files', 0),
-                    'total_dirs': folder_data.get('total_dirs', 0),
-                    'summary': folder_data.get('summary', ''),
-                    'error': folder_data.get('error', None)
+            }
+
+memory_profiler = MemoryProfiler(DEFAULT_CONFIG['memorySnapshotsKept'], DEFAULT_CONFIG['memoryRequestHistory'])
+
+def admin_required(view):
+    """Serve a debug view only with the configured X-Admin-Token; without a configured token it does not exist"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        token = DEFAULT_CONFIG['adminToken']
+        if not token:
+            return jsonify({'success': False, 'error': 'Not found'}), 404
+        supplied = request.headers.get('X-Admin-Token', '')
+        if not hmac.compare_digest(supplied.encode(), token.encode()):
+            log_event('admin_denied', logging.WARNING, path=request.path)
+            return jsonify({'success': False, 'error': 'Forbidden'}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.route('/api/analyze-and-execute', methods=['POST'])
+@admission_controlled
+def analyze_and_execute():
+    try:
+        data = request.get_json()
+        if not data or 'prompt' not in data:
+            return jsonify({
+                'success': False,
+                'error': 'Missing prompt in request body'
+            }), 400
+
+        user_prompt = data['prompt']
+        context = data.get('context', '')
+        files = data.get('files', None)
+        folders = data.get('folders', None)
+
+        # --- Handle greetings and unclear prompts before any analysis ---
+        analysis_msg = quick_reply(user_prompt)
+        if analysis_msg:
+            return jsonify(analysis_message_response(user_prompt, analysis_msg))
+
+        temp_files = []
+        context_report = {}
+        try:
+            pipeline = AnalysisPipeline(files, folders, user_prompt, temp_files)
+            context = build_context(pipeline, user_prompt, report=context_report)
+            analysis_results = pipeline.finish()
+            context_report.update(near_duplicate_report(analysis_results))
+        finally:
+            remove_temp_files(temp_files)
+
+        response = generate_analysis_response(user_prompt, context, analysis_results)
+        if 'context_tokens' in response:
+            response.update(context_report)
+        return jsonify(response)
+    except Exception as error:
+        log_event('request_error', logging.ERROR, error=str(error))
+        return jsonify({
+            'success': False,
+            'error': f'Server error: {str(error)}'
+        }), 500
+
+@app.route('/api/analyze-and-execute/batch', methods=['POST'])
+@admission_controlled
+def analyze_and_execute_batch():
+    """Run many prompts against one shared, once-analyzed set of files/folders"""
+    try:
+        data = request.get_json()
+        prompts = data.get('prompts') if data else None
+        if not isinstance(prompts, list) or not prompts:
+            return jsonify({
+                'success': False,
+                'error': 'Missing prompts list in request body'
+            }), 400
+        if len(prompts) > DEFAULT_CONFIG['maxBatchSize']:
+            return jsonify({
+                'success': False,
+                'error': f"Too many prompts in batch (max {DEFAULT_CONFIG['maxBatchSize']})"
+            }), 400
+
+        # Items are either plain prompt strings or {"prompt": ...} objects
+        user_prompts = [item.get('prompt', '') if isinstance(item, dict) else str(item) for item in prompts]
+        parallelism = data.get('parallelism', DEFAULT_CONFIG['batchParallelism'])
+        try:
+            parallelism = max(1, min(int(parallelism), DEFAULT_CONFIG['maxBatchParallelism']))
+        except (TypeError, ValueError):
+            parallelism = DEFAULT_CONFIG['batchParallelism']
+
+        # Analyze the shared inputs once: files named by any prompt first, budgeted for the longest prompt.
+        # Each item then packs its own context from those results, with chunks ranked against its own prompt.
+        longest_prompt = max(user_prompts, key=len)
+        temp_files = []
+        uploads_handed_off = False
+        try:
+            pipeline = AnalysisPipeline(data.get('files', None), data.get('folders', None), ' '.join(user_prompts), temp_files)
+            build_context(pipeline, longest_prompt)
+            analysis_results = pipeline.finish()
+            duplicates = near_duplicate_report(analysis_results)
+        except Exception:
+            remove_temp_files(temp_files)
+            raise
+
+        def run_item(index: int, user_prompt: str) -> Dict[str, Any]:
+            try:
+                analysis_msg = quick_reply(user_prompt)
+                if analysis_msg:
+                    result = analysis_message_response(user_prompt, analysis_msg)
+                else:
+                    context_report = {}
+                    context = build_context(analysis_results, user_prompt, report=context_report)
+                    result = generate_analysis_response(user_prompt, context, analysis_results)
+                    if 'context_tokens' in result:
+                        result.update(context_report)
+            except Exception as error:
+                log_event('request_error', logging.ERROR, error=str(error))
+                result = {
+                    'success': False,
+                    'error': f'Server error: {str(error)}',
+                    'prompt': user_prompt
                 }
-                analyzed_files.append(folder_info)
-        print(sections)
+            result['index'] = index
+            return result
 
-        
-        print(model_output)
+        def batch_summary(results: List[Dict[str, Any]]) -> Dict[str, Any]:
+            succeeded = sum(1 for result in results if result.get('success'))
+            return {
+                'success': True,
+                'type': 'batch',
+                'total': len(results),
+                'succeeded': succeeded,
+                'failed': len(results) - succeeded,
+                'context_tokens': max((result.get('context_tokens', 0) for result in results), default=0),
+                'dedup_blocks': sum(result.get('dedup_blocks', 0) for result in results),
+                'dedup_tokens_saved': sum(result.get('dedup_tokens_saved', 0) for result in results),
+                **duplicates,
+                'analyzed_files': collect_analyzed_files(analysis_results)
+            }
+
+        try:
+            executor = ThreadPoolExecutor(max_workers=min(parallelism, len(user_prompts)))
+            # Each item runs in a copy of this request's context so logs keep the request ID
+            futures = [executor.submit(contextvars.copy_context().run, run_item, i, p) for i, p in enumerate(user_prompts)]
+
+            if data.get('stream'):
+                def generate():
+                    # One JSON object per line, in completion order, then a summary line
+                    results = []
+                    try:
+                        for future in as_completed(futures):
+                            result = future.result()
+                            results.append(result)
+                            yield json.dumps(result) + '\n'
+                        yield json.dumps(batch_summary(results)) + '\n'
+                    finally:
+                        executor.shutdown(wait=False, cancel_futures=True)
+                        # Uploads back the items' chunk text until every item has packed its context
+                        remove_temp_files(temp_files)
+                uploads_handed_off = True
+                return Response(generate(), mimetype='application/x-ndjson')
+
+            try:
+                results = [future.result() for future in futures]
+            finally:
+                executor.shutdown(wait=False)
+        finally:
+            if not uploads_handed_off:
+                remove_temp_files(temp_files)
+        response = batch_summary(results)
+        response['results'] = results
+        return jsonify(response)
+    except Exception as error:
+        log_event('request_error', logging.ERROR, error=str(error))
         return jsonify({
-            'success': True,
-            'type': 'analysis',
-            'output': model_output,
-            'sections': sections,
-            'prompt': user_prompt,
-            'context_tokens': count_tokens(context),
-            'total_analyzed': len(analysis_results),
-            'analyzed_files': analyzed_files,
-            'files': sections.get('files', [])  # New: add files array to response
-        })
+            'success': False,
+            'error': f'Server error: {str(error)}'
+        }), 500
+
+def unknown_session_response():
+    return jsonify({
+        'success': False,
+        'error': 'Unknown or expired session'
+    }), 404
+
+@app.route('/api/sessions', methods=['POST'])
+def create_session():
+    """Create a conversation session, optionally attaching files/folders right away"""
+    try:
+        data = request.get_json(silent=True) or {}
+        session = session_store.create()
+        try:
+            with session.lock:
+                inputs = attach_session_inputs(session, data)
+                response = session.describe()
+        finally:
+            session_store.release(session)
+        response.update({'success': True, 'inputs': inputs})
+        return jsonify(response)
+    except Exception as error:
+        log_event('request_error', logging.ERROR, error=str(error))
+        return jsonify({
+            'success': False,
+            'error': f'Server error: {str(error)}'
+        }), 500
+
+@app.route('/api/sessions/<session_id>', methods=['GET', 'DELETE'])
+def session_detail(session_id):
+    if request.method == 'DELETE':
+        if not session_store.delete(session_id):
+            return unknown_session_response()
+        return jsonify({'success': True})
+    session = session_store.get(session_id)
+    if session is None:
+        return unknown_session_response()
+    response = session.describe()
+    response['success'] = True
+    return jsonify(response)
+
+@app.route('/api/sessions/<session_id>/inputs', methods=['POST'])
+def attach_session(session_id):
+    """Add, update or remove a session's files/folders without running a turn"""
+    try:
+        session = session_store.checkout(session_id)
+        if session is None:
+            return unknown_session_response()
+        data = request.get_json(silent=True) or {}
+        try:
+            with session.lock:
+                inputs = attach_session_inputs(session, data)
+                response = session.describe()
+        finally:
+            session_store.release(session)
+        response.update({'success': True, 'inputs': inputs})
+        return jsonify(response)
+    except Exception as error:
+        log_event('request_error', logging.ERROR, error=str(error))
+        return jsonify({
+            'success': False,
+            'error': f'Server error: {str(error)}'
+        }), 500
+
+@app.route('/api/sessions/<session_id>/turns', methods=['POST'])
+@admission_controlled
+def session_turn(session_id):
+    """Run one conversation turn against the session's stored context and prior turns"""
+    try:
+        session = session_store.checkout(session_id)
+        if session is None:
+            return unknown_session_response()
+        try:
+            data = request.get_json()
+            if not data or 'prompt' not in data:
+                return jsonify({
+                    'success': False,
+                    'error': 'Missing prompt in request body'
+                }), 400
+
+            user_prompt = data['prompt']
+            with session.lock:
+                inputs = attach_session_inputs(session, data)
+                history_tokens = 0
+                analysis_msg = quick_reply(user_prompt)
+                if analysis_msg:
+                    response = analysis_message_response(user_prompt, analysis_msg)
+                else:
+                    analysis_results = session.analysis_results()
+                    history, history_tokens = session.history(DEFAULT_CONFIG['sessionHistoryTokens'])
+                    # Packing only ranks stored chunks against this prompt; nothing is re-analyzed
+                    context_report = {}
+                    context = build_context(analysis_results, user_prompt, history_tokens, context_report)
+                    response = generate_analysis_response(user_prompt, context, analysis_results, history, history_tokens)
+                    if 'context_tokens' in response:
+                        response.update(context_report)
+                    # Full model answers carry 'partial': False; errors and partial results are not remembered
+                    if response.get('partial') is False:
+                        session.add_turn(user_prompt, response['output'], DEFAULT_CONFIG['sessionMaxBytes'])
+                response.update({
+                    'session_id': session.id,
+                    'turn': len(session.turns) // 2,
+                    'history_tokens': history_tokens,
+                    'inputs': inputs
+                })
+        finally:
+            session_store.release(session)
+        return jsonify(response)
     except Exception as error:
-        print(error)
+        log_event('request_error', logging.ERROR, error=str(error))
         return jsonify({
             'success': False,
             'error': f'Server error: {str(error)}'
         }), 500
 
+@app.route('/api/workspaces', methods=['GET', 'POST'])
+def workspaces():
+    """Register a folder for background indexing, or list registered folders"""
+    if request.method == 'GET':
+        return jsonify({'success': True, 'workspaces': workspace_registry.snapshot()})
+    data = request.get_json(silent=True) or {}
+    path = data.get('path')
+    if not path or not os.path.isdir(path):
+        return jsonify({
+            'success': False,
+            'error': 'Missing or invalid folder path'
+        }), 400
+    workspace = workspace_registry.register(path)
+    response = workspace_registry.describe(workspace)
+    response['success'] = True
+    return jsonify(response)
+
+@app.route('/api/workspaces/rules', methods=['GET'])
+def workspace_rules():
+    return jsonify({'success': True, 'rules': workspace_walk_rules()})
+
+@app.route('/api/workspaces/<workspace_id>', methods=['GET', 'DELETE'])
+def workspace_detail(workspace_id):
+    if request.method == 'DELETE':
+        if not workspace_registry.unregister(workspace_id):
+            return jsonify({'success': False, 'error': 'Unknown workspace'}), 404
+        return jsonify({'success': True})
+    workspace = workspace_registry.get(workspace_id)
+    if workspace is None:
+        return jsonify({'success': False, 'error': 'Unknown workspace'}), 404
+    response = workspace_registry.describe(workspace)
+    response['success'] = True
+    return jsonify(response)
+
+@app.before_request
+def assign_request_id():
+    request_id_var.set(request.headers.get('X-Request-ID') or uuid.uuid4().hex[:16])
+    g.request_start = time.perf_counter()
+    body = request.get_json(silent=True)
+    timeout = parse_request_timeout(request.headers, body)
+    request_deadline_var.set(None if timeout is None else time.monotonic() + timeout)
+    default_priority = 'bulk' if request.endpoint == 'analyze_and_execute_batch' else 'normal'
+    request_priority_var.set(parse_request_priority(request.headers, body, default_priority))
+    g.memory_start = memory_profiler.request_started()
+
+@app.after_request
+def log_request(response):
+    response.headers['X-Request-ID'] = request_id_var.get() or ''
+    fields = {}
+    peak = memory_profiler.request_finished(g.get('memory_start'), request.url_rule.rule if request.url_rule else request.path)
+    if peak is not None:
+        fields['peak_kb'] = round(peak / 1024, 1)
+    log_event(
+        'request_complete',
+        method=request.method,
+        path=request.path,
+        status=response.status_code,
+        duration_ms=round((time.perf_counter() - g.get('request_start', time.perf_counter())) * 1000, 1),
+        **fields
+    )
+    return response
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    return jsonify({
+        'logging': log_stats.snapshot(),
+        'analysis': analysis_stats.snapshot(),
+        'sessions': session_store.snapshot(),
+        'workspaces': workspace_registry.snapshot(),
+        'summaries': summary_cache.snapshot(),
+        'dependencies': dependency_graph.snapshot(),
+        'dedup': dedup_stats.snapshot(),
+        'output_tokens': output_size_model.snapshot(),
+        'tokens': token_estimator.snapshot(),
+        'admission': admission.snapshot(),
+        'model_router': model_client.router.snapshot()
+    })
+
+@app.route('/api/debug/memory', methods=['GET', 'POST'])
+@admin_required
+def debug_memory():
+    """Memory diagnostics: GET reports status and top allocation sites; POST starts/stops tracing, snapshots and diffs"""
+    data = (request.get_json(silent=True) or {}) if request.method == 'POST' else request.args
+    group = data.get('group', 'function')
+    if group not in ('function', 'module'):
+        return jsonify({'success': False, 'error': "group must be 'function' or 'module'"}), 400
+    try:
+        limit = max(1, int(data.get('limit', DEFAULT_CONFIG['memoryTopSites'])))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'limit must be an integer'}), 400
+
+    action = data.get('action', 'top') if request.method == 'POST' else 'top'
+    response = {'success': True}
+    try:
+        if action == 'start':
+            memory_profiler.start(int(data.get('frames', 1)))
+        elif action == 'stop':
+            memory_profiler.stop()
+        elif action == 'snapshot':
+            response['label'] = memory_profiler.take_snapshot(data.get('label'))
+        elif action == 'diff':
+            if not data.get('from'):
+                return jsonify({'success': False, 'error': "diff needs a 'from' snapshot label"}), 400
+            response['diff'] = memory_profiler.diff(data['from'], data.get('to'), group, limit)
+        elif action == 'top':
+            if memory_profiler.tracing:
+                response['top'] = memory_profiler.top(data.get('snapshot'), group, limit)
+        else:
+            return jsonify({'success': False, 'error': f'Unknown action: {action}'}), 400
+    except KeyError as missing:
+        return jsonify({'success': False, 'error': f'Unknown snapshot: {missing.args[0]}'}), 404
+    except (TypeError, ValueError) as error:
+        return jsonify({'success': False, 'error': str(error)}), 400
+    except RuntimeError as error:
+        return jsonify({'success': False, 'error': str(error)}), 409
+    log_event('memory_debug', action=action)
+    response['status'] = memory_profiler.snapshot()
+    return jsonify(response)
+
+@app.route('/api/prompts', methods=['GET'])
+def list_prompt_templates():
+    return jsonify(prompt_registry.describe())
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     return jsonify({
@@ -0,0 +1,702 @@
+"""Offline benchmarks for the Flask backend.
+
+Run from the flaskbackend directory:
+
+    py benchmark.py              # run every benchmark
+    py benchmark.py classifier   # run one benchmark
+"""
+import re
+import sys
+import json
+import time
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List
+
+import app
+
+# --- SYSTEM PROMPT CLASSIFIER ---
+def bench_classifier():
+    # Accuracy on labeled prompts is checked by tests/test_classifier.py
+    rng = random.Random(0)
+    words = ["def", "class", "import", "return", "value", "config", "python", "copy", "node_modules", "data"]
+    for size in (10_000, 100_000, 1_000_000):
+        context = ' '.join(rng.choice(words) for _ in range(size // 6))[:size]
+        runs = 20
+        start = time.perf_counter()
+        for _ in range(runs):
+            app.select_system_prompt("refactor this module", context)
+        elapsed = (time.perf_counter() - start) / runs
+        print(f"context {size:>9,} chars: {elapsed * 1000:.3f} ms per selection")
+
+# --- MODEL ENDPOINT HEDGING ---
+def start_mock_model_server(latency: Callable[[], float], status: int = 200) -> str:
+    """Start a local OpenAI-compatible mock on a free port and return its URL"""
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            time.sleep(latency())
+            body = json.dumps({
+                'choices': [{'message': {'content': 'ok'}, 'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': 10, 'completion_tokens': 5, 'total_tokens': 15}
+            }).encode()
+            try:
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # A losing hedge the router aborted
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}/v1/chat/completions"
+
+def percentile(samples: List[float], pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+def bench_hedging():
+    # Failover and circuit breaking are checked by tests/test_hedging.py
+    rng = random.Random(0)
+    # 3% of calls to the primary hit a 1 s stall; the secondary is steady but slightly slower
+    slow_tail = start_mock_model_server(lambda: 1.0 if rng.random() < 0.03 else 0.02)
+    steady = start_mock_model_server(lambda: 0.04)
+    config = dict(app.DEFAULT_CONFIG, rateLimitRequestsPerMinute=100000, rateLimitTokensPerMinute=10 ** 9,
+                  hedgeDefaultDelay=0.1, circuitOpenSeconds=60)
+    payload = {'model': 'mock', 'messages': [{'role': 'user', 'content': 'hi'}], 'max_tokens': 16}
+
+    def run(router: 'app.EndpointRouter', calls: int = 200) -> List[float]:
+        latencies = []
+        for _ in range(calls):
+            start = time.perf_counter()
+            router.call(payload, 10)
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    scenarios = [
+        ('single endpoint', [slow_tail], dict(config, hedgeEnabled=False)),
+        ('hedged, 2 endpoints', [slow_tail, steady], config),
+    ]
+    for name, urls, scenario_config in scenarios:
+        router = app.EndpointRouter(
+            [app.ModelEndpoint(url, '', None, 1.0 if i == 0 else 0.0, scenario_config) for i, url in enumerate(urls)],
+            scenario_config
+        )
+        latencies = run(router)
+        stats = router.snapshot()
+        print(f"{name:<20} p50 {percentile(latencies, 50) * 1000:7.1f} ms  p99 {percentile(latencies, 99) * 1000:7.1f} ms"
+              f"  hedges {stats['hedges_launched']} (won {stats['hedges_won']})")
+
+# --- C-FAMILY SCANNER ---
+# The DOTALL regex the Java/C analyzers used before CFamilyScanner, kept for comparison
+LEGACY_C_FUNCTION_PATTERN = r'\w+\s+\w+\s*\([^)]*\)\s*\{[^}]*\}'
+
+def generated_c_sources(size: int) -> Dict[str, str]:
+    """Worst-case and typical C-family inputs of roughly `size` characters"""
+    function = "static int f%d(int a, char *b) {\n    if (a) { return b[0] == '}'; } /* { */\n    return 0;\n}\n"
+    typical = []
+    total = 0
+    while total < size:
+        typical.append(function % len(typical))
+        total += len(typical[-1])
+    return {
+        'typical functions': ''.join(typical),
+        'deep nesting': 'int main() ' + '{' * (size // 2) + '}' * (size // 2),
+        'unterminated comments': '/*' * (size // 2),
+        'open parens (legacy worst case)': 'a b(' * (size // 4),
+        'one huge header': 'a ' * (size // 2) + '{}',
+        'class members': 'class A {\n' + 'void m() { x(); }\n' * (size // 19) + '}\n',
+    }
+
+def bench_scanner():
+    for size in (100_000, 1_000_000):
+        print(f"-- {size:,} chars --")
+        for name, source in generated_c_sources(size).items():
+            start = time.perf_counter()
+            declarations = app.CFamilyScanner('c').scan(source)
+            elapsed = time.perf_counter() - start
+            print(f"{name:<32} {elapsed * 1000:8.1f} ms  {len(declarations):>6} declarations")
+
+    # The legacy pattern on its worst case grows quadratically; keep the input small
+    source = generated_c_sources(20_000)['open parens (legacy worst case)']
+    start = time.perf_counter()
+    re.findall(LEGACY_C_FUNCTION_PATTERN, source, re.DOTALL)
+    print(f"legacy regex, open parens, 20,000 chars: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+# --- CONTEXT PACKING ---
+CHUNK_VERBS = ['parse', 'compute', 'validate', 'render', 'load', 'store', 'apply', 'merge', 'format', 'sync']
+CHUNK_NOUNS = ['invoice', 'refund', 'customer', 'ledger', 'report', 'discount', 'shipment', 'tax', 'order', 'coupon']
+# (prompt, functions whose definitions the model needs to see)
+CHUNK_CASES = [
+    ("apply_refund is double counting partial refunds, fix it", ['apply_refund']),
+    ("make validate_coupon reject expired coupons", ['validate_coupon']),
+    ("compute_tax and format_report disagree on rounding", ['compute_tax', 'format_report']),
+    ("add retries to sync_shipment and store_ledger", ['sync_shipment', 'store_ledger']),
+    ("why does merge_order drop the discount from compute_discount?", ['merge_order', 'compute_discount']),
+]
+
+def generated_python_modules(directory: str, files: int = 10) -> List[str]:
+    """Write modules of 10 realistic-sized functions each; every verb/noun pair appears once"""
+    paths = []
+    for index, noun in enumerate(CHUNK_NOUNS[:files]):
+        lines = ['import math', 'import json', '', f'{noun.upper()}_LIMIT = 100', '']
+        for verb in CHUNK_VERBS:
+            name = f"{verb}_{noun}"
+            lines += [f"def {name}(record, options=None):", f'    """{verb.title()} a {noun} record"""', '    options = options or {}']
+            lines += [f"    value_{i} = record.get('{noun}_{i}', 0) * math.sqrt({i + 1})" for i in range(8)]
+            lines += [f"    if value_0 > {noun.upper()}_LIMIT:", f"        raise ValueError('{name} limit exceeded')",
+                      "    return json.dumps({'total': value_0 + value_1, 'options': options})", '']
+        lines += ["if __name__ == '__main__':", f"    print(compute_{noun}({{}}))"]
+        path = f"{directory}/{noun}.py"
+        with open(path, 'w') as handle:
+            handle.write('\n'.join(lines) + '\n')
+        paths.append(path)
+    return paths
+
+def generated_mixed_project(directory: str) -> List[str]:
+    """Write a small shop with JavaScript, Java and Python sources plus a large lockfile distractor"""
+    import os
+    files = {}
+    js = ["'use strict';", "const TAX_RATE = 0.2;", ""]
+    for name in ['cartTotal', 'applyCoupon', 'updateQuantity', 'renderCheckout', 'loadCart', 'saveCart',
+                 'formatPrice', 'trackEvent', 'validateAddress', 'estimateShipping', 'mergeCarts', 'clearCart']:
+        js += [f"function {name}(cart, options) {{", "  options = options || {};"]
+        js += [f"  const step{i} = (cart.items[{i}] || {{}}).price * (1 + TAX_RATE) || 0;" for i in range(8)]
+        js += [f"  if (step0 > options.limit) {{ throw new Error('{name}: limit exceeded'); }}",
+               "  return { total: step0 + step1, options };", "}", ""]
+    js.append("module.exports = { cartTotal, applyCoupon, updateQuantity, renderCheckout };")
+    files['web/cart.js'] = js
+
+    java = ["package shop;", "", "import java.util.List;", "", "public class Billing {",
+            "    private final Gateway gateway;", "", "    public Billing(Gateway gateway) { this.gateway = gateway; }", ""]
+    for name in ['chargeCard', 'refundPayment', 'issueInvoice', 'voidInvoice', 'settleBatch', 'exportLedger',
+                 'reconcile', 'applyCredit']:
+        java += [f"    public double {name}(Order order, List<String> flags) {{", "        double total = 0;"]
+        java += [f"        total += order.line({i}).price() * {i + 1};" for i in range(8)]
+        java += [f"        if (total < 0) {{ throw new IllegalStateException(\"{name}: negative total\"); }}",
+                 "        return gateway.submit(order.id(), total);", "    }", ""]
+    java.append("}")
+    files['src/main/java/shop/Billing.java'] = java
+
+    python = ["import dataclasses", "from decimal import Decimal", ""]
+    for name in ['Order', 'RefundService', 'Customer', 'Inventory', 'Warehouse', 'Carrier']:
+        python += ["@dataclasses.dataclass", f"class {name}:", f'    """A {name.lower()} in the shop"""',
+                   "    id: str", "    total: Decimal = Decimal(0)", ""]
+        for method in ['cancel', 'validate', 'to_dict']:
+            python += [f"    def {method}(self, reason=None):", f'        """{method.title()} this {name.lower()}"""']
+            python += [f"        part_{i} = self.total * Decimal({i + 1}) / Decimal(10)" for i in range(6)]
+            python += ["        return {'id': self.id, 'reason': reason, 'total': str(part_0 + part_1)}", ""]
+    files['shop/models.py'] = python
+
+    files['package-lock.json'] = ['{', '  "name": "shop",', '  "packages": {'] + [
+        f'    "node_modules/dep-{i}": {{"version": "1.{i}.0", "resolved": "https://registry.npmjs.org/dep-{i}/-/dep-{i}-1.{i}.0.tgz", '
+        f'"integrity": "sha512-{i:064d}"}},' for i in range(300)
+    ] + ['    "": {}', '  }', '}']
+
+    paths = []
+    for relative, lines in files.items():
+        path = os.path.join(directory, relative)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as handle:
+            handle.write('\n'.join(lines) + '\n')
+        paths.append(path)
+    return paths
+
+def generated_call_chains(directory: str) -> List[str]:
+    """Write a package whose entry points reach helpers in other files through imports and calls"""
+    import os
+
+    def python_function(name: str, calls: List[str]) -> List[str]:
+        lines = [f"def {name}(order, options=None):", f'    """{name.replace("_", " ").capitalize()}"""', '    options = options or {}']
+        lines += [f"    step_{i} = order.get('line_{i}', 0) * {i + 1}" for i in range(8)]
+        lines += [f"    step_0 += {call}(order, options)" for call in calls]
+        return lines + ["    return step_0 + step_1", '']
+
+    def js_function(name: str, calls: List[str]) -> List[str]:
+        lines = [f"function {name}(order, options) {{", '  options = options || {};']
+        lines += [f"  const step{i} = (order.lines[{i}] || {{}}).amount * {i + 1} || 0;" for i in range(8)]
+        lines += [f"  const via{j} = {call}(order, options);" for j, call in enumerate(calls)]
+        return lines + ['  return step0 + step1;', '}', '']
+
+    filler = ['summarize', 'export', 'archive', 'restock', 'forecast', 'notify']
+    files = {
+        'store/checkout.py': ['from store.pricing import compute_total', 'from store import audit', ''] +
+            python_function('place_order', ['compute_total', 'audit.record_event']) +
+            python_function('cancel_order', ['audit.record_event']),
+        'store/pricing.py': ['from store.tax import tax_for', ''] +
+            python_function('compute_total', ['tax_for', 'apply_bulk_discount']) +
+            python_function('apply_bulk_discount', []) + python_function('price_quote', []),
+        'store/tax.py': python_function('tax_for', []) + python_function('tax_report', []),
+        'store/audit.py': python_function('record_event', []) + python_function('rotate_log', []),
+        'store/reports.py': [line for verb in filler for line in python_function(f"{verb}_orders", [])],
+        'web/checkout.js': ["import { formatMoney } from './money';", "const analytics = require('./analytics');", ''] +
+            js_function('submitOrder', ['formatMoney']) + js_function('showCart', []),
+        'web/money.js': js_function('formatMoney', ['roundCents']) + js_function('roundCents', []) +
+            js_function('parseMoney', []) + ['module.exports = { formatMoney, parseMoney };'],
+        'web/analytics.js': [line for verb in filler for line in js_function(f"{verb}Events", [])],
+    }
+    paths = []
+    for relative, lines in files.items():
+        path = os.path.join(directory, relative)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as handle:
+            handle.write('\n'.join(lines) + '\n')
+        paths.append(path)
+    return paths
+
+# Labeled cases: workspace -> (prompt, symbols whose definitions the model must see)
+CONTEXT_CASES = {
+    'python modules': (generated_python_modules, CHUNK_CASES),
+    'mixed project': (generated_mixed_project, [
+        ("cartTotal ignores applyCoupon when the cart is empty", ['cartTotal', 'applyCoupon']),
+        ("renderCheckout shows stale prices after updateQuantity", ['renderCheckout', 'updateQuantity']),
+        ("Billing.chargeCard should retry when the card is declined", ['chargeCard']),
+        ("cancelling an Order must go through RefundService", ['Order', 'RefundService']),
+        ("refundPayment and reconcile disagree on the order total", ['refundPayment', 'reconcile']),
+    ]),
+    # The definitions needed are one or two calls away from the symbol the prompt names
+    'call chains': (generated_call_chains, [
+        ("place_order charges customers the wrong amount", ['place_order', 'compute_total', 'tax_for']),
+        ("submitOrder shows totals with the wrong number of decimals", ['submitOrder', 'formatMoney', 'roundCents']),
+        ("cancel_order is missing from the audit trail", ['cancel_order', 'record_event']),
+    ]),
+}
+CONTEXT_BUDGETS = (4000, 1500, 600)  # Context tokens available after the prompt and system prompt
+
+def defines_symbol(context: str, symbol: str) -> bool:
+    """Whether the context holds the symbol's definition (not just its name in a summary)"""
+    name = re.escape(symbol)
+    pattern = (rf"(?:\bdef|\bclass|\bfunction|\binterface)\s+{name}\b"
+               rf"|\b{name}\s*\([^()\n]*\)\s*(?:throws [\w., ]+)?\{{")
+    return re.search(pattern, context) is not None
+
+def raw_file_context(records: List[Dict], prompt: str, budget: int) -> str:
+    """Client-built context: every file's raw text, cut to the budget by _optimize_context_by_tokens"""
+    sections = []
+    for result in records:
+        data = result['data']
+        sections.append(f"File: {data.file_path}\n" + '\n'.join(data.load_lines() or []))
+    return app.model_client._optimize_context_by_tokens('\n\n'.join(sections), budget)
+
+def built_context(records: List[Dict], prompt: str, budget: int) -> str:
+    """The analyze_and_execute path: summaries, then ranked chunks, within the budget"""
+    fixed = app.prompt_registry.max_token_count + app.prompt_registry.context_framing_tokens
+    reserved = app.DEFAULT_CONFIG['maxInputTokens'] - app.count_tokens(prompt) - fixed - budget
+    return app.build_context(records, prompt, reserved)
+
+def summaries_only(records: List[Dict], prompt: str, budget: int) -> str:
+    """build_context on the fixed-shape summaries from before chunking"""
+    unchunked = []
+    for result in records:
+        data = result['data'].with_path(result['data'].file_path)
+        data.chunks = None
+        unchunked.append({'type': 'file', 'data': data})
+    return built_context(unchunked, prompt, budget)
+
+def chunks_without_graph(records: List[Dict], prompt: str, budget: int) -> str:
+    """build_context with ranked chunks but no dependency closure"""
+    depth = app.DEFAULT_CONFIG['dependencyMaxDepth']
+    app.DEFAULT_CONFIG['dependencyMaxDepth'] = 0
+    try:
+        return built_context(records, prompt, budget)
+    finally:
+        app.DEFAULT_CONFIG['dependencyMaxDepth'] = depth
+
+# name -> (records, prompt, context token budget) -> context; add an entry to compare a new strategy
+CONTEXT_STRATEGIES: Dict[str, Callable[[List[Dict], str, int], str]] = {
+    'raw + truncate': raw_file_context,
+    'summaries only': summaries_only,
+    'chunks, no graph': chunks_without_graph,
+    'ranked chunks': built_context,
+}
+
+def bench_context():
+    """Tokens used, recall of required definitions and packing time per strategy, workspace and budget"""
+    import os
+    import tempfile
+    analyzer = app.ASTContextAnalyzer()
+    for workspace, (generate, cases) in CONTEXT_CASES.items():
+        with tempfile.TemporaryDirectory() as directory:
+            records = []
+            for path in sorted(generate(directory)):
+                language = app.WORKSPACE_LANGUAGES.get(os.path.splitext(path)[1].lower(), 'unknown')
+                records.append({'type': 'file', 'data': analyzer.analyze_file(path, language)})
+            source_tokens = sum(app.count_tokens('\n'.join(r['data'].load_lines() or [])) for r in records)
+            print(f"-- {workspace}: {len(records)} files, {source_tokens:,} source tokens, {len(cases)} cases --")
+            for budget in CONTEXT_BUDGETS:
+                for label, strategy in CONTEXT_STRATEGIES.items():
+                    kept = mentioned = wanted = tokens = 0
+                    elapsed = 0.0
+                    for prompt, symbols in cases:
+                        start = time.perf_counter()
+                        context = strategy(records, prompt, budget)
+                        elapsed += time.perf_counter() - start
+                        tokens += app.count_tokens(context)
+                        wanted += len(symbols)
+                        kept += sum(1 for symbol in symbols if defines_symbol(context, symbol))
+                        mentioned += sum(1 for symbol in symbols if re.search(rf"\b{re.escape(symbol)}\b", context))
+                    print(f"budget {budget:>5}  {label:<16} recall {kept / wanted:4.0%} ({kept}/{wanted}, "
+                          f"{mentioned}/{wanted} named)  avg {tokens / len(cases):6.0f} tokens  "
+                          f"{kept / max(tokens, 1) * 1000:5.2f} per 1k tokens  {elapsed / len(cases) * 1000:6.1f} ms/pack")
+
+# --- CONTEXT DEDUPLICATION ---
+BOILERPLATE_HEADER = [
+    '# Copyright (c) 2024 Example Corp. All rights reserved.',
+    '# Licensed under the Apache License, Version 2.0 (the "License");',
+    '# you may not use this file except in compliance with the License.',
+    '# You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0',
+    '# Unless required by applicable law or agreed to in writing, software distributed',
+    '# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES.',
+    'import os', 'import sys', 'import json', 'import logging',
+    'from typing import Any, Dict, List, Optional', '',
+    'logger = logging.getLogger(__name__)', '',
+]
+
+def generated_boilerplate_services(directory: str, services: int = 12) -> List[str]:
+    """Write services that share a license header, an import block and a generated client stub"""
+    paths = []
+    for index in range(services):
+        name = f"service_{index}"
+        lines = list(BOILERPLATE_HEADER)
+        lines += ['class GeneratedClient:', '    """Generated by apigen; do not edit"""', '',
+                  '    def __init__(self, base_url: str, timeout: float = 10.0):',
+                  '        self.base_url = base_url', '        self.timeout = timeout', '',
+                  '    def request(self, method: str, path: str, body: Optional[Dict[str, Any]] = None):',
+                  "        logger.debug('%s %s', method, path)",
+                  "        return {'method': method, 'url': self.base_url + path, 'body': json.dumps(body or {})}", '']
+        lines += [f"def handle_{name}(event, client=None):", f'    """Handle one {name} event"""',
+                  '    client = client or GeneratedClient(os.environ.get("API_URL", ""))']
+        lines += [f"    field_{i} = event.get('{name}_{i}')" for i in range(6)]
+        lines += [f"    return client.request('POST', '/{name}', {{'field_0': field_0}})", '']
+        path = f"{directory}/{name}.py"
+        with open(path, 'w') as handle:
+            handle.write('\n'.join(lines) + '\n')
+        paths.append(path)
+    return paths
+
+def bench_dedup():
+    import tempfile
+    analyzer = app.ASTContextAnalyzer()
+    prompt = "handle_service_3 and handle_service_7 send the wrong request body through GeneratedClient"
+    required = ['handle_service_3', 'handle_service_7', 'GeneratedClient']
+    with tempfile.TemporaryDirectory() as directory:
+        records = [{'type': 'file', 'data': analyzer.analyze_file(path, 'python')}
+                   for path in generated_boilerplate_services(directory)]
+        min_lines = app.DEFAULT_CONFIG['dedupMinLines']
+        for budget in (4000, 1500):
+            for label, setting in (('no dedup', 0), ('dedup', min_lines)):
+                app.DEFAULT_CONFIG['dedupMinLines'] = setting
+                report = {}
+                try:
+                    start = time.perf_counter()
+                    fixed = app.prompt_registry.max_token_count + app.prompt_registry.context_framing_tokens
+                    reserved = app.DEFAULT_CONFIG['maxInputTokens'] - app.count_tokens(prompt) - fixed - budget
+                    context = app.build_context(records, prompt, reserved, report)
+                    elapsed = time.perf_counter() - start
+                finally:
+                    app.DEFAULT_CONFIG['dedupMinLines'] = min_lines
+                kept = sum(1 for symbol in required if defines_symbol(context, symbol))
+                print(f"budget {budget:>5}  {label:<9} {app.count_tokens(context):5} tokens  definitions {kept}/{len(required)}"
+                      f"  blocks replaced {report.get('dedup_blocks', 0):3}  tokens saved {report.get('dedup_tokens_saved', 0):5}"
+                      f"  {elapsed * 1000:6.1f} ms")
+
+# --- NEAR-DUPLICATE FILES ---
+def generated_vendored_copies(directory: str, modules: int = 10) -> List[str]:
+    """Write modules, then a vendor/ copy of each with a few lines edited, as copied-in libraries drift"""
+    import os
+    rng = random.Random(7)
+    os.makedirs(f"{directory}/vendor")
+    paths = generated_python_modules(directory, modules)
+    for path in list(paths):
+        with open(path) as handle:
+            lines = handle.read().split('\n')
+        for index in rng.sample(range(len(lines)), max(1, len(lines) // 40)):
+            lines[index] = '# patched locally'
+        copy = f"{directory}/vendor/{os.path.basename(path)}"
+        with open(copy, 'w') as handle:
+            handle.write('\n'.join(lines))
+        paths.append(copy)
+    return paths
+
+def bench_duplicates(index_files: int = 2000):
+    import os
+    import glob
+    import tempfile
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    prompt = "explain how the request flows through these modules"
+    threshold = app.DEFAULT_CONFIG['nearDuplicateThreshold']
+    with tempfile.TemporaryDirectory() as directory:
+        workspaces = {
+            'vendored copies': generated_vendored_copies(directory),
+            'src/ + out/': sorted(glob.glob(f"{repo}/src/*.ts")) + sorted(glob.glob(f"{repo}/out/*.js")),
+        }
+        for workspace, paths in workspaces.items():
+            files = [{'path': path, 'language': app.UPLOAD_LANGUAGES.get(os.path.splitext(path)[1], 'unknown')}
+                     for path in paths]
+            for label, setting in (('warm-up', None), ('off', 0), ('on', threshold)):
+                app.DEFAULT_CONFIG['nearDuplicateThreshold'] = setting or 0
+                try:
+                    start = time.perf_counter()
+                    pipeline = app.AnalysisPipeline(files, [], prompt, [])
+                    context = app.build_context(pipeline, prompt)
+                    report = app.near_duplicate_report(pipeline.finish())
+                    elapsed = time.perf_counter() - start
+                finally:
+                    app.DEFAULT_CONFIG['nearDuplicateThreshold'] = threshold
+                if setting is None:
+                    continue
+                print(f"{workspace:<16} {label:<3} {len(paths):3} files  {report['near_duplicates']:2} listed by name"
+                      f"  {app.count_tokens(context):6} context tokens  saved {report['duplicate_bytes_saved']:7} bytes"
+                      f" / {report['duplicate_tokens_saved']:6} tokens  {elapsed * 1000:7.1f} ms")
+
+    # Indexing cost grows with the number of files, not the number of pairs;
+    # tests/test_duplicates.py checks what is matched
+    rng = random.Random(3)
+    words = [f"name_{i}" for i in range(5000)]
+    documents = [' '.join(rng.choice(words) for _ in range(400)).encode() for _ in range(index_files)]
+    for count in (index_files // 4, index_files // 2, index_files):
+        index = app.NearDuplicateIndex()
+        start = time.perf_counter()
+        for number, document in enumerate(documents[:count]):
+            index.match(f"f{number}.py", document)
+        elapsed = time.perf_counter() - start
+        print(f"index {count:5} distinct files  {elapsed * 1000:7.1f} ms"
+              f"  ({elapsed / count * 1e6:5.0f} us/file)")
+
+# --- SUMMARY CACHE ---
+def bench_summaries(rounds: int = 20):
+    import tempfile
+    analyzer = app.ASTContextAnalyzer()
+    with tempfile.TemporaryDirectory() as directory:
+        results = [{'type': 'file', 'data': analyzer.analyze_file(path, 'python')}
+                   for path in generated_python_modules(directory)]
+        levels = app.summary_cache.file_summaries(results[0]['data'])
+        print('tokens per level: ' + ', '.join(f"{level} {tokens}" for level, (_, tokens) in levels.items()))
+        for label, warm in (('cold cache', False), ('warm cache', True)):
+            start = time.perf_counter()
+            for _ in range(rounds):
+                if not warm:
+                    app.summary_cache = app.SummaryCache(app.DEFAULT_CONFIG['summaryCacheEntries'])
+                app.build_context(results, CHUNK_CASES[0][0])
+            elapsed = (time.perf_counter() - start) / rounds
+            print(f"{label:<12} {elapsed * 1000:7.1f} ms/build  {app.summary_cache.snapshot()}")
+
+# --- TOKEN ACCOUNTING ---
+def bench_tokens():
+    import tempfile
+    if app.get_encoding() is None:
+        print("tiktoken encoding unavailable: exact counts fall back to len // 4, so CPU times understate the saving")
+    estimator = app.token_estimator = app.TokenEstimator(app.DEFAULT_CONFIG['tokenEstimateMargin'], 0)
+    analyzer = app.ASTContextAnalyzer()
+    with tempfile.TemporaryDirectory() as directory:
+        paths = generated_python_modules(directory)
+        contents = [open(path).read() for path in paths]
+        # Estimator accuracy is checked by tests/test_token_estimator.py
+        estimator.calibrate([(content, 'python') for content in contents[:5]])
+
+        results = [{'type': 'file', 'data': analyzer.analyze_file(path, 'python')} for path in paths]
+        chunk_texts = [chunk.text(content.split('\n')) for content, result in zip(contents, results)
+                       for chunk in result['data'].chunks]
+
+        # Before: every file and every chunk went through the tokenizer on each request
+        start = time.process_time()
+        legacy_chars = 0
+        for text in contents + chunk_texts:
+            app.count_tokens(text)
+            legacy_chars += len(text)
+        legacy_cpu = time.process_time() - start
+
+        # After: the same texts are estimated, and packing counts exactly only near the budget
+        start = time.process_time()
+        estimator.estimate_many(contents + chunk_texts, 'python')
+        estimate_cpu = time.process_time() - start
+        exact_chars = estimator.exact_chars
+        for prompt, _ in CHUNK_CASES:
+            app.build_context(results, prompt)
+        exact_per_request = (estimator.exact_chars - exact_chars) / len(CHUNK_CASES)
+        new_cpu = estimate_cpu + exact_per_request * legacy_cpu / legacy_chars
+        print(f"exact counting      {legacy_chars:>8} chars tokenized/request  {legacy_cpu * 1000:7.2f} ms tokenizer CPU")
+        print(f"adaptive precision  {exact_per_request:>8.0f} chars tokenized/request  {new_cpu * 1000:7.2f} ms tokenizer CPU")
+
+# --- ANALYSIS MEMORY ---
+def legacy_analyze_file(analyzer: 'app.ASTContextAnalyzer', path: str, language: str) -> Dict:
+    """The result dicts from before AnalysisRecord: full 'content' plus chunks carrying their text"""
+    with open(path, 'r', encoding='utf-8') as handle:
+        content = handle.read()
+    result = analyzer._analyze_by_language(content, path, language)
+    result['chunks'] = analyzer.chunker.chunk(content, language)
+    return result
+
+def bench_memory(copies: int = 100):
+    import gc
+    import os
+    import tempfile
+    import tracemalloc
+    analyzer = app.ASTContextAnalyzer()
+    prompt = CHUNK_CASES[0][0]
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for copy in range(copies):
+            os.mkdir(f"{directory}/{copy}")
+            paths += generated_python_modules(f"{directory}/{copy}")
+        size = sum(os.path.getsize(path) for path in paths)
+        print(f"{len(paths)} files, {size / 1e6:.1f} MB of source")
+
+        legacy = lambda path, language: legacy_analyze_file(analyzer, path, language)
+        for label, analyze in (('content dicts', legacy), ('slotted records', analyzer.analyze_file)):
+            gc.collect()
+            tracemalloc.start()
+            start = time.perf_counter()
+            results = [{'type': 'file', 'data': analyze(path, 'python')} for path in paths]
+            retained = tracemalloc.get_traced_memory()[0]
+            if label == 'slotted records':
+                app.build_context(results, prompt)
+            peak = tracemalloc.get_traced_memory()[1]
+            elapsed = time.perf_counter() - start
+            tracemalloc.stop()
+            del results
+            print(f"{label:<16} retained {retained / 1e6:7.1f} MB  peak {peak / 1e6:7.1f} MB  {elapsed:6.1f} s")
+
+# --- PRIORITY SCHEDULING ---
+def bench_priority(seconds: float = 5.0, bulk_clients: int = 16, slots: int = 4):
+    """Interactive latency while bulk clients saturate admission, FIFO vs weighted-fair priorities"""
+    url = start_mock_model_server(lambda: 0.05)
+    config = dict(app.DEFAULT_CONFIG, rateLimitRequestsPerMinute=100000, rateLimitTokensPerMinute=10 ** 9,
+                  hedgeEnabled=False)
+    payload = {'model': 'mock', 'messages': [{'role': 'user', 'content': 'hi'}], 'max_tokens': 16}
+
+    for label, prioritized in (('FIFO', False), ('priorities', True)):
+        router = app.EndpointRouter([app.ModelEndpoint(url, '', None, 1.0, config)], config)
+        controller = app.AdmissionController(slots, bulk_clients * 2, 30.0, 60.0)
+        stop = time.monotonic() + seconds
+        bulk_done = [0]
+        interactive = []
+
+        def request(priority: str):
+            priority = priority if prioritized else 'normal'
+            controller.acquire(priority=priority)
+            try:
+                router.call(payload, 10, priority=priority)
+            finally:
+                controller.release(priority)
+
+        def bulk_client():
+            while time.monotonic() < stop:
+                request('bulk')
+                bulk_done[0] += 1
+
+        def interactive_client():
+            while time.monotonic() < stop:
+                start = time.perf_counter()
+                request('interactive')
+                interactive.append(time.perf_counter() - start)
+                time.sleep(0.1)
+
+        threads = [threading.Thread(target=bulk_client) for _ in range(bulk_clients)]
+        threads.append(threading.Thread(target=interactive_client))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        print(f"{label:<11} interactive p50 {percentile(interactive, 50) * 1000:6.1f} ms"
+              f"  p95 {percentile(interactive, 95) * 1000:6.1f} ms  bulk {bulk_done[0] / seconds:5.1f} req/s")
+
+# --- OUTPUT SIZE PREDICTION ---
+# Per template: (prompt, median completion tokens); sizes vary log-normally around the median
+OUTPUT_CASES = [
+    ("give me just code for fizzbuzz", 150),
+    ("write a python script to rename files", 700),
+    ("create a flask app with a login page", 1400),
+    ("make a react app with a counter", 1100),
+    ("tell me a joke about programmers", 90),
+]
+
+def start_sized_model_server(lengths: Dict[str, int]) -> str:
+    """A mock whose completion size is looked up by prompt and cut at max_tokens, as a real upstream would"""
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            wanted = lengths[payload['messages'][-1]['content']]
+            produced = min(wanted, payload['max_tokens'])
+            body = json.dumps({
+                'choices': [{'message': {'content': 'word ' * produced},
+                             'finish_reason': 'length' if wanted > payload['max_tokens'] else 'stop'}],
+                'usage': {'prompt_tokens': 10, 'completion_tokens': produced, 'total_tokens': 10 + produced}
+            }).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}/v1/chat/completions"
+
+def bench_output(calls: int = 400):
+    """max_tokens reserved vs. completion tokens used, fixed limit vs. learned per-template limits"""
+    rng = random.Random(11)
+    prompts, lengths = [], {}
+    for number in range(calls):
+        prompt, median = OUTPUT_CASES[number % len(OUTPUT_CASES)]
+        prompt = f"{prompt} #{number}"
+        lengths[prompt] = max(1, min(app.DEFAULT_CONFIG['maxTokens'], int(rng.lognormvariate(0, 0.35) * median)))
+        prompts.append(prompt)
+    url = start_sized_model_server(lengths)
+    config = dict(app.DEFAULT_CONFIG, modelApiUrl=url, modelEndpoints=[], hedgeEnabled=False,
+                  rateLimitRequestsPerMinute=10 ** 6, rateLimitTokensPerMinute=10 ** 9)
+    min_samples = app.DEFAULT_CONFIG['outputMinSamples']
+    for label, setting in (('fixed', 10 ** 9), ('predicted', min_samples)):
+        app.DEFAULT_CONFIG['outputMinSamples'] = setting
+        app.output_size_model = app.OutputSizeModel()
+        client = app.ModelAPIClient(config)
+        try:
+            start = time.perf_counter()
+            # The first third trains the model; the rest is measured
+            for prompt in prompts[:calls // 3]:
+                client.generate_full_response(prompt)
+            trained = app.output_size_model.snapshot()
+            incomplete = sum(1 for prompt in prompts[calls // 3:]
+                             if len(client.generate_full_response(prompt).split()) < lengths[prompt])
+            elapsed = time.perf_counter() - start
+            totals = app.output_size_model.snapshot()
+        finally:
+            app.DEFAULT_CONFIG['outputMinSamples'] = min_samples
+        reserved = totals['reserved_tokens'] - trained['reserved_tokens']
+        used = totals['used_tokens'] - trained['used_tokens']
+        print(f"{label:<10} reserved {reserved:8} used {used:7}  utilization {used / reserved:5.1%}"
+              f"  truncated {totals['truncated'] - trained['truncated']:3}  retries {totals['retries'] - trained['retries']:3}"
+              f"  incomplete answers {incomplete}  {elapsed:5.2f} s")
+        for template, counters in sorted(totals['templates'].items()):
+            before = trained['templates'][template]
+            print(f"    {template:<14} max_tokens {counters['max_tokens']:5}"
+                  f"  utilization {(counters['used'] - before['used']) / (counters['reserved'] - before['reserved']):5.1%}")
+
+BENCHMARKS: Dict[str, Callable[[], None]] = {
+    'classifier': bench_classifier,
+    'hedging': bench_hedging,
+    'scanner': bench_scanner,
+    'context': bench_context,
+    'dedup': bench_dedup,
+    'duplicates': bench_duplicates,
+    'summaries': bench_summaries,
+    'tokens': bench_tokens,
+    'memory': bench_memory,
+    'priority': bench_priority,
+    'output': bench_output,
+}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print(f"== {name} ==")
+        BENCHMARKS[name]()
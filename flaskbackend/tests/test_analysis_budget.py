@@ -0,0 +1,128 @@
+import threading
+import time
+
+import pytest
+
+import app
+
+
+class FakeConn:
+    def __init__(self, record):
+        self.record = record
+        self.poll_timeouts = []
+
+    def send(self, job):
+        pass
+
+    def poll(self, timeout):
+        self.poll_timeouts.append(timeout)
+        return True
+
+    def recv(self):
+        return self.record
+
+
+@pytest.fixture
+def module(tmp_path):
+    path = tmp_path / 'small.py'
+    path.write_text('def add(a, b):\n    return a + b\n')
+    return str(path)
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    stats = app.AnalysisStats()
+    pool = app.AnalysisWorkerPool(1, stats)
+    pool._started = True
+    monkeypatch.setattr(app, 'analysis_pool', pool)
+    monkeypatch.setattr(app, 'analysis_stats', stats)
+    return pool
+
+
+def test_small_files_still_go_to_the_pool(tmp_path, pool, monkeypatch):
+    nested = tmp_path / 'nested.yaml'
+    nested.write_text('a: ' + '[' * 15000)
+    calls = []
+
+    def overrun(file_path, language, timeout, *args):
+        calls.append(timeout)
+        return None
+    monkeypatch.setattr(pool, 'analyze', overrun)
+    result = app.analyze_file_with_budget(app.ASTContextAnalyzer(), str(nested), 'yaml', time.monotonic() + 5)
+    assert calls == [app.DEFAULT_CONFIG['analysisFileBudget']]
+    assert result.degraded
+    assert app.analysis_stats.snapshot()['degraded_by_reason'] == {'file_budget': 1}
+
+
+def test_file_budget_starts_when_a_worker_picks_the_file_up(module, pool, monkeypatch):
+    conn = FakeConn(app.ASTContextAnalyzer().analyze_file(module, 'python'))
+
+    def slow_take_idle(priority, timeout):
+        time.sleep(0.3)
+        return (None, conn)
+    monkeypatch.setattr(pool, '_take_idle', slow_take_idle)
+    monkeypatch.setattr(pool, '_put_idle', lambda worker: None)
+    monkeypatch.setitem(app.DEFAULT_CONFIG, 'analysisFileBudget', 0.5)
+    result = app.analyze_file_with_budget(app.ASTContextAnalyzer(), module, 'python', time.monotonic() + 10)
+    assert not result.degraded
+    assert conn.poll_timeouts[0] > 0.45
+    snapshot = app.analysis_stats.snapshot()
+    assert snapshot['max_queue_wait_ms'] >= 300
+    assert snapshot['max_analysis_ms'] < 300
+
+
+def test_no_free_worker_is_reported_as_a_queue_timeout(module, pool, monkeypatch):
+    monkeypatch.setattr(pool, '_take_idle', lambda priority, timeout: None)
+    result = app.analyze_file_with_budget(app.ASTContextAnalyzer(), module, 'python', time.monotonic() + 5)
+    assert result.degraded
+    assert app.analysis_stats.snapshot()['degraded_by_reason'] == {'queue': 1}
+
+
+def test_losing_the_last_worker_fails_fast(module, pool, monkeypatch):
+    monkeypatch.setitem(app.DEFAULT_CONFIG, 'analysisRespawnBackoff', 0.05)
+    spawned = threading.Event()
+
+    def spawn():
+        if not spawned.is_set():
+            raise RuntimeError('fork failed')
+        return (None, None)
+    monkeypatch.setattr(pool, '_spawn', spawn)
+    waited = []
+    waiter = threading.Thread(target=lambda: waited.append(pool._take_idle('normal', 10.0)))
+    waiter.start()
+    respawner = threading.Thread(target=pool._respawn, daemon=True)
+    respawner.start()
+    try:
+        waiter.join(2.0)
+        assert waited == [None]
+        assert not pool.available
+        # With no worker alive, files are analyzed in-process instead of queueing until the deadline
+        result = app.analyze_file_with_budget(app.ASTContextAnalyzer(), module, 'python', time.monotonic() + 10)
+        assert not result.degraded
+        assert app.analysis_stats.snapshot()['analyzed_in_process'] == 1
+
+        spawned.set()
+        respawner.join(2.0)
+        assert pool.available
+        assert pool._idle == [(None, None)]
+    finally:
+        pool.shutdown()
+
+
+def test_overrunning_worker_is_killed_and_replaced(tmp_path, module):
+    slow = tmp_path / 'slow.py'
+    slow.write_text('\n'.join(f"def f{i}(x):\n    return x + {i}\n" for i in range(20000)))
+    stats = app.AnalysisStats()
+    pool = app.AnalysisWorkerPool(1, stats)
+    try:
+        assert pool._ensure_started()
+        (process, _), = pool._workers
+        assert pool.analyze(str(slow), 'python', 0.05) is None
+        assert not process.is_alive()
+        assert stats.snapshot()['worker_restarts'] == 1
+        # The replacement is spawned in the background; the next file waits for it
+        result = pool.analyze(module, 'python', 30.0)
+        assert [function['name'] for function in result.functions] == ['add']
+        assert pool._workers[0][0] is not process
+    finally:
+        pool.shutdown()
@@ -0,0 +1,47 @@
+import base64
+import json
+
+import app
+
+
+class FakeResponse:
+    status_code = 200
+    headers = {}
+
+    def __init__(self, body):
+        self.body = body
+        self.text = json.dumps(body)
+
+    def json(self):
+        return self.body
+
+
+def module_source(prefix: str, count: int = 150) -> bytes:
+    functions = [f"def {prefix}_handler_{i}(event, store):\n"
+                 f"    record = store.load(event['{prefix}_{i}'])\n"
+                 f"    record.update(status='{prefix} step {i}', retries=event.get('retries', 0) + {i})\n"
+                 f"    return store.save(record)\n" for i in range(count)]
+    return '\n'.join(functions).encode()
+
+
+def test_each_batch_item_packs_chunks_for_its_own_prompt(monkeypatch):
+    sent = {}
+
+    def fake_post(url, json=None, headers=None, timeout=None, **kwargs):
+        message = json['messages'][-1]['content']
+        sent[message.rsplit('\n', 1)[-1]] = message
+        return FakeResponse({'choices': [{'message': {'content': '## 📋 Analysis\nok'}, 'finish_reason': 'stop'}],
+                             'usage': {'prompt_tokens': 10, 'completion_tokens': 5, 'total_tokens': 15}})
+
+    monkeypatch.setattr(app.requests, 'post', fake_post)
+    files = [{'name': 'alpha.py', 'content': base64.b64encode(module_source('alpha')).decode()},
+             {'name': 'beta.py', 'content': base64.b64encode(module_source('beta')).decode()}]
+    prompts = ['why does alpha_handler_3 retry forever', 'fix the status written by beta_handler_140 please']
+    response = app.app.test_client().post('/api/analyze-and-execute/batch', json={'prompts': prompts, 'files': files})
+
+    assert response.status_code == 200
+    assert response.json['succeeded'] == 2
+    alpha = next(message for message in sent.values() if 'alpha_handler_3 retry' in message)
+    beta = next(message for message in sent.values() if 'beta_handler_140 please' in message)
+    assert 'def alpha_handler_3(' in alpha and 'def beta_handler_140(' not in alpha
+    assert 'def beta_handler_140(' in beta and 'def alpha_handler_3(' not in beta
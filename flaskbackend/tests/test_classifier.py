@@ -0,0 +1,47 @@
+import pytest
+
+import app
+
+# Labeled (prompt, context, expected template) cases
+CLASSIFIER_CASES = [
+    ("build a sentiment analyzer with nlp", "", "nlp_app"),
+    ("natural language processing pipeline for reviews", "", "nlp_app"),
+    ("create an angular dashboard", "", "angular_app"),
+    ("typescript react component for a todo list", "", "react_app"),
+    ("write a java program that reverses a string", "", "java"),
+    ("set up a maven project", "", "java"),
+    ("fix this bug", "📄 File: src/Main.java\n🔤 Language: java\n", "java"),
+    ("write c code to sort an array", "", "c"),
+    ("compile with gcc and fix the warnings", "", "c"),
+    ("fix the segfault", "📄 File: main.c\n🔤 Language: c\n#include <stdio.h>\n", "c"),
+    ("create a flask app with a login page", "", "flask_app"),
+    ("create a flask app", "📄 File: util.py\n🔤 Language: python\n" * 20, "flask_app"),
+    ("add an endpoint", "📄 File: server.py\n📦 Imports: from flask import Flask\n", "flask_app"),
+    ("build a fastapi service for todos", "", "fastapi_app"),
+    ("make a react app with a counter", "", "react_app"),
+    ("plot a histogram from a csv with pandas", "", "data_analysis"),
+    ("load a dataframe and compute averages", "", "data_analysis"),
+    ("make a web app for a portfolio", "", "webapp"),
+    ("style the page", "📄 File: index.html\n🔤 Language: html\n", "webapp"),
+    ("write a nodejs script that reads a file", "", "nodejs"),
+    ("write a python script to rename files", "", "python_script"),
+    ("add logging", "📄 File: tool.py\n🔤 Language: python\n", "python_script"),
+    ("give me just code for fizzbuzz", "", "minimal"),
+    ("tell me a joke about programmers", "", "default"),
+    # The old substring rules routed these on "c"/"py"/"java" inside other words
+    ("explain the architecture of this project", "copy the config into place", "default"),
+    ("summarize this", "📄 File: notes.txt\nhappy path, copy and paste", "default"),
+    ("write unit tests", "📄 File: app.js\n🔤 Language: javascript\n", "webapp"),
+]
+
+
+@pytest.mark.parametrize('prompt, context, expected', CLASSIFIER_CASES)
+def test_classifier_picks_the_labeled_template(prompt, context, expected):
+    assert app.select_system_prompt(prompt, context) == expected
+
+
+def test_classifier_only_scans_the_head_and_tail_of_a_long_context():
+    filler = 'plain notes about the project\n' * (app.DEFAULT_CONFIG['classifierContextChars'] // 10)
+    marker = '📄 File: main.c\n🔤 Language: c\n'
+    assert app.select_system_prompt('fix the segfault', filler + marker) == 'c'
+    assert app.select_system_prompt('fix the segfault', filler + marker + filler) == 'default'
@@ -0,0 +1,38 @@
+import app
+
+
+def write_module(tmp_path, functions: int = 40) -> str:
+    path = tmp_path / 'orders.py'
+    path.write_text('\n'.join(
+        f"def order_step_{i}(order, ledger):\n"
+        f"    total = sum(line.price * line.quantity for line in order.lines if line.sku != 'skip_{i}')\n"
+        f"    ledger.append({{'order': order.id, 'step': {i}, 'total': total}})\n"
+        f"    return total\n" for i in range(functions)))
+    return str(path)
+
+
+def test_packed_chunks_are_charged_their_exact_size(tmp_path):
+    record = app.ASTContextAnalyzer().analyze_file(write_module(tmp_path), 'python')
+    assert record.chunks
+    for budget in (120, 400, 900):
+        selected = app.select_chunks([record], 'how is the order total computed in order_step ledger', budget)
+        texts = [text for chunks in selected.values() for _, text in chunks]
+        assert texts
+        assert sum(app.count_tokens(text) for text in texts) <= budget
+
+
+def chunked_record(path: str, boundaries, ref: app.ContentRef) -> app.AnalysisRecord:
+    chunks = [app.ChunkRecord('function', f'step_{start}', [f'step_{start}'], start, end, 10, ())
+              for start, end in boundaries]
+    return app.AnalysisRecord(file_path=path, language='python', chunks=chunks, content_ref=ref)
+
+
+def test_dependency_node_follows_moved_chunk_boundaries(tmp_path):
+    # Recalibrated token estimates can split an unchanged file into different chunks
+    graph = app.DependencyGraph(10)
+    ref = app.ContentRef(str(tmp_path / 'orders.py'), 1, 100)
+    wide = graph.node(chunked_record(ref.path, [(1, 10), (11, 20), (21, 30)], ref))
+    assert graph.node(chunked_record(ref.path, [(1, 10), (11, 20), (21, 30)], ref)) is wide
+    narrow = graph.node(chunked_record(ref.path, [(1, 15), (16, 30)], ref))
+    assert narrow is not wide
+    assert max(index for indexes in narrow.defines.values() for index in indexes) == 1
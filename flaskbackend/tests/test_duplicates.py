@@ -0,0 +1,73 @@
+import random
+
+import app
+
+
+def duplicate_record(representative: str, similarity: float) -> app.AnalysisRecord:
+    return app.AnalysisRecord(file_path='vendor/util.py', language='python', size=4096, token_count=900,
+                              details={'duplicate_of': representative, 'similarity': similarity})
+
+
+def test_summary_follows_the_current_representative():
+    cache = app.SummaryCache(100)
+    first = cache.file_summary(duplicate_record('src/util.py', 0.91), 'full')[0]
+    second = cache.file_summary(duplicate_record('lib/util.py', 0.91), 'full')[0]
+    assert '≈ src/util.py' in first
+    assert '≈ lib/util.py' in second
+
+
+def test_skipped_and_analyzed_records_do_not_share_a_summary():
+    cache = app.SummaryCache(100)
+    skipped = app.AnalysisRecord(file_path='a.py', language='python', token_count=10, details={'skipped': 'context budget'})
+    analyzed = app.AnalysisRecord(file_path='a.py', language='python', token_count=10)
+    assert cache.file_digest(skipped) != cache.file_digest(analyzed)
+
+
+def test_index_matches_edited_copy_but_not_a_different_file():
+    index = app.NearDuplicateIndex()
+    original = '\n'.join(f"def handler_{i}(event):\n    return process(event, {i})" for i in range(60)).encode()
+    edited = original.replace(b'handler_7(', b'handler_seven(')
+    other = '\n'.join(f"class Model{i}:\n    field = {i * 3}" for i in range(60)).encode()
+    assert index.match('a.py', original) is None
+    representative, similarity = index.match('vendor/a.py', edited)
+    assert representative == 'a.py' and similarity >= 0.8
+    assert index.match('models.py', other) is None
+
+
+def module_source(noun: str) -> str:
+    lines = ['import math', '']
+    for verb in ('load', 'save', 'check', 'merge', 'render', 'parse', 'compute', 'format'):
+        lines += [f"def {verb}_{noun}(record, options=None):"]
+        lines += [f"    value_{i} = record.get('{noun}_{i}', 0) * math.sqrt({i + 1})" for i in range(8)]
+        lines += ["    return value_0 + value_1", '']
+    return '\n'.join(lines)
+
+
+def test_pipeline_lists_vendored_copies_by_name(tmp_path):
+    files = []
+    for noun in ('order', 'invoice', 'parcel'):
+        source = module_source(noun)
+        (tmp_path / f'{noun}.py').write_text(source)
+        lines = source.split('\n')
+        lines[5] = '# patched locally'
+        (tmp_path / 'vendor').mkdir(exist_ok=True)
+        (tmp_path / 'vendor' / f'{noun}.py').write_text('\n'.join(lines))
+        files += [{'path': str(tmp_path / f'{noun}.py'), 'language': 'python'},
+                  {'path': str(tmp_path / 'vendor' / f'{noun}.py'), 'language': 'python'}]
+    pipeline = app.AnalysisPipeline(files, [], 'explain the order flow', [])
+    context = app.build_context(pipeline, 'explain the order flow')
+    report = app.near_duplicate_report(pipeline.finish())
+    assert report['near_duplicates'] == 3
+    assert report['duplicate_tokens_saved'] > 0
+    for noun in ('order', 'invoice', 'parcel'):
+        assert f"≈ {tmp_path / noun}.py" in context
+
+
+def test_distinct_files_never_match():
+    rng = random.Random(3)
+    words = [f"name_{i}" for i in range(5000)]
+    index = app.NearDuplicateIndex()
+    matches = [number for number in range(300)
+               if index.match(f"f{number}.py", ' '.join(rng.choice(words) for _ in range(400)).encode())]
+    assert matches == []
+
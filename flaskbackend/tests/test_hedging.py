@@ -0,0 +1,113 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import app
+
+
+@pytest.fixture(autouse=True)
+def no_proxy(monkeypatch):
+    monkeypatch.setenv('NO_PROXY', '127.0.0.1,localhost')
+
+
+@pytest.fixture
+def mock_server():
+    servers = []
+
+    def start(latency: float, status: int = 200) -> str:
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                time.sleep(latency)
+                body = json.dumps({
+                    'choices': [{'message': {'content': f'{latency}'}, 'finish_reason': 'stop'}],
+                    'usage': {'prompt_tokens': 10, 'completion_tokens': 5, 'total_tokens': 15}
+                }).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # A losing hedge the router aborted
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_port}/v1/chat/completions"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def make_router(urls, **overrides):
+    config = dict(app.DEFAULT_CONFIG, rateLimitRequestsPerMinute=100000, rateLimitTokensPerMinute=10 ** 6,
+                  hedgeDefaultDelay=0.05, maxRetries=0, timeout=10, **overrides)
+    endpoints = [app.ModelEndpoint(url, '', None, 1.0 if i == 0 else 0.0, config) for i, url in enumerate(urls)]
+    for endpoint in endpoints:
+        endpoint.rate_limiter._refill = lambda now: None
+    return app.EndpointRouter(endpoints, config)
+
+
+def test_losing_hedge_is_aborted_and_refunded(mock_server):
+    router = make_router([mock_server(3.0), mock_server(0.0)])
+    slow = router.endpoints[0]
+    before = slow.rate_limiter.token_level
+
+    start = time.monotonic()
+    data = router.call({'messages': [], 'max_tokens': 16}, 100)
+    assert data['choices'][0]['message']['content'] == '0.0'
+    assert router.snapshot()['hedges_won'] == 1
+
+    # The loser's socket is shut down, so its thread finishes long before the 3 s response
+    while slow.rate_limiter.token_level != before and time.monotonic() - start < 2.0:
+        time.sleep(0.01)
+    assert slow.rate_limiter.token_level == before
+    assert time.monotonic() - start < 2.0
+    # Losing a race is not an endpoint failure
+    assert slow.snapshot()['calls'] == 0
+
+
+def test_expired_deadline_is_not_an_endpoint_failure(mock_server):
+    router = make_router([mock_server(0.0), mock_server(0.0)])
+    for _ in range(5):
+        with pytest.raises(app.DeadlineExceeded):
+            router.call({'messages': [], 'max_tokens': 16}, 10, deadline=time.monotonic() - 1)
+    stats = router.snapshot()
+    # Nothing was sent, so no endpoint is charged and nothing fails over
+    assert stats['failovers'] == 0
+    assert [(e['circuit'], e['calls'], e['errors']) for e in stats['endpoints']] == [('closed', 0, 0)] * 2
+
+
+def test_failures_fail_over_and_open_the_circuit(mock_server):
+    router = make_router([mock_server(0.0, status=500), mock_server(0.0)], circuitOpenSeconds=60)
+    failing = router.endpoints[0]
+    for _ in range(20):
+        assert router.call({'messages': [], 'max_tokens': 16}, 10)['choices']
+    stats = router.snapshot()
+    minimum = app.DEFAULT_CONFIG['circuitMinCalls']
+    # Once the circuit opens, calls go straight to the healthy endpoint
+    assert stats['failovers'] == minimum
+    assert stats['endpoints'][0]['circuit'] == 'open'
+    assert failing.snapshot()['calls'] == minimum
+    assert stats['endpoints'][1]['calls'] == 20
+
+
+def test_half_open_trial_closes_a_recovered_circuit(mock_server):
+    router = make_router([mock_server(0.0), mock_server(0.0)], circuitOpenSeconds=0)
+    primary = router.endpoints[0]
+    for _ in range(app.DEFAULT_CONFIG['circuitMinCalls']):
+        primary.record(False, 0.01)
+    assert primary.snapshot()['circuit'] == 'open'
+    router.call({'messages': [], 'max_tokens': 16}, 10)
+    assert primary.snapshot()['circuit'] == 'closed'
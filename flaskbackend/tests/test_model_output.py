@@ -0,0 +1,66 @@
+import pytest
+
+import app
+
+
+class FakeRouter:
+    """Answers from a script: a finish_reason per call, or an exception to raise"""
+
+    def __init__(self, *script):
+        self.script = list(script)
+        self.payloads = []
+
+    def call(self, payload, input_tokens, deadline=None, priority=None):
+        self.payloads.append(payload)
+        step = self.script.pop(0)
+        if isinstance(step, Exception):
+            raise step
+        return {'choices': [{'message': {'content': '## Analysis\ncut off mid'}, 'finish_reason': step}],
+                'usage': {'completion_tokens': 256}}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(app.output_size_model, 'predict', lambda template, features: 256)
+    client = app.ModelAPIClient(dict(app.DEFAULT_CONFIG))
+    monkeypatch.setattr(app, 'model_client', client)
+    return client
+
+
+def test_long_history_is_trimmed_before_the_prompt(client):
+    client.config['maxInputTokens'] = 2000
+    client.router = FakeRouter('stop')
+    history = []
+    for turn in range(6):
+        history += [{'role': 'user', 'content': f'question {turn} ' + 'q' * 1200},
+                    {'role': 'assistant', 'content': f'answer {turn} ' + 'a' * 1200}]
+    history_tokens = sum(app.count_tokens(message['content']) for message in history)
+    prompt = 'explain the latest change ' + 'p' * 2000
+    client.generate_full_response(prompt, 'def f():\n    pass\n' * 400, history, history_tokens)
+
+    messages = client.router.payloads[0]['messages']
+    assert sum(app.count_tokens(message['content']) for message in messages) <= 2000
+    # The newest turns survive, in whole user/assistant pairs, and the prompt is still sent
+    assert messages[-1]['content'] == prompt
+    assert messages[-2]['content'].startswith('answer 5')
+    assert [message['role'] for message in messages[1:-1]] == ['user', 'assistant'] * ((len(messages) - 2) // 2)
+
+
+def test_failed_retry_after_truncation_is_reported(client):
+    client.router = FakeRouter('length', RuntimeError('upstream down'))
+    report = {}
+    output = client.generate_full_response('summarize', '', report=report)
+    assert output.endswith('cut off mid')
+    assert report == {'truncated': True}
+
+
+def test_truncated_answer_is_not_remembered_by_the_session(client, monkeypatch):
+    client.router = FakeRouter('length', RuntimeError('upstream down'))
+    store = app.SessionStore(max_sessions=2, idle_seconds=60)
+    monkeypatch.setattr(app, 'session_store', store)
+    api = app.app.test_client()
+    session_id = api.post('/api/sessions', json={}).get_json()['session_id']
+    response = api.post(f'/api/sessions/{session_id}/turns', json={'prompt': 'summarize the design'}).get_json()
+    assert response['success'] and response['partial'] and response['truncated']
+    assert response['turn'] == 0
+    assert not store.get(session_id).turns
@@ -0,0 +1,71 @@
+import pytest
+import requests
+
+import app
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.headers = {}
+        self.text = ''
+        self._body = body
+
+    def json(self):
+        if isinstance(self._body, Exception):
+            raise self._body
+        return self._body
+
+
+def make_endpoint():
+    config = dict(app.DEFAULT_CONFIG, rateLimitRequestsPerMinute=1000, rateLimitTokensPerMinute=100000,
+                  rateLimitMaxWait=1.0, maxRetries=0, maxTokens=4096)
+    endpoint = app.ModelEndpoint('http://upstream.invalid/v1/chat/completions', 'key', None, 1.0, config)
+    # Freeze refills so the level only moves by reservations and refunds
+    endpoint.rate_limiter._refill = lambda now: None
+    return endpoint
+
+
+def post(endpoint, monkeypatch, outcome):
+    def fake_post(*args, **kwargs):
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+    monkeypatch.setattr(app.requests, 'post', fake_post)
+    endpoint.post({'max_tokens': 500}, input_tokens=2000)
+
+
+def test_unsent_request_refunds_the_whole_reservation(monkeypatch):
+    endpoint = make_endpoint()
+    before = endpoint.rate_limiter.token_level
+    for _ in range(20):
+        with pytest.raises(requests.exceptions.ConnectionError):
+            post(endpoint, monkeypatch, requests.exceptions.ConnectionError('refused'))
+    assert endpoint.rate_limiter.token_level == before
+
+
+def test_failed_call_without_usage_only_keeps_the_prompt(monkeypatch):
+    endpoint = make_endpoint()
+    before = endpoint.rate_limiter.token_level
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        post(endpoint, monkeypatch, requests.exceptions.ReadTimeout('slow'))
+    assert endpoint.rate_limiter.token_level == before - 2000
+    with pytest.raises(Exception, match='status 500'):
+        post(endpoint, monkeypatch, FakeResponse(500))
+    assert endpoint.rate_limiter.token_level == before - 4000
+
+
+def test_unparseable_success_still_settles_the_reservation(monkeypatch):
+    endpoint = make_endpoint()
+    before = endpoint.rate_limiter.token_level
+    with pytest.raises(ValueError):
+        post(endpoint, monkeypatch, FakeResponse(200, ValueError('truncated body')))
+    assert endpoint.rate_limiter.token_level == before - 2000
+
+
+def test_usage_reconciles_the_reservation(monkeypatch):
+    endpoint = make_endpoint()
+    before = endpoint.rate_limiter.token_level
+    usage = {'prompt_tokens': 1900, 'completion_tokens': 120, 'total_tokens': 2020}
+    post(endpoint, monkeypatch, FakeResponse(200, {'choices': [], 'usage': usage}))
+    assert endpoint.rate_limiter.token_level == before - 2020
@@ -0,0 +1,103 @@
+import base64
+import hashlib
+import os
+
+import pytest
+
+import app
+
+
+def attach_upload(session, tmp_path, name='a.py'):
+    upload = tmp_path / name
+    upload.write_text('x = 1\n')
+    record = app.AnalysisRecord(file_path=name, language='python')
+    assert session.put(name, 'sha', {'type': 'file', 'data': record}, 1 << 20, str(upload))
+    return str(upload)
+
+
+def test_sessions_in_use_are_not_evicted(tmp_path):
+    store = app.SessionStore(max_sessions=1, idle_seconds=60)
+    busy = store.create()
+    upload = attach_upload(busy, tmp_path)
+    busy.last_used -= 3600  # Idle by the clock, but a turn still holds it
+
+    other = store.create()
+    store.release(other)
+    assert store.get(busy.id) is busy
+    assert os.path.exists(upload)
+    assert store.snapshot()['in_use'] == 1
+
+    store.release(busy)
+    third = store.create()
+    store.release(third)
+    assert store.get(busy.id) is None
+    assert store.snapshot()['evicted_capacity'] >= 1
+
+
+def test_idle_clock_restarts_when_a_turn_releases_the_session(tmp_path):
+    store = app.SessionStore(max_sessions=10, idle_seconds=60)
+    session = store.create()
+    session.last_used -= 3600
+    assert store.snapshot()['active'] == 1
+    store.release(session)
+    assert store.get(session.id) is session
+    session.last_used -= 3600
+    assert store.get(session.id) is None
+    assert store.snapshot()['evicted_idle'] == 1
+
+
+def test_deleting_a_session_in_use_defers_cleanup(tmp_path):
+    store = app.SessionStore(max_sessions=10, idle_seconds=60)
+    session = store.create()
+    store.release(session)
+    turn = store.checkout(session.id)
+    upload = attach_upload(turn, tmp_path)
+    assert store.delete(session.id)
+    assert store.get(session.id) is None
+    assert os.path.exists(upload)
+    store.release(turn)
+    assert not os.path.exists(upload)
+
+
+@pytest.fixture
+def sessions_api(monkeypatch):
+    store = app.SessionStore(max_sessions=2, idle_seconds=60)
+    monkeypatch.setattr(app, 'session_store', store)
+    return app.app.test_client(), store
+
+
+def test_session_reuses_uploads_until_it_expires(sessions_api):
+    client, store = sessions_api
+    source = b'def add(a, b):\n    return a + b\n'
+    created = client.post('/api/sessions', json={
+        'files': [{'name': 'calc.py', 'content': base64.b64encode(source).decode()}]}).get_json()
+    assert created['inputs']['analyzed'] == ['calc.py']
+    session_id = created['session_id']
+
+    # A repeat attach by hash alone is not re-analyzed
+    inputs = client.post(f'/api/sessions/{session_id}/inputs', json={
+        'files': [{'name': 'calc.py', 'sha256': hashlib.sha256(source).hexdigest()},
+                  {'name': 'other.py', 'sha256': '0' * 64}]}).get_json()['inputs']
+    assert inputs['unchanged'] == ['calc.py']
+    assert inputs['missing'] == ['other.py']
+
+    session = store.get(session_id)
+    upload = session.entries['calc.py']['upload']
+    assert os.path.exists(upload)
+    session.last_used -= 3600
+    response = client.get(f'/api/sessions/{session_id}')
+    assert response.status_code == 404
+    assert response.get_json()['error'] == 'Unknown or expired session'
+    assert client.post(f'/api/sessions/{session_id}/turns', json={'prompt': 'hi'}).status_code == 404
+    assert not os.path.exists(upload)
+    assert store.snapshot()['evicted_idle'] == 1
+
+
+def test_least_recently_used_session_is_evicted_at_capacity(sessions_api):
+    client, store = sessions_api
+    first, second = (client.post('/api/sessions', json={}).get_json()['session_id'] for _ in range(2))
+    assert client.get(f'/api/sessions/{first}').status_code == 200
+    client.post('/api/sessions', json={})
+    assert client.get(f'/api/sessions/{second}').status_code == 404
+    assert client.get(f'/api/sessions/{first}').status_code == 200
+    assert store.snapshot()['evicted_capacity'] == 1
@@ -0,0 +1,77 @@
+import re
+
+import pytest
+
+import app
+
+
+class WordEncoding:
+    """Stands in for tiktoken where its BPE file cannot be downloaded"""
+
+    def encode(self, text):
+        return re.findall(r'\w+|[^\w\s]|\s+', text)
+
+
+@pytest.fixture
+def encoding(monkeypatch):
+    monkeypatch.setattr(app, 'get_encoding', lambda model='cl100k_base': WordEncoding())
+
+
+def python_module(noun: str) -> str:
+    lines = ['import math', '']
+    for verb in ('load', 'save', 'check', 'merge', 'render', 'parse'):
+        lines += [f"def {verb}_{noun}(record, options=None):", f'    """{verb.title()} a {noun} record"""']
+        lines += [f"    value_{i} = record.get('{noun}_{i}', 0) * math.sqrt({i + 1})" for i in range(8)]
+        lines += ["    return value_0 + value_1", '']
+    return '\n'.join(lines)
+
+
+def test_calibrated_ratio_estimates_held_out_files_within_the_margin(encoding):
+    margin = app.DEFAULT_CONFIG['tokenEstimateMargin']
+    estimator = app.TokenEstimator(margin, 0)
+    sources = [python_module(noun) for noun in ('order', 'invoice', 'customer', 'parcel', 'ticket', 'coupon')]
+    estimator.calibrate([(source, 'python') for source in sources[:3]])
+    chars = sum(len(source) for source in sources[:3])
+    assert estimator.ratio('python') == chars / sum(app.count_tokens(source) for source in sources[:3])
+    for source in sources[3:]:
+        exact = app.count_tokens(source)
+        assert abs(estimator.estimate(source, 'python') - exact) <= margin * exact
+
+
+def test_ratio_is_kept_until_enough_text_was_counted(encoding):
+    estimator = app.TokenEstimator(0.1, 10_000)
+    seed = estimator.ratio('python')
+    estimator.count(python_module('order'), 'python')
+    assert estimator.needs_calibration('python')
+    assert estimator.ratio('python') == seed
+    estimator.calibrate([(python_module(noun), 'python') for noun in ('invoice', 'customer', 'parcel', 'ticket')] * 3)
+    assert not estimator.needs_calibration('python')
+    assert estimator.ratio('python') != seed
+    assert estimator.snapshot()['error']['python']['samples'] == 13
+
+
+def test_fallback_counts_do_not_recalibrate(monkeypatch):
+    monkeypatch.setattr(app, 'get_encoding', lambda model='cl100k_base': None)
+    estimator = app.TokenEstimator(0.1, 100)
+    source = python_module('order')
+    assert estimator.count(source, 'python') == len(source) // 4
+    assert estimator.ratio('python') == app.TokenEstimator.SEED_RATIOS['python']
+    assert estimator.needs_calibration('python')
+    snapshot = estimator.snapshot()
+    assert (snapshot['exact'], snapshot['fallback'], snapshot['error']) == (0, 1, {})
+
+
+def test_fits_is_undecided_only_within_the_margin():
+    estimator = app.TokenEstimator(0.1, 0)
+    assert estimator.fits(900, 1000) is True
+    assert estimator.fits(1000, 1000) is None
+    assert estimator.fits(1100, 1000) is None
+    assert estimator.fits(1112, 1000) is False
+
+
+def test_workers_adopt_the_request_process_ratios():
+    estimator = app.TokenEstimator(0.1, 0)
+    estimator.load_ratios({'python': 2.5})
+    assert estimator.ratio('python') == 2.5
+    assert estimator.estimate('x' * 100, 'python') == 40
+    assert estimator.ratio('unknown-language') == app.TokenEstimator.SEED_RATIOS['text']
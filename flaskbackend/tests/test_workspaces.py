@@ -0,0 +1,79 @@
+import os
+import time
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def workspace(tmp_path):
+    (tmp_path / 'src').mkdir()
+    (tmp_path / 'node_modules' / 'lib').mkdir(parents=True)
+    (tmp_path / 'src' / 'main.py').write_text('def main():\n    return 1\n')
+    (tmp_path / 'node_modules' / 'lib' / 'index.js').write_text('module.exports = 1;\n')
+    index = app.WorkspaceIndex(str(tmp_path))
+    index.structure_stale = index.rescan_requested = False
+    return index
+
+
+def test_events_in_ignored_directories_cost_nothing(workspace):
+    registry = app.WorkspaceRegistry()
+    root = workspace.root
+    for event_type, path, is_directory in (
+            ('modified', os.path.join(root, 'node_modules', 'lib', 'index.js'), False),
+            ('created', os.path.join(root, 'node_modules', 'left-pad'), True),
+            ('modified', os.path.join(root, '.git', 'index'), False),
+            ('created', os.path.join(root, 'build'), True),
+            ('modified', os.path.join(root, 'src'), True),
+            ('closed', os.path.join(root, 'src', 'main.py'), False)):
+        assert not registry._on_change(workspace, event_type, [path], is_directory)
+    assert not workspace.structure_stale and not workspace.rescan_requested and not workspace.pending
+
+
+def test_source_and_directory_changes_are_queued(workspace):
+    registry = app.WorkspaceRegistry()
+    root = workspace.root
+    assert registry._on_change(workspace, 'modified', [os.path.join(root, 'README.md')], False)
+    assert workspace.structure_stale and not workspace.pending
+    main = os.path.join(root, 'src', 'main.py')
+    assert registry._on_change(workspace, 'moved', [os.path.join(root, 'node_modules', 'x.py'), main], False)
+    assert list(workspace.pending) == [main]
+    assert not workspace.rescan_requested
+    assert registry._on_change(workspace, 'created', [os.path.join(root, 'src', 'pkg')], True)
+    assert workspace.rescan_requested
+
+
+def test_structure_skips_ignored_directories(workspace):
+    structure = app.ASTContextAnalyzer().analyze_folder_structure(
+        workspace.root, set(app.DEFAULT_CONFIG['workspaceIgnoreDirs']))
+    assert [entry['path'] for entry in structure['files']] == [os.path.join('src', 'main.py')]
+    assert structure['directories'] == ['src']
+
+
+def test_indexer_survives_a_failing_file(tmp_path, monkeypatch):
+    monkeypatch.setitem(app.DEFAULT_CONFIG, 'workspacePollSeconds', 60.0)
+    monkeypatch.setitem(app.DEFAULT_CONFIG, 'workspaceIndexDutyCycle', 1.0)
+    broken, healthy = tmp_path / 'broken', tmp_path / 'healthy'
+    for folder in (broken, healthy):
+        folder.mkdir()
+        (folder / 'module.py').write_text('def f():\n    return 1\n')
+
+    registry = app.WorkspaceRegistry()
+    index_file = registry._index_file
+
+    def failing_index_file(workspace, path):
+        if workspace.root == str(broken):
+            raise RuntimeError('analyzer crashed')
+        index_file(workspace, path)
+    monkeypatch.setattr(registry, '_index_file', failing_index_file)
+
+    first = registry.register(str(broken))
+    second = registry.register(str(healthy))
+    deadline = time.monotonic() + 10
+    while second.state != 'ready' and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert second.state == 'ready'
+    assert registry.describe(first)['state'] == 'error'
+    assert registry.describe(first)['error'] == 'analyzer crashed'
+    assert registry._thread.is_alive()
@@ -5,10 +5,160 @@ var __importDefault = (this && this.__importDefault) || function (mod) {
 Object.defineProperty(exports, "__esModule", { value: true });
 exports.BackendClient = void 0;
 const axios_1 = __importDefault(require("axios"));
+const workspace_collector_1 = require("./workspace-collector");
+// Raw bytes per /inputs request when streaming a folder's changed files
+const UPLOAD_BATCH_BYTES = 2 * 1024 * 1024;
 class BackendClient {
     constructor(config) {
+        this.attached = new Set();
         this.config = config;
     }
+    async postJson(route, body, timeout) {
+        return fetch(`${this.config.backendUrl}${route}`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-Request-Timeout-Ms': String(timeout),
+                'X-Request-Priority': 'interactive',
+            },
+            body: JSON.stringify(body),
+            signal: AbortSignal.timeout(timeout)
+        });
+    }
+    // The backend walker's ignore rules, so a collected folder holds the files it would index
+    async getCollectRules() {
+        try {
+            const response = await axios_1.default.get(`${this.config.backendUrl}/api/workspaces/rules`, { timeout: 5000 });
+            return { ...workspace_collector_1.DEFAULT_COLLECT_RULES, ...response.data.rules };
+        }
+        catch (error) {
+            return workspace_collector_1.DEFAULT_COLLECT_RULES;
+        }
+    }
+    // Bring the session's files in line with `files`: hashes first, then only the bytes it lacks, in batches
+    async syncSessionInputs(files, readContent, timing) {
+        if (!this.sessionId) {
+            const response = await this.postJson('/api/sessions', {}, this.config.timeout);
+            if (!response.ok) {
+                throw new Error(`HTTP error! status: ${response.status}`);
+            }
+            this.sessionId = (await response.json()).session_id;
+            this.attached.clear();
+        }
+        const route = `/api/sessions/${this.sessionId}/inputs`;
+        const keyOf = (file) => file.relativePath || file.name;
+        const wanted = new Map(files.map((file) => [keyOf(file), file]));
+        const attach = async (body) => {
+            const response = await this.postJson(route, body, this.config.timeout);
+            if (response.status === 404) {
+                // The backend evicted the session: start over with a new one
+                this.sessionId = undefined;
+                throw new Error('session expired');
+            }
+            if (!response.ok) {
+                throw new Error(`HTTP error! status: ${response.status}`);
+            }
+            const inputs = (await response.json()).inputs;
+            timing.backendMs += inputs.analysis_ms || 0;
+            return inputs;
+        };
+        const inputs = await attach({
+            remove: [...this.attached].filter((key) => !wanted.has(key)),
+            files: files.filter((file) => file.sha256).map((file) => ({ name: file.name, relativePath: keyOf(file), sha256: file.sha256 }))
+        });
+        timing.unchanged = inputs.unchanged.length;
+        inputs.removed.forEach((key) => this.attached.delete(key));
+        inputs.unchanged.forEach((key) => this.attached.add(key));
+        // Changed files plus any picked in the webview, which arrive with their bytes
+        const missing = new Set(inputs.missing);
+        const toSend = files.filter((file) => file.content || missing.has(keyOf(file)));
+        const batches = [];
+        let size = UPLOAD_BATCH_BYTES;
+        for (const file of toSend) {
+            if (size + (file.size || 0) > UPLOAD_BATCH_BYTES) {
+                batches.push([]);
+                size = 0;
+            }
+            batches[batches.length - 1].push(file);
+            size += file.size || 0;
+        }
+        // Files picked in the webview already carry their bytes; folder files are read now and
+        // sent with the hash of what was read, in case they changed since they were collected
+        const readBatch = (batch) => Promise.all(batch.map(async (file) => ({
+            name: file.name,
+            relativePath: keyOf(file),
+            ...(file.content ? { content: file.content } : await readContent(file))
+        })));
+        // Read the next batch while the current one is being sent
+        let next = batches.length > 0 ? readBatch(batches[0]) : undefined;
+        for (let index = 0; next; index++) {
+            const batch = await next;
+            next = index + 1 < batches.length ? readBatch(batches[index + 1]) : undefined;
+            const sent = await attach({ files: batch });
+            sent.analyzed.concat(sent.unchanged).forEach((key) => this.attached.add(key));
+            timing.uploaded += batch.length;
+        }
+    }
+    // Run a prompt against folder files through a session, uploading only new or changed files.
+    // `context` is sent with the turn just as analyzeAndExecute sends it.
+    async analyzeWorkspace(prompt, files, readContent, context) {
+        const timing = { uploaded: 0, unchanged: 0, uploadMs: 0, backendMs: 0, turnMs: 0 };
+        try {
+            const uploadStart = Date.now();
+            try {
+                await this.syncSessionInputs(files, readContent, timing);
+            }
+            catch (error) {
+                if (this.sessionId) {
+                    throw error;
+                }
+                await this.syncSessionInputs(files, readContent, timing);
+            }
+            timing.uploadMs = Date.now() - uploadStart;
+            timing.backendMs = Math.round(timing.backendMs);
+            const turnStart = Date.now();
+            const turnBody = { prompt };
+            if (context) {
+                turnBody.context = context;
+            }
+            const response = await this.postJson(`/api/sessions/${this.sessionId}/turns`, turnBody, this.config.timeout);
+            timing.turnMs = Date.now() - turnStart;
+            if (response.status === 429) {
+                const retryAfter = response.headers.get('Retry-After') || '1';
+                return {
+                    success: false,
+                    type: 'analysis',
+                    error: `Backend is busy, try again in ${retryAfter}s`,
+                    prompt: prompt,
+                    timing
+                };
+            }
+            if (!response.ok) {
+                throw new Error(`HTTP error! status: ${response.status}`);
+            }
+            const data = await response.json();
+            return {
+                success: data.success,
+                type: data.type,
+                output: data.output,
+                sections: data.sections,
+                error: data.error,
+                prompt: data.prompt,
+                files: data.files,
+                timing
+            };
+        }
+        catch (error) {
+            console.error('Error in analyzeWorkspace:', error);
+            return {
+                success: false,
+                type: 'analysis',
+                error: `Backend error: ${error}`,
+                prompt: prompt,
+                timing
+            };
+        }
+    }
     async healthCheck() {
         try {
             const response = await axios_1.default.get(`${this.config.backendUrl}/api/health`, {
@@ -34,10 +184,24 @@ class BackendClient {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
+                    // Lets the backend budget its work to finish before we abort
+                    'X-Request-Timeout-Ms': String(this.config.timeout),
+                    // A user is waiting on this one: schedule it ahead of batch work
+                    'X-Request-Priority': 'interactive',
                 },
                 body: JSON.stringify(requestBody),
                 signal: AbortSignal.timeout(this.config.timeout)
             });
+            if (response.status === 429) {
+                // Shed by the backend's admission control: report when to come back instead of adding to the overload
+                const retryAfter = response.headers.get('Retry-After') || '1';
+                return {
+                    success: false,
+                    type: 'analysis',
+                    error: `Backend is busy, try again in ${retryAfter}s`,
+                    prompt: prompt
+                };
+            }
             if (!response.ok) {
                 throw new Error(`HTTP error! status: ${response.status}`);
             }
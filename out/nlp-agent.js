@@ -35,9 +35,11 @@ var __importStar = (this && this.__importStar) || (function () {
 Object.defineProperty(exports, "__esModule", { value: true });
 exports.NLPAgent = void 0;
 const backend_client_1 = require("./backend-client");
+const workspace_collector_1 = require("./workspace-collector");
 const vscode = __importStar(require("vscode"));
 class NLPAgent {
     constructor(context, config) {
+        this.collector = new workspace_collector_1.WorkspaceCollector();
         this.context = context;
         this.config = config;
         // Use backend URL if provided, otherwise default to localhost:5000
@@ -47,6 +49,14 @@ class NLPAgent {
             timeout: config.timeout
         });
     }
+    // List and hash a folder without blocking the editor; files unchanged since the last pick are not re-read
+    async collectFolder(folderPath) {
+        const rules = await this.backendClient.getCollectRules();
+        const collected = await this.collector.collect(folderPath, rules);
+        const { stats } = collected;
+        console.log(`Collected ${stats.files} files from ${folderPath} in ${stats.collectMs} ms (${stats.hashed} read, ${stats.cached} cached, ${stats.bytesRead} bytes)`);
+        return collected;
+    }
     async analyzeAndExecute(userPrompt, vsContext, files) {
         try {
             vscode.window.showInformationMessage(`🤖 Analyzing: "${userPrompt}"`);
@@ -80,6 +90,19 @@ class NLPAgent {
             else if (vsContext) {
                 // analyzeContext is removed; just return empty string
             }
+            // Folder files carry a hash instead of their bytes: sync them to a backend session, sending only changes
+            if (files && files.some((file) => file.sha256 && !file.content)) {
+                const result = await this.backendClient.analyzeWorkspace(userPrompt, files, (file) => this.collector.readContent(file), context);
+                if (result.timing) {
+                    const timing = result.timing;
+                    console.log(`Uploaded ${timing.uploaded} files (${timing.unchanged} unchanged) in ${timing.uploadMs} ms, ` +
+                        `backend attach ${timing.backendMs} ms, turn ${timing.turnMs} ms`);
+                }
+                if (result.success) {
+                    vscode.window.showInformationMessage(`📝 Analysis completed successfully`);
+                }
+                return result;
+            }
             // Use the intelligent endpoint
             const result = await this.backendClient.analyzeAndExecute(userPrompt, context, files);
             console.log(result);
@@ -0,0 +1,145 @@
+"use strict";
+var __createBinding = (this && this.__createBinding) || (Object.create ? (function(o, m, k, k2) {
+    if (k2 === undefined) k2 = k;
+    var desc = Object.getOwnPropertyDescriptor(m, k);
+    if (!desc || ("get" in desc ? !m.__esModule : desc.writable || desc.configurable)) {
+      desc = { enumerable: true, get: function() { return m[k]; } };
+    }
+    Object.defineProperty(o, k2, desc);
+}) : (function(o, m, k, k2) {
+    if (k2 === undefined) k2 = k;
+    o[k2] = m[k];
+}));
+var __setModuleDefault = (this && this.__setModuleDefault) || (Object.create ? (function(o, v) {
+    Object.defineProperty(o, "default", { enumerable: true, value: v });
+}) : function(o, v) {
+    o["default"] = v;
+});
+var __importStar = (this && this.__importStar) || (function () {
+    var ownKeys = function(o) {
+        ownKeys = Object.getOwnPropertyNames || function (o) {
+            var ar = [];
+            for (var k in o) if (Object.prototype.hasOwnProperty.call(o, k)) ar[ar.length] = k;
+            return ar;
+        };
+        return ownKeys(o);
+    };
+    return function (mod) {
+        if (mod && mod.__esModule) return mod;
+        var result = {};
+        if (mod != null) for (var k = ownKeys(mod), i = 0; i < k.length; i++) if (k[i] !== "default") __createBinding(result, mod, k[i]);
+        __setModuleDefault(result, mod);
+        return result;
+    };
+})();
+Object.defineProperty(exports, "__esModule", { value: true });
+exports.WorkspaceCollector = exports.DEFAULT_COLLECT_RULES = void 0;
+const fs = __importStar(require("fs"));
+const path = __importStar(require("path"));
+const crypto = __importStar(require("crypto"));
+exports.DEFAULT_COLLECT_RULES = {
+    ignoreDirs: ['node_modules', '__pycache__', 'venv', 'dist', 'build', 'out', 'target'],
+    ignoreHidden: true,
+    extensions: ['.c', '.css', '.h', '.html', '.java', '.js', '.json', '.py', '.ts', '.xml', '.yaml', '.yml'],
+    maxFiles: 5000,
+    maxFileBytes: 1024 * 1024
+};
+// Run `worker` over `items` with at most `limit` calls in flight
+async function mapLimit(items, limit, worker) {
+    const results = new Array(items.length);
+    let next = 0;
+    const lanes = Array.from({ length: Math.min(limit, items.length) }, async () => {
+        while (next < items.length) {
+            const index = next++;
+            results[index] = await worker(items[index]);
+        }
+    });
+    await Promise.all(lanes);
+    return results;
+}
+class WorkspaceCollector {
+    constructor(concurrency = 8) {
+        this.concurrency = concurrency;
+        // Absolute path -> hash of the bytes it had at that mtime and size
+        this.cache = new Map();
+    }
+    // List and hash a folder's files off the extension host thread; unchanged files are not re-read
+    async collect(root, rules = exports.DEFAULT_COLLECT_RULES) {
+        const start = Date.now();
+        const stats = { files: 0, hashed: 0, cached: 0, bytesRead: 0, collectMs: 0 };
+        const candidates = await this.walk(root, rules);
+        const hashed = await mapLimit(candidates, this.concurrency, async (candidate) => {
+            try {
+                const stat = await fs.promises.stat(candidate.path);
+                if (stat.size > rules.maxFileBytes) {
+                    return undefined;
+                }
+                const cached = this.cache.get(candidate.path);
+                if (cached && cached.mtimeMs === stat.mtimeMs && cached.size === stat.size) {
+                    stats.cached++;
+                    return { ...candidate, size: stat.size, sha256: cached.sha256 };
+                }
+                const content = await fs.promises.readFile(candidate.path);
+                const sha256 = crypto.createHash('sha256').update(content).digest('hex');
+                this.cache.set(candidate.path, { mtimeMs: stat.mtimeMs, size: stat.size, sha256 });
+                stats.hashed++;
+                stats.bytesRead += content.length;
+                return { ...candidate, size: content.length, sha256 };
+            }
+            catch (e) {
+                // skip unreadable files
+                return undefined;
+            }
+        });
+        const files = hashed.filter((file) => file !== undefined);
+        stats.files = files.length;
+        stats.collectMs = Date.now() - start;
+        return { files, stats };
+    }
+    // Base64 bytes of a collected file for uploading, with the hash of exactly those bytes;
+    // a file edited since it was collected is uploaded, hashed and cached as it is now
+    async readContent(file) {
+        const stat = await fs.promises.stat(file.path);
+        const content = await fs.promises.readFile(file.path);
+        const sha256 = crypto.createHash('sha256').update(content).digest('hex');
+        this.cache.set(file.path, { mtimeMs: stat.mtimeMs, size: stat.size, sha256 });
+        return { content: content.toString('base64'), sha256 };
+    }
+    // Breadth-first listing under the same ignore rules as the backend's workspace walker
+    async walk(root, rules) {
+        const ignored = new Set(rules.ignoreDirs);
+        const extensions = new Set(rules.extensions.map((extension) => extension.toLowerCase()));
+        const found = [];
+        let level = [''];
+        while (level.length > 0 && found.length < rules.maxFiles) {
+            const listings = await mapLimit(level, this.concurrency, async (rel) => {
+                try {
+                    return { rel, entries: await fs.promises.readdir(path.join(root, rel), { withFileTypes: true }) };
+                }
+                catch (e) {
+                    return { rel, entries: [] };
+                }
+            });
+            level = [];
+            for (const { rel, entries } of listings) {
+                for (const entry of entries) {
+                    if (rules.ignoreHidden && entry.name.startsWith('.')) {
+                        continue;
+                    }
+                    const relPath = path.join(rel, entry.name);
+                    if (entry.isDirectory()) {
+                        if (!ignored.has(entry.name)) {
+                            level.push(relPath);
+                        }
+                    }
+                    else if (entry.isFile() && extensions.has(path.extname(entry.name).toLowerCase()) && found.length < rules.maxFiles) {
+                        found.push({ name: entry.name, relativePath: relPath, path: path.join(root, relPath), type: 'file' });
+                    }
+                }
+            }
+        }
+        return found;
+    }
+}
+exports.WorkspaceCollector = WorkspaceCollector;
+//# sourceMappingURL=workspace-collector.js.map
\ No newline at end of file
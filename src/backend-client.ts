@@ -1,5 +1,6 @@
 import axios from 'axios';
 import * as vscode from 'vscode';
+import { CollectRules, DEFAULT_COLLECT_RULES } from './workspace-collector';
 
 export interface BackendConfig {
   backendUrl: string;
@@ -19,6 +20,20 @@ export interface FileInfo {
   language: string;
 }
 
+export interface UploadTiming {
+  uploaded: number;  // Files whose bytes were sent
+  unchanged: number;  // Files the session already had at the same SHA-256
+  uploadMs: number;  // Wall time of all /inputs requests, reads included
+  backendMs: number;  // Time the backend spent attaching them (its analysis_ms)
+  turnMs: number;
+}
+
+// Raw bytes per /inputs request when streaming a folder's changed files
+const UPLOAD_BATCH_BYTES = 2 * 1024 * 1024;
+
+// Reads a collected file for upload: its base64 bytes and the SHA-256 of those bytes
+export type ContentReader = (file: any) => Promise<{ content: string; sha256: string }>;
+
 export interface ContextAnalysis {
   success: boolean;
   context?: string;
@@ -28,11 +43,173 @@ export interface ContextAnalysis {
 
 export class BackendClient {
   private config: BackendConfig;
+  // Session holding the folder files uploaded so far, and the keys attached to it
+  private sessionId?: string;
+  private attached = new Set<string>();
 
   constructor(config: BackendConfig) {
     this.config = config;
   }
 
+  private async postJson(route: string, body: any, timeout: number): Promise<Response> {
+    return fetch(`${this.config.backendUrl}${route}`, {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+        'X-Request-Timeout-Ms': String(timeout),
+        'X-Request-Priority': 'interactive',
+      },
+      body: JSON.stringify(body),
+      signal: AbortSignal.timeout(timeout)
+    });
+  }
+
+  // The backend walker's ignore rules, so a collected folder holds the files it would index
+  async getCollectRules(): Promise<CollectRules> {
+    try {
+      const response = await axios.get(`${this.config.backendUrl}/api/workspaces/rules`, { timeout: 5000 });
+      return { ...DEFAULT_COLLECT_RULES, ...response.data.rules };
+    } catch (error) {
+      return DEFAULT_COLLECT_RULES;
+    }
+  }
+
+  // Bring the session's files in line with `files`: hashes first, then only the bytes it lacks, in batches
+  private async syncSessionInputs(files: any[], readContent: ContentReader, timing: UploadTiming): Promise<void> {
+    if (!this.sessionId) {
+      const response = await this.postJson('/api/sessions', {}, this.config.timeout);
+      if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}`);
+      }
+      this.sessionId = ((await response.json()) as any).session_id;
+      this.attached.clear();
+    }
+    const route = `/api/sessions/${this.sessionId}/inputs`;
+    const keyOf = (file: any) => file.relativePath || file.name;
+    const wanted = new Map<string, any>(files.map((file) => [keyOf(file), file]));
+    const attach = async (body: any) => {
+      const response = await this.postJson(route, body, this.config.timeout);
+      if (response.status === 404) {
+        // The backend evicted the session: start over with a new one
+        this.sessionId = undefined;
+        throw new Error('session expired');
+      }
+      if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}`);
+      }
+      const inputs = ((await response.json()) as any).inputs;
+      timing.backendMs += inputs.analysis_ms || 0;
+      return inputs;
+    };
+
+    const inputs = await attach({
+      remove: [...this.attached].filter((key) => !wanted.has(key)),
+      files: files.filter((file) => file.sha256).map((file) => ({ name: file.name, relativePath: keyOf(file), sha256: file.sha256 }))
+    });
+    timing.unchanged = inputs.unchanged.length;
+    inputs.removed.forEach((key: string) => this.attached.delete(key));
+    inputs.unchanged.forEach((key: string) => this.attached.add(key));
+
+    // Changed files plus any picked in the webview, which arrive with their bytes
+    const missing = new Set<string>(inputs.missing);
+    const toSend = files.filter((file) => file.content || missing.has(keyOf(file)));
+    const batches: any[][] = [];
+    let size = UPLOAD_BATCH_BYTES;
+    for (const file of toSend) {
+      if (size + (file.size || 0) > UPLOAD_BATCH_BYTES) {
+        batches.push([]);
+        size = 0;
+      }
+      batches[batches.length - 1].push(file);
+      size += file.size || 0;
+    }
+    // Files picked in the webview already carry their bytes; folder files are read now and
+    // sent with the hash of what was read, in case they changed since they were collected
+    const readBatch = (batch: any[]) => Promise.all(batch.map(async (file) => ({
+      name: file.name,
+      relativePath: keyOf(file),
+      ...(file.content ? { content: file.content } : await readContent(file))
+    })));
+    // Read the next batch while the current one is being sent
+    let next = batches.length > 0 ? readBatch(batches[0]) : undefined;
+    for (let index = 0; next; index++) {
+      const batch = await next;
+      next = index + 1 < batches.length ? readBatch(batches[index + 1]) : undefined;
+      const sent = await attach({ files: batch });
+      sent.analyzed.concat(sent.unchanged).forEach((key: string) => this.attached.add(key));
+      timing.uploaded += batch.length;
+    }
+  }
+
+  // Run a prompt against folder files through a session, uploading only new or changed files.
+  // `context` is sent with the turn just as analyzeAndExecute sends it.
+  async analyzeWorkspace(prompt: string, files: any[], readContent: ContentReader, context?: string): Promise<{
+    success: boolean;
+    type: 'analysis';
+    output?: string;
+    sections?: ResponseSections;
+    error?: string;
+    prompt: string,
+    files?: any[],
+    timing?: UploadTiming
+  }> {
+    const timing: UploadTiming = { uploaded: 0, unchanged: 0, uploadMs: 0, backendMs: 0, turnMs: 0 };
+    try {
+      const uploadStart = Date.now();
+      try {
+        await this.syncSessionInputs(files, readContent, timing);
+      } catch (error) {
+        if (this.sessionId) {
+          throw error;
+        }
+        await this.syncSessionInputs(files, readContent, timing);
+      }
+      timing.uploadMs = Date.now() - uploadStart;
+      timing.backendMs = Math.round(timing.backendMs);
+
+      const turnStart = Date.now();
+      const turnBody: any = { prompt };
+      if (context) {
+        turnBody.context = context;
+      }
+      const response = await this.postJson(`/api/sessions/${this.sessionId}/turns`, turnBody, this.config.timeout);
+      timing.turnMs = Date.now() - turnStart;
+      if (response.status === 429) {
+        const retryAfter = response.headers.get('Retry-After') || '1';
+        return {
+          success: false,
+          type: 'analysis',
+          error: `Backend is busy, try again in ${retryAfter}s`,
+          prompt: prompt,
+          timing
+        };
+      }
+      if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}`);
+      }
+      const data = await response.json() as any;
+      return {
+        success: data.success,
+        type: data.type,
+        output: data.output,
+        sections: data.sections,
+        error: data.error,
+        prompt: data.prompt,
+        files: data.files,
+        timing
+      };
+    } catch (error) {
+      console.error('Error in analyzeWorkspace:', error);
+      return {
+        success: false,
+        type: 'analysis',
+        error: `Backend error: ${error}`,
+        prompt: prompt,
+        timing
+      };
+    }
+  }
+
   async healthCheck(): Promise<boolean> {
     try {
       const response = await axios.get(`${this.config.backendUrl}/api/health`, {
@@ -67,11 +244,26 @@ export class BackendClient {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
+          // Lets the backend budget its work to finish before we abort
+          'X-Request-Timeout-Ms': String(this.config.timeout),
+          // A user is waiting on this one: schedule it ahead of batch work
+          'X-Request-Priority': 'interactive',
         },
         body: JSON.stringify(requestBody),
         signal: AbortSignal.timeout(this.config.timeout)
       });
 
+      if (response.status === 429) {
+        // Shed by the backend's admission control: report when to come back instead of adding to the overload
+        const retryAfter = response.headers.get('Retry-After') || '1';
+        return {
+          success: false,
+          type: 'analysis',
+          error: `Backend is busy, try again in ${retryAfter}s`,
+          prompt: prompt
+        };
+      }
+
       if (!response.ok) {
         throw new Error(`HTTP error! status: ${response.status}`);
       }
@@ -175,33 +175,9 @@ async function handleInteractiveMode() {
           if (folderUris && folderUris.length > 0) {
             const folderUri = folderUris[0];
             const folderPath = folderUri.fsPath;
-            const files: any[] = [];
-            const fs = require('fs');
-            const path = require('path');
-            function walk(dir: string, rel: string) {
-              const entries = fs.readdirSync(dir, { withFileTypes: true });
-              for (const entry of entries) {
-                const entryPath = path.join(dir, entry.name);
-                const relPath = path.join(rel, entry.name);
-                if (entry.isDirectory()) {
-                  walk(entryPath, relPath);
-                } else if (entry.isFile()) {
-                  try {
-                    const content = fs.readFileSync(entryPath);
-                    files.push({
-                      name: entry.name,
-                      relativePath: relPath,
-                      type: 'file',
-                      size: content.length,
-                      content: content.toString('base64')
-                    });
-                  } catch (e) {
-                    // skip unreadable files
-                  }
-                }
-              }
-            }
-            walk(folderPath, '');
+            // Async, concurrency-limited reads keep the editor responsive; unchanged files are not re-read
+            const { files, stats } = await nlpAgent.collectFolder(folderPath);
+            vscode.window.setStatusBarMessage(`NLP Agent: ${stats.files} files collected in ${stats.collectMs} ms (${stats.cached} cached)`, 5000);
             panel.webview.postMessage({ command: 'folderFiles', files });
           }
         }
@@ -1,10 +1,12 @@
 import { BackendClient } from './backend-client';
+import { CollectedFile, CollectStats, WorkspaceCollector } from './workspace-collector';
 import type { AgentConfig, VSCodeContext } from './types';
 import * as vscode from 'vscode';
 import * as path from 'path';
 
 export class NLPAgent {
   private backendClient: BackendClient;
+  private collector = new WorkspaceCollector();
   private config: AgentConfig;
   private context: vscode.ExtensionContext;
 
@@ -20,6 +22,15 @@ export class NLPAgent {
     });
   }
 
+  // List and hash a folder without blocking the editor; files unchanged since the last pick are not re-read
+  async collectFolder(folderPath: string): Promise<{ files: CollectedFile[]; stats: CollectStats }> {
+    const rules = await this.backendClient.getCollectRules();
+    const collected = await this.collector.collect(folderPath, rules);
+    const { stats } = collected;
+    console.log(`Collected ${stats.files} files from ${folderPath} in ${stats.collectMs} ms (${stats.hashed} read, ${stats.cached} cached, ${stats.bytesRead} bytes)`);
+    return collected;
+  }
+
   async analyzeAndExecute(userPrompt: string, vsContext?: VSCodeContext, files?: any[]): Promise<{ 
     success: boolean; 
     type: 'analysis'; 
@@ -60,6 +71,20 @@ export class NLPAgent {
         // analyzeContext is removed; just return empty string
       }
       
+      // Folder files carry a hash instead of their bytes: sync them to a backend session, sending only changes
+      if (files && files.some((file) => file.sha256 && !file.content)) {
+        const result = await this.backendClient.analyzeWorkspace(userPrompt, files, (file) => this.collector.readContent(file), context);
+        if (result.timing) {
+          const timing = result.timing;
+          console.log(`Uploaded ${timing.uploaded} files (${timing.unchanged} unchanged) in ${timing.uploadMs} ms, ` +
+            `backend attach ${timing.backendMs} ms, turn ${timing.turnMs} ms`);
+        }
+        if (result.success) {
+          vscode.window.showInformationMessage(`📝 Analysis completed successfully`);
+        }
+        return result;
+      }
+
       // Use the intelligent endpoint
       const result = await this.backendClient.analyzeAndExecute(userPrompt, context, files);
       console.log(result)
@@ -0,0 +1,142 @@
+import * as fs from 'fs';
+import * as path from 'path';
+import * as crypto from 'crypto';
+
+// Which files a folder selection picks up; the backend's /api/workspaces/rules
+// reports its own walker's values, these are the same defaults for when it can't be asked
+export interface CollectRules {
+  ignoreDirs: string[];
+  ignoreHidden: boolean;
+  extensions: string[];
+  maxFiles: number;
+  maxFileBytes: number;
+}
+
+export const DEFAULT_COLLECT_RULES: CollectRules = {
+  ignoreDirs: ['node_modules', '__pycache__', 'venv', 'dist', 'build', 'out', 'target'],
+  ignoreHidden: true,
+  extensions: ['.c', '.css', '.h', '.html', '.java', '.js', '.json', '.py', '.ts', '.xml', '.yaml', '.yml'],
+  maxFiles: 5000,
+  maxFileBytes: 1024 * 1024
+};
+
+export interface CollectedFile {
+  name: string;
+  relativePath: string;
+  path: string;
+  type: 'file';
+  size: number;
+  sha256: string;
+}
+
+export interface CollectStats {
+  files: number;
+  hashed: number;  // Files read because they were new or changed
+  cached: number;  // Files whose hash came from the mtime/size cache
+  bytesRead: number;
+  collectMs: number;
+}
+
+interface CacheEntry {
+  mtimeMs: number;
+  size: number;
+  sha256: string;
+}
+
+// Run `worker` over `items` with at most `limit` calls in flight
+async function mapLimit<T, R>(items: T[], limit: number, worker: (item: T) => Promise<R>): Promise<R[]> {
+  const results: R[] = new Array(items.length);
+  let next = 0;
+  const lanes = Array.from({ length: Math.min(limit, items.length) }, async () => {
+    while (next < items.length) {
+      const index = next++;
+      results[index] = await worker(items[index]);
+    }
+  });
+  await Promise.all(lanes);
+  return results;
+}
+
+export class WorkspaceCollector {
+  // Absolute path -> hash of the bytes it had at that mtime and size
+  private cache = new Map<string, CacheEntry>();
+
+  constructor(private concurrency: number = 8) {}
+
+  // List and hash a folder's files off the extension host thread; unchanged files are not re-read
+  async collect(root: string, rules: CollectRules = DEFAULT_COLLECT_RULES): Promise<{ files: CollectedFile[]; stats: CollectStats }> {
+    const start = Date.now();
+    const stats: CollectStats = { files: 0, hashed: 0, cached: 0, bytesRead: 0, collectMs: 0 };
+    const candidates = await this.walk(root, rules);
+    const hashed = await mapLimit(candidates, this.concurrency, async (candidate) => {
+      try {
+        const stat = await fs.promises.stat(candidate.path);
+        if (stat.size > rules.maxFileBytes) {
+          return undefined;
+        }
+        const cached = this.cache.get(candidate.path);
+        if (cached && cached.mtimeMs === stat.mtimeMs && cached.size === stat.size) {
+          stats.cached++;
+          return { ...candidate, size: stat.size, sha256: cached.sha256 };
+        }
+        const content = await fs.promises.readFile(candidate.path);
+        const sha256 = crypto.createHash('sha256').update(content).digest('hex');
+        this.cache.set(candidate.path, { mtimeMs: stat.mtimeMs, size: stat.size, sha256 });
+        stats.hashed++;
+        stats.bytesRead += content.length;
+        return { ...candidate, size: content.length, sha256 };
+      } catch (e) {
+        // skip unreadable files
+        return undefined;
+      }
+    });
+    const files = hashed.filter((file): file is CollectedFile => file !== undefined);
+    stats.files = files.length;
+    stats.collectMs = Date.now() - start;
+    return { files, stats };
+  }
+
+  // Base64 bytes of a collected file for uploading, with the hash of exactly those bytes;
+  // a file edited since it was collected is uploaded, hashed and cached as it is now
+  async readContent(file: CollectedFile): Promise<{ content: string; sha256: string }> {
+    const stat = await fs.promises.stat(file.path);
+    const content = await fs.promises.readFile(file.path);
+    const sha256 = crypto.createHash('sha256').update(content).digest('hex');
+    this.cache.set(file.path, { mtimeMs: stat.mtimeMs, size: stat.size, sha256 });
+    return { content: content.toString('base64'), sha256 };
+  }
+
+  // Breadth-first listing under the same ignore rules as the backend's workspace walker
+  private async walk(root: string, rules: CollectRules): Promise<Omit<CollectedFile, 'size' | 'sha256'>[]> {
+    const ignored = new Set(rules.ignoreDirs);
+    const extensions = new Set(rules.extensions.map((extension) => extension.toLowerCase()));
+    const found: Omit<CollectedFile, 'size' | 'sha256'>[] = [];
+    let level = [''];
+    while (level.length > 0 && found.length < rules.maxFiles) {
+      const listings = await mapLimit(level, this.concurrency, async (rel) => {
+        try {
+          return { rel, entries: await fs.promises.readdir(path.join(root, rel), { withFileTypes: true }) };
+        } catch (e) {
+          return { rel, entries: [] as fs.Dirent[] };
+        }
+      });
+      level = [];
+      for (const { rel, entries } of listings) {
+        for (const entry of entries) {
+          if (rules.ignoreHidden && entry.name.startsWith('.')) {
+            continue;
+          }
+          const relPath = path.join(rel, entry.name);
+          if (entry.isDirectory()) {
+            if (!ignored.has(entry.name)) {
+              level.push(relPath);
+            }
+          } else if (entry.isFile() && extensions.has(path.extname(entry.name).toLowerCase()) && found.length < rules.maxFiles) {
+            found.push({ name: entry.name, relativePath: relPath, path: path.join(root, relPath), type: 'file' });
+          }
+        }
+      }
+    }
+    return found;
+  }
+}